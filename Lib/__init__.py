@@ -24,7 +24,31 @@ Created on Wed Oct 21 13:56:55 2015
 
 from . import helper
 from . import flock
+from . import archive
+from . import checksum
+from . import chunkstore
+from . import compression
+from . import connection
+from . import cron
+from . import daemon
+from . import incremental
+from . import metrics
+from . import nbd
+from . import offline
+from . import pagecache
+from . import preflight
+from . import restore
+from . import retention
+from . import scheduler
+from . import sparse
+from . import storage
+from . import throttle
+from . import verify
 
 __author__ = "Paolo Cozzi"
 __version__ = "1.1"
-__all__ = ["helper", "flock"]
+__all__ = ["helper", "flock", "archive", "checksum", "chunkstore",
+           "compression", "connection", "cron", "daemon", "incremental",
+           "metrics", "nbd", "offline", "pagecache", "preflight", "restore",
+           "retention", "scheduler", "sparse", "storage", "throttle",
+           "verify"]
@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to write backup archives in a single pass: images are read once
+and streamed through tar framing and compression to the final archive.
+
+Indexed archives are tar archives split in independently compressed
+frames: every member starts a new frame, and large members are split in
+many frames. An index of members and frames is stored at the end of the
+archive in frames ignored by decompressors (empty gzip members with an extra
+field, or zstd and lz4 skippable frames), followed by a fixed size footer
+pointing to the index. Indexed archives are still valid compressed tar
+files, and a single member could be read without decompressing the others
+
+"""
+
+from __future__ import print_function
+
+import collections
+import io
+import json
+import logging
+import os
+import struct
+import tarfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import checksum, compression, sparse
+from .storage import LocalStorage
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# read images with large buffers: tarfile defaults to 16K
+BUFSIZE = 4 * 1024 * 1024
+
+# the uncompressed size of frames of indexed archives
+FRAME_SIZE = 16 * 1024 * 1024
+
+# identify the footer of indexed archives, which is in the last bytes
+INDEX_MAGIC = b"KVMBIDX1"
+FOOTER_SEARCH = 128
+
+# the gzip extra subfield id and the max size of its data
+GZIP_SUBFIELD = b"KB"
+GZIP_EXTRA_SIZE = 65000
+
+# zstd and lz4 skippable frame magic number
+SKIPPABLE_MAGIC = 0x184D2A5A
+
+
+def addData(tar, arcname, data):
+    """Add bytes to an open tar file as arcname"""
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tarinfo.mode = 0o644
+
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+class StreamArchive():
+    """A tar archive streamed through a compressor into its final
+    destination"""
+
+    def __init__(self, target, compressor, sparse=True, checksum=True,
+                 throttle=None, storage=None):
+        """Open a compressed archive in target path of storage (a local
+        path by default). Archive is visible in target only when it is
+        closed. If sparse is True, only allocated extents of images are
+        read. If checksum is True, checksums of images are computed while
+        reading. Image reads and archive writes are limited by throttle, if
+        any"""
+
+        self.storage = storage or LocalStorage()
+        self.target = self.storage.getURL(target)
+        self.sparse = sparse
+        self.checksum = checksum
+        self.throttle = throttle
+
+        # the checksums of images, by member name
+        self.checksums = {}
+
+        logger.debug("Compressing '%s' with %s" % (self.target, compressor))
+        self.handle = self.storage.open(target)
+        self.writer = compressor.open(self.target, throttle, self.handle)
+
+        # a tar stream: tar blocks are written on compressor
+        self.tar = tarfile.open(
+            fileobj=self.writer, mode="w|", bufsize=BUFSIZE,
+            format=tarfile.PAX_FORMAT)
+        self.tar.copybufsize = BUFSIZE
+
+    def addData(self, arcname, data):
+        """Add bytes to archive as arcname"""
+
+        logger.debug("Adding '%s' to archive '%s'" % (arcname, self.target))
+        addData(self.tar, arcname, data)
+
+    def addXML(self, arcname, xml):
+        """Add a XML string to archive as arcname"""
+
+        self.addData(arcname, xml.encode("utf-8"))
+
+    def addImage(self, source, arcname):
+        """Read source image once and add it to archive as arcname. Return
+        the number of bytes read"""
+
+        logger.debug("Adding '%s' to archive '%s' as '%s'" % (
+            source, self.target, arcname))
+
+        if not self.checksum:
+            return sparse.addFile(
+                self.tar, source, arcname, sparse=self.sparse,
+                throttle=self.throttle)
+
+        file_checksum = checksum.FileChecksum(os.path.getsize(source))
+
+        result = sparse.addFile(
+            self.tar, source, arcname, sparse=self.sparse,
+            checksum=file_checksum, throttle=self.throttle)
+
+        self.checksums[arcname] = file_checksum.finish()
+        self.checksums[arcname]["source"] = source
+
+        return result
+
+    def addDisk(self, handle, arcname, size, extents):
+        """Add the extents of a disk read from handle (a file object which
+        could seek) to archive as arcname. Disk has size bytes: data out of
+        extents are holes. Return the number of bytes read"""
+
+        logger.debug("Adding '%s' to archive '%s' as '%s'" % (
+            handle.name, self.target, arcname))
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0o600
+
+        if self.throttle is not None:
+            handle = self.throttle.reader(handle)
+
+        if not self.checksum:
+            return sparse.addExtents(self.tar, tarinfo, handle, extents)
+
+        file_checksum = checksum.FileChecksum(size)
+
+        result = sparse.addExtents(
+            self.tar, tarinfo, handle, extents, checksum=file_checksum)
+
+        self.checksums[arcname] = file_checksum.finish()
+
+        return result
+
+    def addChecksums(self, arcname):
+        """Add the checksums of images to archive as arcname"""
+
+        self.addData(arcname, checksum.dumpChecksums(
+            self.checksums).encode("utf-8"))
+
+    def close(self):
+        """Finalize archive and wait for compression to finish"""
+
+        self.tar.close()
+
+        try:
+            # the storage writer is closed by compressor
+            self.writer.close()
+
+        except Exception:
+            self.handle.abort()
+            raise
+
+        logger.debug("Archive '%s' completed" % (self.target))
+
+    def abort(self):
+        """Stop compression and remove the partial archive"""
+
+        logger.warning("Removing incomplete archive '%s'" % (self.target))
+
+        # detach tar stream without writing the end of archive: once
+        # collected, it would write its buffer on the aborted writer
+        self.tar.closed = True
+        self.tar.fileobj.closed = True
+
+        self.writer.abort()
+        self.handle.abort()
+
+
+class FrameWriter():
+    """A file object which splits data in frames compressed in parallel by
+    a pool of threads. Frames are written in order in handle"""
+
+    def __init__(self, handle, compressor, frame_size=FRAME_SIZE):
+        self.handle = handle
+        self.compressor = compressor
+        self.frame_size = frame_size
+
+        # uncompressed data of the current frame
+        self.buffer = []
+        self.buffered = 0
+
+        # uncompressed and compressed offset of the current frame
+        self.offset = 0
+        self.compressed_offset = 0
+
+        # uncompressed offset, uncompressed size, compressed offset and
+        # compressed size of every written frame
+        self.frames = []
+
+        # frames are compressed by threads. Limit frames in memory
+        self.executor = ThreadPoolExecutor(max_workers=compressor.threads)
+        self.pending = collections.deque()
+
+    def tell(self):
+        return self.offset + self.buffered
+
+    def write(self, data):
+        size = len(data)
+
+        # tarfile writes large buffers: split them in frames
+        while data:
+            room = self.frame_size - self.buffered
+            self.buffer += [data[:room]]
+            self.buffered += len(data[:room])
+            data = data[room:]
+
+            if self.buffered >= self.frame_size:
+                self.flush()
+
+        return size
+
+    def flush(self):
+        """Close the current frame, and start its compression"""
+
+        if self.buffered == 0:
+            return
+
+        data = b"".join(self.buffer)
+        future = self.executor.submit(self.compressor.compressFrame, data)
+        self.pending.append((self.offset, len(data), future))
+
+        self.offset += len(data)
+        self.buffer, self.buffered = [], 0
+
+        while len(self.pending) > self.compressor.threads:
+            self.__writeFrame()
+
+    def __writeFrame(self):
+        """Wait for the oldest frame and write it"""
+
+        offset, size, future = self.pending.popleft()
+        data = future.result()
+
+        self.handle.write(data)
+        self.frames += [[offset, size, self.compressed_offset, len(data)]]
+        self.compressed_offset += len(data)
+
+    def close(self):
+        """Write all the remaining frames"""
+
+        self.flush()
+
+        try:
+            while self.pending:
+                self.__writeFrame()
+
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        for offset, size, future in self.pending:
+            future.cancel()
+
+        self.executor.shutdown()
+
+
+class IndexedArchive(StreamArchive):
+    """A tar archive split in independently compressed frames, with an index
+    of members and frames"""
+
+    def __init__(self, target, compressor, sparse=True, checksum=True,
+                 throttle=None, frame_size=FRAME_SIZE, storage=None):
+        """Open an indexed archive in target path of storage. Archive is
+        visible in target only when it is closed"""
+
+        self.storage = storage or LocalStorage()
+        self.target = self.storage.getURL(target)
+        self.sparse = sparse
+        self.checksum = checksum
+        self.throttle = throttle
+        self.checksums = {}
+        self.compressor = compressor
+        self.members = []
+
+        logger.debug("Compressing '%s' with %s in frames of %s bytes" % (
+            self.target, compressor, frame_size))
+
+        self.storage_writer = self.storage.open(target)
+        self.handle = self.storage_writer
+
+        if throttle is not None:
+            self.handle = throttle.writer(self.handle)
+
+        self.writer = FrameWriter(self.handle, compressor, frame_size)
+
+        # not a tar stream: tarfile writes directly on frames, and tar
+        # offsets are the ones of frame writer
+        self.tar = tarfile.open(
+            fileobj=self.writer, mode="w", format=tarfile.PAX_FORMAT)
+        self.tar.copybufsize = BUFSIZE
+
+    def __addMember(self, arcname, size, function, *args):
+        """Add a member to archive by calling function, and index it"""
+
+        # every member starts a new frame
+        self.writer.flush()
+        offset = self.writer.tell()
+
+        result = function(self, *args)
+
+        self.members += [{
+            "name": arcname,
+            "size": size,
+            "offset": offset,
+            "end": self.writer.tell()}]
+
+        return result
+
+    def addData(self, arcname, data):
+        """Add bytes to archive as arcname"""
+
+        return self.__addMember(
+            arcname, len(data), StreamArchive.addData, arcname, data)
+
+    def addImage(self, source, arcname):
+        """Read source image once and add it to archive as arcname. Return
+        the number of bytes read"""
+
+        return self.__addMember(
+            arcname, os.path.getsize(source), StreamArchive.addImage, source,
+            arcname)
+
+    def addDisk(self, handle, arcname, size, extents):
+        """Add the extents of a disk read from handle to archive as
+        arcname. Return the number of bytes read"""
+
+        return self.__addMember(
+            arcname, size, StreamArchive.addDisk, handle, arcname, size,
+            extents)
+
+    def getIndex(self):
+        return {
+            "version": 1,
+            "compression": self.compressor.name,
+            "frames": self.writer.frames,
+            "members": self.members}
+
+    def close(self):
+        """Finalize archive, then write index and footer"""
+
+        try:
+            self.tar.close()
+            self.writer.close()
+
+            # the index and a footer pointing to it
+            index = packData(self.compressor.name, zlib.compress(
+                json.dumps(self.getIndex()).encode("utf-8")))
+            footer = packData(self.compressor.name, INDEX_MAGIC + struct.pack(
+                "<QQ", self.writer.compressed_offset, len(index)))
+
+            self.handle.write(index)
+            self.handle.write(footer)
+            self.handle.close()
+
+            # wrappers could have closed the storage writer already
+            self.storage_writer.close()
+
+        except Exception:
+            self.abort()
+            raise
+
+        logger.debug("Archive '%s' completed with %s frames" % (
+            self.target, len(self.writer.frames)))
+
+    def abort(self):
+        """Stop compression and remove the partial archive"""
+
+        logger.warning("Removing incomplete archive '%s'" % (self.target))
+
+        self.writer.abort()
+        self.storage_writer.abort()
+
+
+def packData(name, data):
+    """Wrap data in frames ignored by the decompressor of name"""
+
+    if name == "gzip":
+        # empty gzip members with data in an extra field
+        members = []
+
+        for start in range(0, max(len(data), 1), GZIP_EXTRA_SIZE):
+            chunk = data[start:start + GZIP_EXTRA_SIZE]
+            subfield = GZIP_SUBFIELD + struct.pack("<H", len(chunk)) + chunk
+
+            # magic, deflate, FEXTRA flag, mtime, xfl, unknown os
+            members += [
+                struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 4, 0, 0, 255) +
+                struct.pack("<H", len(subfield)) + subfield +
+                # an empty deflate block, crc32 and size of no data
+                b"\x03\x00" + struct.pack("<II", 0, 0)]
+
+        return b"".join(members)
+
+    elif name in ["zstd", "lz4"]:
+        return struct.pack("<II", SKIPPABLE_MAGIC, len(data)) + data
+
+    # not compressed: tar readers stop at the end of archive
+    return data
+
+
+def unpackData(data):
+    """Return data wrapped by packData"""
+
+    if data[:2] == b"\x1f\x8b":
+        chunks = []
+
+        while data:
+            xlen, = struct.unpack("<H", data[10:12])
+            extra = data[12:12 + xlen]
+
+            while extra:
+                subfield, size = extra[:2], struct.unpack("<H", extra[2:4])[0]
+
+                if subfield == GZIP_SUBFIELD:
+                    chunks += [extra[4:4 + size]]
+
+                extra = extra[4 + size:]
+
+            # skip the empty deflate block and gzip trailer
+            data = data[12 + xlen + 10:]
+
+        return b"".join(chunks)
+
+    if len(data) >= 8:
+        magic, size = struct.unpack("<II", data[:8])
+
+        if magic == SKIPPABLE_MAGIC:
+            return data[8:8 + size]
+
+    return data
+
+
+def readRange(handle, offset, size):
+    """Read size bytes at offset from a file opened by a storage, without
+    moving it: local files with pread, remote files with a range request.
+    Could be called by many threads"""
+
+    if hasattr(handle, "fileno"):
+        return os.pread(handle.fileno(), size, offset)
+
+    return handle.readRange(offset, size)
+
+
+class FrameReader():
+    """A file object reading a range of the uncompressed data of an indexed
+    archive, by decompressing only the frames needed. With an executor,
+    the following frames are decompressed in parallel while data is read.
+    If storage is provided, path is the name of archive in storage"""
+
+    def __init__(self, path, compressor, frames, start, end, executor=None,
+                 prefetch=4, storage=None):
+        self.handle = (storage or LocalStorage()).open(path, "rb")
+        self.compressor = compressor
+        self.executor = executor
+        self.prefetch = prefetch
+
+        # frames overlapping the requested range
+        self.frames = collections.deque([
+            frame for frame in frames
+            if frame[0] < end and frame[0] + frame[1] > start])
+
+        # frames being decompressed
+        self.futures = collections.deque()
+
+        self.start = start
+        self.position = start
+        self.end = end
+
+        # the current decompressed frame
+        self.current = b""
+        self.current_position = 0
+
+    def __decompress(self, frame):
+        offset, size, compressed_offset, compressed_size = frame
+
+        # ranges could be read by many threads
+        data = self.compressor.decompress(readRange(
+            self.handle, compressed_offset, compressed_size))
+
+        # the first frame could start before the requested range
+        return data[max(0, self.start - offset):]
+
+    def __nextFrame(self):
+        """Return the next decompressed frame, or None"""
+
+        if self.executor is None:
+            if not self.frames:
+                return None
+
+            return self.__decompress(self.frames.popleft())
+
+        while self.frames and len(self.futures) < self.prefetch:
+            self.futures.append(self.executor.submit(
+                self.__decompress, self.frames.popleft()))
+
+        if not self.futures:
+            return None
+
+        return self.futures.popleft().result()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.end - self.position
+
+        size = min(size, self.end - self.position)
+        chunks = []
+
+        while size > 0:
+            if self.current_position >= len(self.current):
+                self.current = self.__nextFrame()
+                self.current_position = 0
+
+                if self.current is None:
+                    self.current = b""
+                    break
+
+            data = self.current[
+                self.current_position:self.current_position + size]
+            self.current_position += len(data)
+            size -= len(data)
+
+            chunks += [data]
+
+        data = b"".join(chunks)
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+
+        self.handle.close()
+
+
+def isIndexed(path, storage=None):
+    """Return True if path is an indexed archive. If storage is provided,
+    path is the name of an archive in storage"""
+
+    storage = storage or LocalStorage()
+    handle = storage.open(path, "rb")
+
+    try:
+        handle.seek(0, os.SEEK_END)
+        handle.seek(max(0, handle.tell() - FOOTER_SEARCH))
+
+        return INDEX_MAGIC in handle.read()
+
+    finally:
+        handle.close()
+
+
+class IndexedReader():
+    """Read members of an indexed archive. If storage is provided, path is
+    the name of archive in storage: only the frames of the members read are
+    requested to remote storages"""
+
+    def __init__(self, path, storage=None):
+        self.path = path
+        self.storage = storage
+        handle = (storage or LocalStorage()).open(path, "rb")
+
+        try:
+            handle.seek(0, os.SEEK_END)
+            size = handle.tell()
+
+            # the footer is the last thing in archive
+            handle.seek(max(0, size - FOOTER_SEARCH))
+            tail = handle.read()
+            position = tail.rfind(INDEX_MAGIC)
+
+            if position < 0:
+                raise Exception("'%s' is not an indexed archive" % (path))
+
+            offset, length = struct.unpack(
+                "<QQ", tail[position + 8:position + 24])
+
+            data = unpackData(readRange(handle, offset, length))
+
+        finally:
+            handle.close()
+
+        self.index = json.loads(zlib.decompress(data).decode("utf-8"))
+
+        self.compressor = compression.COMPRESSORS[
+            self.index["compression"]]()
+
+    def getMembers(self):
+        """Return members as a list of dictionaries"""
+
+        return self.index["members"]
+
+    def getMember(self, name):
+        """Return a member by its name or by its basename"""
+
+        for member in self.getMembers():
+            if name in [member["name"], os.path.basename(member["name"])]:
+                return member
+
+        raise KeyError("'%s' not found in '%s'" % (name, self.path))
+
+    def getReader(self, name, executor=None, prefetch=4):
+        """Return a file object with the tar blocks of the requested member
+        only. Up to prefetch frames are decompressed in parallel by
+        executor, if any"""
+
+        member = self.getMember(name)
+
+        return FrameReader(
+            self.path, self.compressor, self.index["frames"],
+            member["offset"], member["end"], executor=executor,
+            prefetch=prefetch, storage=self.storage)
+
+    def extract(self, name, path="."):
+        """Extract a member in path. Sparse images are restored with holes.
+        Return the path of extracted file"""
+
+        reader = self.getReader(name)
+
+        try:
+            tar = tarfile.open(fileobj=reader, mode="r|")
+            tarinfo = tar.next()
+            tar.extract(tarinfo, path)
+            tar.close()
+
+        finally:
+            reader.close()
+
+        return os.path.join(path, tarinfo.name)
+
+    def read(self, name):
+        """Return the content of a small member, like a XML file"""
+
+        reader = self.getReader(name)
+
+        try:
+            tar = tarfile.open(fileobj=reader, mode="r|")
+            data = tar.extractfile(tar.next()).read()
+            tar.close()
+
+        finally:
+            reader.close()
+
+        return data
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to compute checksums of images while they are read. Images are
+split in fixed size chunks, and the sha256 of every chunk is computed. The
+checksum of a whole image is the sha256 of its chunk checksums, so holes
+never need to be read
+
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+
+from . import sparse
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the size of chunks whose sha256 are stored
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# the suffix of the checksums manifest added to archives
+CHECKSUM_SUFFIX = "-checksums.json"
+
+
+class FileChecksum():
+    """Checksums of a file, computed while data is read sequentially"""
+
+    def __init__(self, size, chunk_size=CHUNK_SIZE):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = []
+        self.position = 0
+        self.current = hashlib.sha256()
+
+        # the checksum of a chunk in a hole
+        self.zero_digest = hashlib.sha256(bytes(chunk_size)).hexdigest()
+
+    def __closeChunk(self):
+        self.digests += [self.current.hexdigest()]
+        self.current = hashlib.sha256()
+
+    def __hash(self, data):
+        """Hash data found at current position"""
+
+        view = memoryview(data)
+
+        while len(view) > 0:
+            room = self.chunk_size - self.position % self.chunk_size
+            block = view[:room]
+
+            self.current.update(block)
+            self.position += len(block)
+            view = view[len(block):]
+
+            if self.position % self.chunk_size == 0:
+                self.__closeChunk()
+
+    def __skip(self, length):
+        """Hash length zeros found at current position"""
+
+        while length > 0:
+            inside = self.position % self.chunk_size
+
+            # a whole chunk of zeros doesn't need to be hashed
+            if inside == 0 and length >= self.chunk_size:
+                self.digests += [self.zero_digest]
+                self.position += self.chunk_size
+                length -= self.chunk_size
+
+            else:
+                block = min(self.chunk_size - inside, length)
+                self.__hash(bytes(block))
+                length -= block
+
+    def update(self, offset, data):
+        """Add data read at offset. Data between the last read and offset
+        are zeros"""
+
+        if offset < self.position:
+            raise Exception("Checksum data need to be read sequentially")
+
+        self.__skip(offset - self.position)
+        self.__hash(data)
+
+    def finish(self):
+        """Hash the remaining holes, and return checksums as a dictionary"""
+
+        self.__skip(self.size - self.position)
+
+        if self.position % self.chunk_size != 0:
+            self.__closeChunk()
+
+        return makeChecksum(self.size, self.chunk_size, self.digests)
+
+
+def makeChecksum(size, chunk_size, digests):
+    """Return the checksums of a file as a dictionary"""
+
+    return {
+        "size": size,
+        "chunk_size": chunk_size,
+        "sha256": hashlib.sha256("".join(digests).encode("ascii")).hexdigest(),
+        "chunks": digests}
+
+
+def fromChunks(chunks, size, chunk_size):
+    """Return the checksums of a file stored in a chunk store, from the list
+    of its [offset, digest]. Chunks of zeros are not stored"""
+
+    digests = dict([(offset // chunk_size, digest)
+                    for offset, digest in chunks])
+    count = (size + chunk_size - 1) // chunk_size
+
+    zero_digest = hashlib.sha256(bytes(chunk_size)).hexdigest()
+    result = []
+
+    for index in range(count):
+        if index in digests:
+            result += [digests[index]]
+
+        elif (index + 1) * chunk_size <= size:
+            result += [zero_digest]
+
+        else:
+            # the last chunk could be smaller
+            result += [hashlib.sha256(
+                bytes(size - index * chunk_size)).hexdigest()]
+
+    return makeChecksum(size, chunk_size, result)
+
+
+def checksumFile(path, chunk_size=CHUNK_SIZE, is_sparse=True):
+    """Compute the checksums of a file, reading only its allocated
+    extents"""
+
+    with open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        checksum = FileChecksum(size, chunk_size)
+
+        if is_sparse:
+            extents = sparse.getExtents(handle, size)
+
+        else:
+            extents = [(0, size)]
+
+        for offset, length in extents:
+            handle.seek(offset)
+
+            while length > 0:
+                data = handle.read(min(sparse.BUFSIZE, length))
+
+                if not data:
+                    raise IOError("Unexpected end of file in '%s'" % (path))
+
+                checksum.update(offset, data)
+                offset += len(data)
+                length -= len(data)
+
+    return checksum.finish()
+
+
+def compare(expected, actual):
+    """Return the indexes of chunks which differ"""
+
+    if expected["chunk_size"] != actual["chunk_size"]:
+        raise Exception("Cannot compare checksums of different chunk sizes")
+
+    if expected["sha256"] == actual["sha256"]:
+        return []
+
+    mismatched = []
+
+    for index in range(max(len(expected["chunks"]), len(actual["chunks"]))):
+        if index >= len(expected["chunks"]) or \
+                index >= len(actual["chunks"]) or \
+                expected["chunks"][index] != actual["chunks"][index]:
+            mismatched += [index]
+
+    return mismatched
+
+
+def dumpChecksums(checksums):
+    """Return the checksums manifest of a backup, as JSON"""
+
+    return json.dumps({"version": 1, "files": checksums}, indent=1)
+
+
+def loadChecksums(data):
+    """Return the checksums of files from a checksums manifest"""
+
+    return json.loads(data)["files"]
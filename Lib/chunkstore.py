@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A content addressed chunk store. Images are split in fixed size chunks,
+which are identified by their sha256 and stored only once, even if they
+are shared by many backups or domains. A backup is a manifest listing the
+chunks of every image. The progress of a backup is saved in a checkpoint,
+so an interrupted backup could be resumed from its last stored chunks.
+Chunks are compressed by the compression engine of the domain: gzip chunks
+are zlib streams, while the other ones start with a header naming their
+engine, so a store could have chunks of many engines
+
+"""
+
+from __future__ import print_function
+
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import compression, sparse
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# default chunk size (in bytes)
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# where chunks are placed, relative to backupdir
+CHUNKS_DIR = "chunks"
+
+# manifest file extension
+MANIFEST_EXT = ".manifest.json.gz"
+
+# checkpoint file extension
+CHECKPOINT_EXT = ".checkpoint.json"
+
+# how often checkpoints are saved (seconds)
+CHECKPOINT_INTERVAL = 60
+
+# the header of chunks not compressed with zlib, followed by the engine
+# name and a newline
+CHUNK_MAGIC = b"KVMBCHNK"
+
+# gzip chunks are compressed at this level, unless compression_level is
+# defined
+GZIP_LEVEL = 6
+
+# engines decompressing chunks, by name
+decompressors = {}
+
+# the locks of chunk stores, by backupdir
+store_locks = {}
+store_locks_lock = threading.Lock()
+
+
+def getCompressor(parameters):
+    """Return the engine compressing chunks from domain parameters"""
+
+    if parameters.get("compression", "gzip") == "gzip" and \
+            parameters.get("compression_level") is None:
+        parameters = dict(parameters, compression_level=GZIP_LEVEL)
+
+    return compression.getCompressor(parameters)
+
+
+def getDecompressor(name):
+    """Return the engine decompressing the chunks of name"""
+
+    if name not in decompressors:
+        if name not in compression.COMPRESSORS:
+            raise IOError("Unknown chunk compression '%s'" % (name))
+
+        decompressors[name] = compression.COMPRESSORS[name]()
+
+    return decompressors[name]
+
+
+class StoreLock():
+    """Backups share a chunk store, while garbage collection needs it
+    alone: chunks reused or written by a backup must not be removed"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.backups = 0
+        self.collecting = False
+
+    @contextmanager
+    def use(self):
+        """Hold the store while a backup is writing in it"""
+
+        with self.condition:
+            while self.collecting:
+                self.condition.wait()
+
+            self.backups += 1
+
+        try:
+            yield
+
+        finally:
+            with self.condition:
+                self.backups -= 1
+                self.condition.notify_all()
+
+    def acquireCollect(self, blocking=True):
+        """Wait for backups to finish, and hold the store alone. Return
+        False if store is in use and blocking is False"""
+
+        with self.condition:
+            if not blocking and (self.backups or self.collecting):
+                return False
+
+            while self.backups or self.collecting:
+                self.condition.wait()
+
+            self.collecting = True
+
+            return True
+
+    def releaseCollect(self):
+        with self.condition:
+            self.collecting = False
+            self.condition.notify_all()
+
+
+def getLock(backupdir):
+    """Return the lock of the chunk store in backupdir"""
+
+    key = os.path.abspath(backupdir)
+
+    with store_locks_lock:
+        return store_locks.setdefault(key, StoreLock())
+
+
+class ChunkStore():
+    """A directory of compressed chunks named by their sha256"""
+
+    def __init__(self, backupdir, compressor=None, workers=4, throttle=None,
+                 fsync=False):
+        """Chunks are compressed by compressor (gzip if None) in
+        workers threads. If fsync is True, chunks are on disk once stored,
+        and could be referenced by checkpoints"""
+
+        self.path = os.path.join(backupdir, CHUNKS_DIR)
+        self.backupdir = backupdir
+        self.compressor = compressor or compression.GzipCompressor(
+            level=GZIP_LEVEL)
+        self.workers = workers
+        self.fsync = fsync
+
+        # limits image reads and chunk writes, if any
+        self.throttle = throttle
+
+        # statistics of the current session
+        self.lock = threading.Lock()
+        self.written = 0
+        self.reused = 0
+        self.bytes_read = 0
+
+        if not os.path.exists(self.path):
+            logger.info("Creating directory '%s'" % (self.path))
+
+            try:
+                os.makedirs(self.path)
+
+            except OSError:
+                # created by a concurrent backup
+                if not os.path.isdir(self.path):
+                    raise
+
+    def getChunkPath(self, digest):
+        """Return the path of a chunk"""
+
+        return os.path.join(self.path, digest[:2], digest)
+
+    def hasChunk(self, digest):
+        """Return True if chunk is already stored"""
+
+        return os.path.exists(self.getChunkPath(digest))
+
+    def putChunk(self, data):
+        """Hash data and store it if not already present. Return its
+        digest"""
+
+        digest = hashlib.sha256(data).hexdigest()
+
+        if self.hasChunk(digest):
+            with self.lock:
+                self.reused += 1
+
+            return digest
+
+        path = self.getChunkPath(digest)
+        dirname = os.path.dirname(path)
+
+        if not os.path.exists(dirname):
+            try:
+                os.mkdir(dirname)
+
+            except OSError:
+                # created by another thread
+                pass
+
+        # write in a temporary file, then move it in place: concurrent
+        # backups could write the same chunk
+        partial = "%s.%s.part" % (path, uuid.uuid4().hex)
+
+        with open(partial, "wb") as handle:
+            if self.throttle is not None:
+                handle = self.throttle.writer(handle)
+
+            handle.write(self.compressChunk(data))
+            handle.close()
+
+        if self.fsync:
+            fd = os.open(partial, os.O_RDONLY)
+
+            try:
+                os.fsync(fd)
+
+            finally:
+                os.close(fd)
+
+        os.rename(partial, path)
+
+        with self.lock:
+            self.written += 1
+
+        return digest
+
+    def compressChunk(self, data):
+        """Return the content of the chunk file of data"""
+
+        # chunks written before other engines were supported
+        if self.compressor.name == "gzip":
+            return zlib.compress(data, self.compressor.level)
+
+        return CHUNK_MAGIC + self.compressor.name.encode("utf-8") + \
+            b"\n" + self.compressor.compressFrame(data)
+
+    def getChunk(self, digest):
+        """Return the uncompressed data of a chunk"""
+
+        with open(self.getChunkPath(digest), "rb") as handle:
+            data = handle.read()
+
+        if not data.startswith(CHUNK_MAGIC):
+            return zlib.decompress(data)
+
+        name, data = data[len(CHUNK_MAGIC):].split(b"\n", 1)
+        decompressor = getDecompressor(name.decode("utf-8"))
+
+        try:
+            return decompressor.decompress(data)
+
+        except Exception as error:
+            raise IOError("Cannot decompress chunk %s with %s: %s" % (
+                digest, decompressor.name, error))
+
+    def __readChunks(self, source, chunk_size, is_sparse, start=0):
+        """Yield (offset, data) for every chunk of source with data, from
+        start offset"""
+
+        with open(source, "rb") as handle:
+            if self.throttle is not None:
+                handle = self.throttle.reader(handle)
+
+            size = os.fstat(handle.fileno()).st_size
+
+            if is_sparse:
+                extents = sparse.getExtents(handle, size)
+
+            else:
+                extents = [(0, size)]
+
+            # chunks are aligned to chunk size, in order to find the same
+            # chunks in different backups of the same image
+            offsets = set()
+
+            for offset, length in extents:
+                first = offset // chunk_size
+                last = (offset + length - 1) // chunk_size
+
+                offsets.update(range(first, last + 1))
+
+            for index in sorted(offsets):
+                if index * chunk_size < start:
+                    continue
+
+                handle.seek(index * chunk_size)
+                data = handle.read(chunk_size)
+                self.bytes_read += len(data)
+
+                yield index * chunk_size, data
+
+    def putFile(self, source, chunk_size=CHUNK_SIZE, is_sparse=True,
+                start=0, chunks=None, progress=None):
+        """Store every chunk of source. Chunks are hashed and compressed by
+        a pool of threads. Return a list of [offset, digest]. Holes and
+        chunks of zeros are not stored. A file could be resumed from start
+        offset, with the chunks stored before it. progress is called with
+        the offset to resume from and the chunks stored, every time a batch
+        of chunks is stored"""
+
+        chunks = list(chunks or [])
+        zeros = bytes(chunk_size)
+
+        def put(item):
+            offset, data = item
+
+            if data == zeros[:len(data)]:
+                return None
+
+            return [offset, self.putChunk(data)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # read a bunch of chunks at a time, in order to limit memory
+            batch = []
+
+            for item in self.__readChunks(
+                    source, chunk_size, is_sparse, start):
+                batch += [item]
+
+                if len(batch) >= self.workers * 2:
+                    chunks += [chunk for chunk in executor.map(put, batch)
+                               if chunk is not None]
+
+                    if progress is not None:
+                        progress(batch[-1][0] + chunk_size, chunks)
+
+                    batch = []
+
+            chunks += [chunk for chunk in executor.map(put, batch)
+                       if chunk is not None]
+
+        return chunks
+
+    def restoreFile(self, disk, dest):
+        """Write an image described in a manifest to dest. Chunks are read
+        and decompressed by a pool of threads"""
+
+        with open(dest, "wb") as handle:
+            fd = handle.fileno()
+
+            def write(chunk):
+                offset, digest = chunk
+                os.pwrite(fd, self.getChunk(digest), offset)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # raise the first error, if any
+                list(executor.map(write, disk["chunks"]))
+
+            # the file could end with a hole
+            handle.truncate(disk["size"])
+
+        os.utime(dest, (disk["mtime"], disk["mtime"]))
+        os.chmod(dest, disk["mode"])
+
+    def getManifests(self):
+        """Return the paths of all manifests (rotated too) of this store"""
+
+        pattern = os.path.join(self.backupdir, "*", "*" + MANIFEST_EXT + "*")
+
+        return [path for path in glob.glob(pattern)
+                if not path.endswith(".part")]
+
+    def collect(self, blocking=True):
+        """Remove chunks not referenced by any manifest or checkpoint, once
+        backups writing in store are terminated. If blocking is False,
+        store is not cleaned while it is in use. Return the number of
+        chunks removed, or None if store was not cleaned"""
+
+        lock = getLock(self.backupdir)
+
+        if not lock.acquireCollect(blocking):
+            logger.info("'%s' is in use: not cleaned" % (self.path))
+            return None
+
+        try:
+            return self.__collect()
+
+        finally:
+            lock.releaseCollect()
+
+    def __collect(self):
+        referenced = set()
+
+        for path in self.getManifests():
+            manifest = readManifest(path)
+
+            for disk in manifest["disks"]:
+                referenced.update(
+                    [digest for offset, digest in disk["chunks"]])
+
+        # chunks of interrupted backups will be used when resuming them
+        for path in glob.glob(os.path.join(
+                self.backupdir, "*", "*" + CHECKPOINT_EXT)):
+            referenced.update(Checkpoint(path).getDigests())
+
+        removed = 0
+
+        for path in glob.glob(os.path.join(self.path, "*", "*")):
+            # chunks being written by a backup
+            if path.endswith(".part"):
+                continue
+
+            if os.path.basename(path) not in referenced:
+                logger.debug("Removing unreferenced chunk %s" % (path))
+                os.remove(path)
+                removed += 1
+
+        logger.info("%s chunks removed from '%s', %s in use" % (
+            removed, self.path, len(referenced)))
+
+        return removed
+
+
+class Checkpoint():
+    """The progress of a backup in a chunk store: the snapshot used, the
+    manifest of the images completed, and the chunks stored of the current
+    image. It is saved periodically, and removed once backup is completed"""
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        """Read a checkpoint from path, if any"""
+
+        self.path = path
+        self.interval = interval
+        self.last = time.time()
+        self.state = None
+
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.state = json.load(handle)
+
+    def start(self, snapshot_name, manifest_name, manifest):
+        """Start tracking a new backup"""
+
+        self.state = {
+            "snapshot": snapshot_name,
+            "manifest_name": manifest_name,
+            "manifest": manifest,
+            "current": None}
+
+        self.save()
+
+    def getDisks(self):
+        """Return the disks already completed"""
+
+        if self.state is None:
+            return []
+
+        return [disk["dev"] for disk in self.state["manifest"]["disks"]]
+
+    def getCurrent(self, dev):
+        """Return the offset to resume disk from and its chunks stored"""
+
+        current = self.state["current"]
+
+        if current is None or current["dev"] != dev:
+            return 0, []
+
+        return current["offset"], current["chunks"]
+
+    def getDigests(self):
+        """Return the chunks referenced by this checkpoint"""
+
+        if self.state is None:
+            return set()
+
+        digests = set()
+
+        for disk in self.state["manifest"]["disks"]:
+            digests.update([digest for offset, digest in disk["chunks"]])
+
+        if self.state["current"] is not None:
+            digests.update([
+                digest for offset, digest in self.state["current"]["chunks"]])
+
+        return digests
+
+    def update(self, dev, offset, chunks):
+        """Track the chunks stored of disk, and save them if needed"""
+
+        self.state["current"] = {
+            "dev": dev,
+            "offset": offset,
+            "chunks": chunks}
+
+        if time.time() - self.last >= self.interval:
+            self.save()
+
+    def addDisk(self, disk):
+        """Add a completed disk to manifest, and save the checkpoint"""
+
+        self.state["manifest"]["disks"] += [disk]
+        self.state["current"] = None
+
+        self.save()
+
+    def save(self):
+        """Write checkpoint on disk, replacing the previous one"""
+
+        partial = self.path + ".part"
+
+        with open(partial, "w") as handle:
+            json.dump(self.state, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        os.rename(partial, self.path)
+        self.last = time.time()
+
+        logger.debug("Checkpoint saved in '%s'" % (self.path))
+
+    def remove(self):
+        """Forget the backup tracked"""
+
+        self.state = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def writeManifest(manifest, path):
+    """Write a compressed manifest in path"""
+
+    partial = path + ".part"
+
+    with gzip.open(partial, "wt") as handle:
+        json.dump(manifest, handle, indent=1)
+
+    os.rename(partial, path)
+
+
+def readManifest(path):
+    """Read a manifest from path"""
+
+    with gzip.open(path, "rt") as handle:
+        return json.load(handle)
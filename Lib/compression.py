@@ -0,0 +1,727 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to deal with compression engines. Every engine could compress in
+process, when the python module is installed, or by using its command line
+tool. Level could be auto tuned by sampling images
+
+"""
+
+from __future__ import print_function
+
+import gzip
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from . import helper, sparse
+
+# optional compression modules
+try:
+    import zstandard
+
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+
+except ImportError:
+    lz4frame = None
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the size of blocks used to sample images
+SAMPLE_SIZE = 4 * 1024 * 1024
+
+# how many blocks are sampled
+SAMPLE_BLOCKS = 8
+
+
+def discard(handle):
+    """Close a destination file after an error. Storage writers discard
+    what was written"""
+
+    if hasattr(handle, "abort"):
+        handle.abort()
+
+    else:
+        handle.close()
+
+
+class ProcessWriter():
+    """Write data to a compression process, which writes in a file"""
+
+    def __init__(self, cmds, path, throttle=None, handle=None):
+        self.cmds = cmds
+        self.path = path
+        self.pump = None
+
+        logger.debug("Executing: %s > %s" % (" ".join(cmds), path))
+
+        # a storage writer could be provided instead of a path
+        self.dest_fh = handle if handle is not None else open(path, "wb")
+        self.output = self.dest_fh
+
+        if throttle is not None:
+            self.output = throttle.writer(self.dest_fh)
+
+        # Launch command. Compressed data goes directly in destination file,
+        # unless writes are limited, bypass page cache or aren't local
+        if self.output is self.dest_fh and hasattr(self.dest_fh, "fileno"):
+            stdout = self.dest_fh
+
+        else:
+            stdout = subprocess.PIPE
+
+        self.process = subprocess.Popen(
+            cmds,
+            stdin=subprocess.PIPE,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+            preexec_fn=helper.preexec_fn,
+            shell=False)
+
+        if stdout is subprocess.PIPE:
+            self.pump = threading.Thread(target=self.__pump)
+            self.pump.daemon = True
+            self.pump.start()
+
+    def __pump(self):
+        """Copy compressed data to the destination file"""
+
+        try:
+            shutil.copyfileobj(self.process.stdout, self.output, SAMPLE_SIZE)
+
+        except Exception as error:
+            logger.error("Cannot write '%s': %s" % (self.path, error))
+
+            # compression process will fail writing its output
+            self.process.stdout.close()
+
+    def write(self, data):
+        return self.process.stdin.write(data)
+
+    def close(self):
+        """Wait for compression process to finish"""
+
+        self.process.stdin.close()
+
+        # Lancio il comando e aspetto che termini
+        status = self.process.wait()
+
+        if self.pump is not None:
+            self.pump.join()
+
+        self.output.close()
+        self.dest_fh.close()
+
+        if status != 0:
+            logger.error("Error for %s:%s" % (
+                self.cmds, self.process.stderr.read()))
+            logger.critical("{exe} returned {stato} state".format(
+                stato=status, exe=self.cmds[0]))
+            raise Exception("%s didn't work properly" % (self.cmds[0]))
+
+    def abort(self):
+        """Kill compression process"""
+
+        self.process.kill()
+
+        try:
+            self.process.stdin.close()
+
+        except (IOError, OSError):
+            pass
+
+        self.process.wait()
+
+        if self.pump is not None:
+            self.pump.join()
+
+        discard(self.dest_fh)
+
+
+class FileWriter():
+    """Write data to a compressed file object, in process"""
+
+    def __init__(self, opener, path, throttle=None, handle=None):
+        self.path = path
+
+        # a storage writer could be provided instead of a path
+        self.dest_fh = handle if handle is not None else open(path, "wb")
+        self.output = self.dest_fh
+
+        if throttle is not None:
+            self.output = throttle.writer(self.dest_fh)
+
+        self.handle = opener(self.output)
+
+    def write(self, data):
+        return self.handle.write(data)
+
+    def close(self):
+        self.handle.close()
+        self.output.close()
+        self.dest_fh.close()
+
+    def abort(self):
+        try:
+            self.handle.close()
+
+        except Exception:
+            pass
+
+        discard(self.dest_fh)
+
+
+class ProcessReader():
+    """Read data decompressed by a process reading a file"""
+
+    def __init__(self, cmds, path, handle=None):
+        self.cmds = cmds
+        self.path = path
+        self.feeder = None
+
+        logger.debug("Executing: %s < %s" % (" ".join(cmds), path))
+
+        # a storage reader could be provided instead of a path
+        self.source_fh = handle if handle is not None else open(path, "rb")
+
+        # compressed data is read directly from a local file
+        if hasattr(self.source_fh, "fileno"):
+            stdin = self.source_fh
+
+        else:
+            stdin = subprocess.PIPE
+
+        # decompression runs in its own process, while data is written
+        self.process = subprocess.Popen(
+            cmds,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=helper.preexec_fn,
+            shell=False)
+
+        if stdin is subprocess.PIPE:
+            self.feeder = threading.Thread(target=self.__feed)
+            self.feeder.daemon = True
+            self.feeder.start()
+
+    def __feed(self):
+        """Copy compressed data to the decompression process"""
+
+        try:
+            shutil.copyfileobj(
+                self.source_fh, self.process.stdin, SAMPLE_SIZE)
+
+        except Exception as error:
+            logger.error("Cannot read '%s': %s" % (self.path, error))
+
+        finally:
+            # decompression process fails on a truncated input
+            try:
+                self.process.stdin.close()
+
+            except (IOError, OSError):
+                pass
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        """Wait for decompression process to finish"""
+
+        self.process.stdout.close()
+        status = self.process.wait()
+
+        if self.feeder is not None:
+            self.feeder.join()
+
+        self.source_fh.close()
+
+        if status != 0:
+            logger.error("Error for %s:%s" % (
+                self.cmds, self.process.stderr.read()))
+            raise Exception("%s didn't work properly" % (self.cmds[0]))
+
+
+class FileReader():
+    """Read data from a compressed file object, in process"""
+
+    def __init__(self, opener, path, handle=None):
+        self.path = path
+
+        # a storage reader could be provided instead of a path
+        self.source_fh = handle if handle is not None else open(path, "rb")
+        self.handle = opener(self.source_fh)
+
+    def read(self, size=-1):
+        return self.handle.read(size)
+
+    def close(self):
+        self.handle.close()
+        self.source_fh.close()
+
+
+class Compressor():
+    """Base class of compression engines"""
+
+    # engine name in configuration file
+    name = None
+
+    # archive extension
+    extension = None
+
+    # default compression level
+    default_level = None
+
+    # levels tested when auto tuning
+    levels = []
+
+    # command line tool
+    executable = None
+
+    def __init__(self, level=None, threads=None):
+        # level will be set by autoTune
+        self.auto = level == "auto"
+
+        if level is None or self.auto:
+            level = self.default_level
+
+        if threads is None:
+            threads = helper.getProcesses()
+
+        self.level = level
+        self.threads = threads
+
+    def __str__(self):
+        return "%s (level %s, %s threads)" % (
+            self.name, self.level, self.threads)
+
+    def hasModule(self):
+        """Return True if engine could compress in process"""
+
+        return False
+
+    def getCommand(self):
+        """Return the command to compress stdin to stdout"""
+
+        raise NotImplementedError
+
+    def getDecompressCommand(self):
+        """Return the command to decompress stdin to stdout"""
+
+        raise NotImplementedError
+
+    def getOpener(self):
+        """Return a function which wraps a file object in a compressed file
+        object"""
+
+        raise NotImplementedError
+
+    def getReadOpener(self):
+        """Return a function which wraps a compressed file object in a file
+        object returning decompressed data"""
+
+        raise NotImplementedError
+
+    def __pipe(self, cmds, data):
+        """Pass data through a command, and return its output"""
+
+        process = subprocess.Popen(
+            cmds,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=helper.preexec_fn,
+            shell=False)
+
+        output, error = process.communicate(data)
+
+        if process.returncode != 0:
+            raise Exception("%s didn't work properly: %s" % (
+                self.executable, error))
+
+        return output
+
+    def compress(self, data):
+        """Compress data with current level, and return compressed data"""
+
+        if self.hasModule():
+            return self.compressData(data)
+
+        return self.__pipe(self.getCommand(), data)
+
+    def compressFrame(self, data):
+        """Compress data as an independent frame. Many frames are compressed
+        at the same time by different threads"""
+
+        return self.compress(data)
+
+    def decompress(self, data):
+        """Decompress a compressed frame"""
+
+        if self.hasModule():
+            return self.decompressData(data)
+
+        return self.__pipe(self.getDecompressCommand(), data)
+
+    def compressData(self, data):
+        """Compress data in process"""
+
+        raise NotImplementedError
+
+    def decompressData(self, data):
+        """Decompress data in process"""
+
+        raise NotImplementedError
+
+    def open(self, path, throttle=None, handle=None):
+        """Return a writer object which compress data into path, or into
+        handle (a storage writer) if provided. Writes are limited by
+        throttle, if any"""
+
+        if self.hasModule():
+            return FileWriter(self.getOpener(), path, throttle, handle)
+
+        if shutil.which(self.executable) is None:
+            raise RuntimeError(
+                "Neither python module nor '%s' are available for %s "
+                "compression" % (self.executable, self.name))
+
+        return ProcessWriter(self.getCommand(), path, throttle, handle)
+
+    def openReader(self, path, handle=None):
+        """Return a reader object which decompress data from path, or from
+        handle (a storage reader) if provided"""
+
+        if self.hasModule():
+            return FileReader(self.getReadOpener(), path, handle)
+
+        if shutil.which(self.executable) is None:
+            raise RuntimeError(
+                "Neither python module nor '%s' are available for %s "
+                "decompression" % (self.executable, self.name))
+
+        return ProcessReader(self.getDecompressCommand(), path, handle)
+
+    def compressFile(self, source, remove=True, throttle=None):
+        """Compress source file in source + extension. Return the path of
+        compressed file"""
+
+        target = source + self.extension
+
+        logger.info("Compressing '%s' with %s" % (source, self))
+        writer = self.open(target, throttle)
+
+        try:
+            with open(source, "rb") as handle:
+                shutil.copyfileobj(handle, writer, SAMPLE_SIZE)
+
+            writer.close()
+
+        except Exception:
+            writer.abort()
+            raise
+
+        if remove:
+            os.remove(source)
+
+        return target
+
+    def autoTune(self, sources, max_rate=None):
+        """Sample blocks from the allocated extents of source images, and
+        select the highest level which compress faster than images could be
+        read. Reads are not faster than max_rate (bytes per second), if
+        any"""
+
+        samples = []
+        read_time = 0.0
+
+        for source in sources:
+            with open(source, "rb") as handle:
+                # holes are not read and compress too well
+                extents = sparse.getExtents(handle)
+                allocated = sum([length for offset, length in extents])
+
+                if allocated == 0:
+                    continue
+
+                step = max(SAMPLE_SIZE, allocated // SAMPLE_BLOCKS)
+
+                # samples are spread over allocated bytes
+                position = 0
+
+                for offset, length in extents:
+                    start = -position % step
+
+                    for delta in range(start, length, step):
+                        begin = time.time()
+                        handle.seek(offset + delta)
+                        samples += [handle.read(min(
+                            SAMPLE_SIZE, length - delta))]
+                        read_time += time.time() - begin
+
+                        if len(samples) >= SAMPLE_BLOCKS:
+                            break
+
+                    position += length
+
+                    if len(samples) >= SAMPLE_BLOCKS:
+                        break
+
+            if len(samples) >= SAMPLE_BLOCKS:
+                break
+
+        sample_size = sum([len(sample) for sample in samples])
+
+        if sample_size == 0 or not self.levels:
+            logger.warning("Cannot auto tune %s compression" % (self.name))
+            self.level = self.default_level
+            return self.level
+
+        read_speed = sample_size / max(read_time, 1e-6)
+
+        # images are not read faster than throttle
+        if max_rate is not None:
+            read_speed = min(read_speed, max_rate)
+
+        logger.debug("%s: read throughput %.1f MB/s" % (
+            self.name, read_speed / 1024 ** 2))
+
+        # the fastest level is used if no level keeps up with reads
+        selected = self.levels[0]
+
+        data = b"".join(samples)
+
+        for level in self.levels:
+            self.level = level
+            start = time.time()
+
+            # compress with the same threads used for archives
+            self.compress(data)
+
+            speed = sample_size / max(time.time() - start, 1e-6)
+
+            logger.debug("%s level %s: %.1f MB/s" % (
+                self.name, level, speed / 1024 ** 2))
+
+            if speed < read_speed:
+                break
+
+            selected = level
+
+        self.level = selected
+
+        logger.info("Selected %s compression level %s" % (
+            self.name, self.level))
+
+        return self.level
+
+
+class GzipCompressor(Compressor):
+    """gzip compression with pigz, or with python gzip if pigz is not
+    installed"""
+
+    name = "gzip"
+    extension = ".gz"
+    default_level = 9
+    levels = [1, 3, 6, 9]
+    executable = "pigz"
+
+    def hasModule(self):
+        # pigz is faster than python gzip, since it uses many threads
+        return shutil.which(self.executable) is None
+
+    def getCommand(self):
+        return [self.executable, "-%s" % (self.level), "--processes",
+                str(self.threads), "-c"]
+
+    def getDecompressCommand(self):
+        return [self.executable, "-d", "-c"]
+
+    def getOpener(self):
+        return lambda fileobj: gzip.GzipFile(
+            fileobj=fileobj, mode="wb", compresslevel=self.level)
+
+    def getReadOpener(self):
+        return lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+    def compressFrame(self, data):
+        # zlib releases the GIL: frames are compressed in parallel by
+        # threads, without pigz
+        return self.compressData(data)
+
+    def decompress(self, data):
+        return self.decompressData(data)
+
+    def compressData(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompressData(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+    """Multithreaded zstd compression"""
+
+    name = "zstd"
+    extension = ".zst"
+    default_level = 3
+    levels = [1, 3, 6, 9, 12, 15, 19]
+    executable = "zstd"
+
+    def hasModule(self):
+        return zstandard is not None
+
+    def getCommand(self):
+        return [self.executable, "-%s" % (self.level),
+                "-T%s" % (self.threads), "-q", "-c"]
+
+    def getCompressor(self):
+        return zstandard.ZstdCompressor(
+            level=self.level, threads=self.threads)
+
+    def getDecompressCommand(self):
+        return [self.executable, "-d", "-q", "-c"]
+
+    def getOpener(self):
+        return lambda fileobj: self.getCompressor().stream_writer(fileobj)
+
+    def getReadOpener(self):
+        return lambda fileobj: zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True)
+
+    def compressFrame(self, data):
+        if not self.hasModule():
+            return self.compress(data)
+
+        # a single thread for each frame, since frames are compressed in
+        # parallel
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def compressData(self, data):
+        return self.getCompressor().compress(data)
+
+    def decompressData(self, data):
+        # frames written by zstd command line don't store content size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    """lz4 compression: fast, with a lower compression ratio"""
+
+    name = "lz4"
+    extension = ".lz4"
+    default_level = 1
+    levels = [1, 3, 6, 9]
+    executable = "lz4"
+
+    def hasModule(self):
+        return lz4frame is not None
+
+    def getCommand(self):
+        return [self.executable, "-%s" % (self.level), "-q", "-c"]
+
+    def getDecompressCommand(self):
+        return [self.executable, "-d", "-q", "-c"]
+
+    def getOpener(self):
+        return lambda fileobj: lz4frame.LZ4FrameFile(
+            fileobj, mode="wb", compression_level=self.level)
+
+    def getReadOpener(self):
+        return lambda fileobj: lz4frame.LZ4FrameFile(fileobj, mode="rb")
+
+    def compressData(self, data):
+        return lz4frame.compress(data, compression_level=self.level)
+
+    def decompressData(self, data):
+        return lz4frame.decompress(data)
+
+
+class NoneCompressor(Compressor):
+    """Don't compress data"""
+
+    name = "none"
+    extension = ""
+
+    def hasModule(self):
+        return True
+
+    def getOpener(self):
+        return lambda fileobj: fileobj
+
+    def getReadOpener(self):
+        return lambda fileobj: fileobj
+
+    def compressData(self, data):
+        return data
+
+    def decompressData(self, data):
+        return data
+
+    def compressFile(self, source, remove=True, throttle=None):
+        return source
+
+    def autoTune(self, sources, max_rate=None):
+        return self.level
+
+
+# all the supported engines
+COMPRESSORS = dict([(compressor.name, compressor) for compressor in [
+    GzipCompressor, ZstdCompressor, Lz4Compressor, NoneCompressor]])
+
+
+def getCompressorByPath(path):
+    """Return the compressor of an archive from its extension. Rotated
+    archives end with their generation number"""
+
+    name = re.sub(r"\.[0-9]+$", "", path)
+
+    # longest extension first: "" matches every file
+    for compressor in sorted(
+            COMPRESSORS.values(), key=lambda item: len(item.extension),
+            reverse=True):
+        if name.endswith(".tar" + compressor.extension):
+            return compressor()
+
+    raise RuntimeError("Unknown archive type for '%s'" % (path))
+
+
+def getCompressor(parameters):
+    """Return a compressor instance from domain parameters"""
+
+    name = parameters.get("compression", "gzip")
+
+    if name not in COMPRESSORS:
+        raise RuntimeError("Unknown compression '%s'" % (name))
+
+    return COMPRESSORS[name](
+        level=parameters.get("compression_level"),
+        threads=parameters.get("compression_threads"))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to deal with libvirt connections. Connections are opened when
+needed, shared between threads and reopened when they die. Domain handles
+and domain XMLs are cached, and need to be invalidated when domain changes
+(after a snapshot or a pivot)
+
+"""
+
+from __future__ import print_function
+
+import logging
+import threading
+
+# To inspect xml
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the default hypervisor
+URI = "qemu:///system"
+
+
+class ConnectionManager():
+    """A lazy libvirt connection, with cached domains and XMLs"""
+
+    # An event loop implementation is required to receive block job
+    # events, and it must be registered before opening connections
+    event_impl = False
+
+    def __init__(self, uri=URI):
+        self.uri = uri
+        self.conn = None
+        self.lock = threading.RLock()
+
+        # cached domain handles and xml by domain name
+        self.domains = {}
+        self.xmls = {}
+
+    def getConnection(self):
+        """Return an alive connection, opening it if necessary"""
+
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    if self.conn.isAlive():
+                        return self.conn
+
+                except libvirt.libvirtError as error:
+                    logger.debug("Connection check failed: %s" % (error))
+
+                logger.warning("Connection to '%s' lost: reconnecting" % (
+                    self.uri))
+
+                # handles belong to the old connection
+                self.invalidate()
+
+            if not ConnectionManager.event_impl:
+                libvirt.virEventRegisterDefaultImpl()
+                ConnectionManager.event_impl = True
+
+            logger.debug("Opening connection to '%s'" % (self.uri))
+            self.conn = libvirt.open(self.uri)
+
+            return self.conn
+
+    def listAllDomains(self):
+        """Return all domains"""
+
+        return self.getConnection().listAllDomains()
+
+    def lookupByName(self, domain_name):
+        """Return a cached domain handle"""
+
+        # check connection first: handles are dropped when reconnecting
+        conn = self.getConnection()
+
+        with self.lock:
+            if domain_name not in self.domains:
+                self.domains[domain_name] = conn.lookupByName(domain_name)
+
+            return self.domains[domain_name]
+
+    def getXMLDesc(self, domain_name, flags=0):
+        """Return the cached XML of a domain"""
+
+        with self.lock:
+            key = (domain_name, flags)
+
+            if key not in self.xmls:
+                domain = self.lookupByName(domain_name)
+                xml = domain.XMLDesc(flags=flags)
+
+                # keep both text and parsed document
+                self.xmls[key] = (xml, ET.fromstring(xml))
+
+            return self.xmls[key][0]
+
+    def getXML(self, domain_name, flags=0):
+        """Return the cached and parsed XML of a domain"""
+
+        with self.lock:
+            self.getXMLDesc(domain_name, flags)
+            return self.xmls[(domain_name, flags)][1]
+
+    def invalidate(self, domain_name=None):
+        """Forget the handle and the XMLs of domain_name (or of every
+        domain): a domain defined again has a new handle"""
+
+        with self.lock:
+            if domain_name is None:
+                self.domains.clear()
+
+            else:
+                self.domains.pop(domain_name, None)
+
+            for key in list(self.xmls.keys()):
+                if domain_name is None or key[0] == domain_name:
+                    del self.xmls[key]
+
+
+# A pool of connections, by uri
+managers = {}
+managers_lock = threading.Lock()
+
+
+def getManager(uri=URI):
+    """Return the connection manager of uri"""
+
+    with managers_lock:
+        if uri not in managers:
+            managers[uri] = ConnectionManager(uri)
+
+        return managers[uri]
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to parse cron like schedules ("minute hour day month weekday",
+like "30 1 * * Mon-Fri") and backup windows ("22:00-06:00"), and to find
+when they occur
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import logging
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# fields of a schedule, with their ranges
+FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7)]
+
+# names could be used for months and weekdays (Sunday is 0 and 7)
+NAMES = {
+    "month": ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep",
+              "oct", "nov", "dec"],
+    "weekday": ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]}
+
+# how many days are searched for the next occurrence
+MAX_DAYS = 5 * 366
+
+
+def parseValue(value, field):
+    """Return the number of a value, which could be a name"""
+
+    if field in NAMES and value.lower()[:3] in NAMES[field]:
+        number = NAMES[field].index(value.lower()[:3])
+
+        # months start from 1
+        return number + 1 if field == "month" else number
+
+    return int(value)
+
+
+def parseField(text, field, low, high):
+    """Return the set of values of a field, like '*', '1-5', '*/15' or
+    'Mon,Wed'"""
+
+    values = set()
+
+    for item in text.split(","):
+        step = 1
+
+        if "/" in item:
+            item, step = item.split("/")
+            step = int(step)
+
+        if item == "*":
+            start, end = low, high
+
+        elif "-" in item:
+            start, end = [parseValue(value, field)
+                          for value in item.split("-")]
+
+        else:
+            start = end = parseValue(item, field)
+
+        if start < low or end > high or start > end or step < 1:
+            raise RuntimeError(
+                "Invalid %s '%s' in schedule" % (field, text))
+
+        values.update(range(start, end + 1, step))
+
+    # Sunday is both 0 and 7
+    if field == "weekday" and 7 in values:
+        values.discard(7)
+        values.add(0)
+
+    return values
+
+
+class Cron():
+    """A cron like schedule"""
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+
+        if len(fields) != len(FIELDS):
+            raise RuntimeError(
+                "Schedule '%s' needs %s fields" % (expression, len(FIELDS)))
+
+        for text, (field, low, high) in zip(fields, FIELDS):
+            setattr(self, field, parseField(text, field, low, high))
+
+        # like cron, if both day and weekday are restricted, a day matching
+        # one of them is a match
+        self.any_day = fields[2] != "*" and fields[4] != "*"
+
+    def __repr__(self):
+        return "<Cron '%s'>" % (self.expression)
+
+    def matchDay(self, date):
+        """Return True if a day is scheduled"""
+
+        if date.month not in self.month:
+            return False
+
+        # isoweekday: Monday is 1, Sunday is 7
+        in_day = date.day in self.day
+        in_weekday = date.isoweekday() % 7 in self.weekday
+
+        if self.any_day:
+            return in_day or in_weekday
+
+        return in_day and in_weekday
+
+    def match(self, date):
+        """Return True if date (a datetime) is scheduled"""
+
+        return self.matchDay(date) and date.hour in self.hour and \
+            date.minute in self.minute
+
+    def getNext(self, after):
+        """Return the first scheduled minute after a datetime"""
+
+        start = after.replace(second=0, microsecond=0) + \
+            datetime.timedelta(minutes=1)
+
+        day = start.replace(hour=0, minute=0)
+
+        for i in range(MAX_DAYS):
+            if self.matchDay(day):
+                for hour in sorted(self.hour):
+                    for minute in sorted(self.minute):
+                        date = day.replace(hour=hour, minute=minute)
+
+                        if date >= start:
+                            return date
+
+            day += datetime.timedelta(days=1)
+
+        raise RuntimeError("Schedule '%s' never occurs" % (self.expression))
+
+
+def fromDays(days, time="02:00"):
+    """Return the schedule of a list of week days (like day_of_week) at
+    time"""
+
+    hour, minute = [int(value) for value in time.split(":")]
+
+    return Cron("%s %s * * %s" % (minute, hour, ",".join(days)))
+
+
+def parseTime(text):
+    """Return the minutes of a day from 'HH:MM'"""
+
+    hour, minute = [int(value) for value in text.split(":")]
+
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        raise RuntimeError("Invalid time '%s'" % (text))
+
+    return hour * 60 + minute
+
+
+class Window():
+    """A daily backup window, like '22:00-06:00'. A window ending before
+    its start ends the day after"""
+
+    def __init__(self, text):
+        self.text = text
+        start, end = text.split("-")
+
+        self.start = parseTime(start)
+        self.end = parseTime(end)
+
+        self.length = (self.end - self.start) % (24 * 60)
+
+        if self.length == 0:
+            self.length = 24 * 60
+
+    def __repr__(self):
+        return "<Window '%s'>" % (self.text)
+
+    def getWindow(self, date):
+        """Return (start, end) datetimes of the window including date, or
+        of the next one"""
+
+        day = date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # the window started the day before could still be open
+        for offset in [-1, 0, 1]:
+            start = day + datetime.timedelta(
+                days=offset, minutes=self.start)
+            end = start + datetime.timedelta(minutes=self.length)
+
+            if date < end:
+                return start, end
+
+    def isOpen(self, date):
+        """Return True if date is inside a window"""
+
+        start, end = self.getWindow(date)
+
+        return start <= date < end
@@ -0,0 +1,673 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to run kvmBackup as a daemon. Configuration is read once (and again
+when reloaded), the libvirt connection is kept open, and every domain is
+backed up following its cron like 'schedule'. Jobs start only inside their
+backup 'window', and are cancelled if they are still running when it closes:
+the durations of past backups, saved in a state file, are used to start long
+jobs early enough to finish inside the window. A unix socket accepts
+commands to trigger, pause, resume and cancel jobs
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from . import chunkstore, connection, cron, metrics, preflight, scheduler, \
+    throttle
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# where durations and results of backups are saved
+STATE_FILE = "/var/lib/kvmBackup/state.json"
+
+# where commands are received
+CONTROL_SOCKET = "/var/run/kvmBackup.sock"
+
+# when domains with a 'day_of_week' and without a 'schedule' are backed up
+SCHEDULE_TIME = "02:00"
+
+# how often scheduled jobs are checked (seconds)
+TICK = 10
+
+# how many durations are kept for every domain
+DURATIONS = 5
+
+# a backup is expected to last as the longest duration kept, times this
+MARGIN = 1.2
+
+# the commands accepted by the control socket
+COMMANDS = ["status", "trigger", "pause", "resume", "cancel", "reload",
+            "stop"]
+
+
+class State():
+    """Durations and results of past backups, saved in a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.domains = {}
+
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.domains = json.load(handle).get("domains", {})
+
+    def getEstimate(self, domain_name):
+        """Return how long the backup of a domain is expected to last, as a
+        timedelta"""
+
+        with self.lock:
+            durations = self.domains.get(domain_name, {}).get(
+                "durations", [])
+
+        if not durations:
+            return datetime.timedelta(0)
+
+        return datetime.timedelta(seconds=max(durations) * MARGIN)
+
+    def addResult(self, domain_name, start, seconds, status):
+        """Record the result of a backup. Durations of completed backups
+        only are used for estimates"""
+
+        with self.lock:
+            item = self.domains.setdefault(domain_name, {"durations": []})
+            item["last_start"] = start
+            item["last_seconds"] = seconds
+            item["last_status"] = status
+
+            if status == "done":
+                item["durations"] = (item["durations"] + [seconds])[
+                    -DURATIONS:]
+
+            self.save()
+
+    def save(self):
+        """Write state on disk, replacing the previous one. Need to be
+        called with lock acquired"""
+
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        partial = self.path + ".part"
+
+        with open(partial, "w") as handle:
+            json.dump({"domains": self.domains}, handle, indent=1)
+
+        os.rename(partial, self.path)
+
+
+def getSchedule(parameters):
+    """Return the schedule of a domain, from its 'schedule' or from its
+    'day_of_week' at 'schedule_time'"""
+
+    if parameters.get("schedule"):
+        return cron.Cron(parameters["schedule"])
+
+    if not parameters.get("day_of_week"):
+        raise RuntimeError("Need a 'schedule' or a 'day_of_week'")
+
+    return cron.fromDays(
+        parameters["day_of_week"],
+        parameters.get("schedule_time", SCHEDULE_TIME))
+
+
+class DomainJob(scheduler.Job):
+    """The scheduled backup of a domain"""
+
+    def __init__(self, domain_name, parameters, backupdir):
+        scheduler.Job.__init__(self, domain_name, parameters, backupdir)
+
+        self.schedule = getSchedule(parameters)
+        self.window = None
+
+        if parameters.get("window"):
+            self.window = cron.Window(parameters["window"])
+
+        # scheduled, queued, running, paused
+        self.status = "scheduled"
+
+        # the scheduled time of next backup, and when it should start
+        self.occurrence = None
+        self.start_at = None
+
+        # when running backup started, and if it was triggered by a command
+        self.started = None
+        self.manual = False
+
+    def plan(self, after, estimate):
+        """Schedule the first occurrence after a datetime. Inside a window,
+        a job expected to last more than the time left starts earlier"""
+
+        self.occurrence = self.schedule.getNext(after)
+        self.start_at = self.occurrence
+        self.deadline = None
+        self.status = "scheduled"
+        self.manual = False
+
+        if self.window is None:
+            return
+
+        start, end = self.window.getWindow(self.occurrence)
+
+        self.start_at = max(
+            start, min(max(self.occurrence, start), end - estimate))
+        self.deadline = end
+
+        if end - start < estimate:
+            logger.warning(
+                "Backup of '%s' is expected to last %s: longer than window "
+                "'%s'" % (self.domain_name, estimate, self.window.text))
+
+    def toDict(self):
+        def isoformat(date):
+            return date.isoformat() if date is not None else None
+
+        return {
+            "domain": self.domain_name,
+            "status": self.status,
+            "occurrence": isoformat(self.occurrence),
+            "start_at": isoformat(self.start_at),
+            "deadline": isoformat(self.deadline),
+            "started": isoformat(self.started),
+            "manual": self.manual}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Read a command line, and reply with a JSON line"""
+
+    def handle(self):
+        line = self.rfile.readline().decode("utf-8").strip()
+        reply = self.server.controller.command(line)
+
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon():
+    """Backup domains following their schedules, until stopped"""
+
+    def __init__(self, function, load, state_file=STATE_FILE,
+                 socket_path=CONTROL_SOCKET, workers=1, target_workers=None,
+                 preflight_workers=preflight.WORKERS):
+        """function(domain_name, parameters, backupdir) does a backup.
+        load() returns the parameters of domains by name, the backupdir and
+        the host options"""
+
+        self.function = function
+        self.load = load
+        self.state = State(state_file)
+        self.socket_path = socket_path
+        self.preflight_workers = preflight_workers
+
+        self.scheduler = scheduler.Scheduler(
+            self.__backup, workers=workers, target_workers=target_workers,
+            callback=self.finished)
+
+        # scheduled jobs, and jobs queued or running, by domain name
+        self.jobs = {}
+        self.busy = {}
+        self.host_conf = {}
+
+        self.lock = threading.RLock()
+        self.event = threading.Event()
+        self.stopping = False
+        self.server = None
+
+    def reload(self):
+        """Read configuration, and schedule domains again. Jobs queued or
+        running are not changed"""
+
+        mydomains, backupdir, host_conf = self.load()
+
+        # running backups follow the new shared limits
+        throttle.configure(host_conf)
+        domains = [domain.name() for domain in
+                   connection.getManager().listAllDomains()]
+
+        jobs = {}
+        now = datetime.datetime.now()
+
+        for domain_name, parameters in iter(mydomains.items()):
+            if domain_name not in domains:
+                logger.info("Ignoring domain '%s'" % (domain_name))
+                continue
+
+            job = DomainJob(
+                domain_name, parameters,
+                parameters.get("backupdir", backupdir))
+
+            # don't schedule again the occurrence of a running job
+            after = now
+
+            with self.lock:
+                if domain_name in self.busy and \
+                        not self.busy[domain_name].manual:
+                    after = max(now, self.busy[domain_name].occurrence)
+
+            job.plan(after, self.state.getEstimate(domain_name))
+            jobs[domain_name] = job
+
+            logger.info("Backup of '%s' scheduled at %s" % (
+                domain_name, job.start_at))
+
+        with self.lock:
+            self.jobs = jobs
+            self.host_conf = host_conf
+
+    def submit(self, job, manual=False):
+        """Queue a job. Need to be called with lock acquired"""
+
+        job.status = "queued"
+        job.manual = manual
+        job.error = None
+        job.seconds = 0
+        job.started = None
+        job.control = throttle.Control()
+
+        # reads and writes of domain are checked by its control
+        throttle.controls[job.domain_name] = job.control
+        self.busy[job.domain_name] = job
+
+        job.getSize()
+        self.scheduler.submit(job)
+
+    def __backup(self, domain_name, parameters, backupdir):
+        """Called by scheduler workers"""
+
+        with self.lock:
+            job = self.busy[domain_name]
+            job.started = datetime.datetime.now()
+
+            if job.status != "paused":
+                job.status = "running"
+
+        # a job cancelled or paused while queued
+        job.control.wait()
+
+        # timings of the previous backup of domain are replaced
+        metrics.collector.reset(domain_name)
+
+        self.function(domain_name, parameters, backupdir)
+
+    def finished(self, job):
+        """Record the result of a job, and schedule the next one"""
+
+        if job.error is None:
+            status = "done"
+
+        # Cancelled could be raised in another thread (like the one writing
+        # compressed data), making the backup fail in a different way
+        elif job.control.cancelled:
+            status = "cancelled"
+
+        else:
+            status = "failed"
+
+        logger.info("Backup of '%s' %s in %.1fs" % (
+            job.domain_name, status, job.seconds))
+
+        start = job.started.isoformat() if job.started else None
+        self.state.addResult(job.domain_name, start, job.seconds, status)
+
+        metrics.collector.domainResult(
+            job.domain_name, job.seconds, job.error is None)
+
+        with self.lock:
+            self.busy.pop(job.domain_name, None)
+            throttle.controls.pop(job.domain_name, None)
+
+            # chunks no more referenced could be removed, if no other job
+            # is writing in the same chunk store. Jobs started in the
+            # meantime wait for collection to finish
+            collect = job.parameters.get("mode") == "chunks" and not any([
+                item.backupdir == job.backupdir and
+                item.parameters.get("mode") == "chunks"
+                for item in self.busy.values()])
+
+            # jobs could be replaced by a reload
+            if self.jobs.get(job.domain_name) is job:
+                now = datetime.datetime.now()
+
+                # the occurrence of a scheduled job is done, even if it
+                # started earlier
+                after = now if job.manual else max(now, job.occurrence)
+                job.plan(after, self.state.getEstimate(job.domain_name))
+
+                logger.info("Next backup of '%s' at %s" % (
+                    job.domain_name, job.start_at))
+
+        if collect:
+            try:
+                chunkstore.ChunkStore(job.backupdir).collect(blocking=False)
+
+            except Exception as message:
+                logger.exception(message)
+                logger.error("Cannot clean chunk store in '%s'" % (
+                    job.backupdir))
+
+        self.writeMetrics()
+
+    def writeMetrics(self):
+        """Export timings of the last backup of every domain"""
+
+        for key, write in [
+                ("metrics_textfile", metrics.collector.writePrometheus),
+                ("summary_file", metrics.collector.writeJSON)]:
+            if self.host_conf.get(key):
+                try:
+                    write(self.host_conf[key])
+
+                except Exception as message:
+                    logger.exception(message)
+                    logger.error("Cannot write '%s'" % (self.host_conf[key]))
+
+    def tick(self):
+        """Cancel jobs out of their window, and queue the jobs to start"""
+
+        now = datetime.datetime.now()
+        due = []
+
+        with self.lock:
+            for job in self.busy.values():
+                if job.deadline is not None and now >= job.deadline and \
+                        not job.manual and not job.control.cancelled:
+                    logger.error(
+                        "Backup of '%s' not completed before %s: "
+                        "cancelling it" % (job.domain_name, job.deadline))
+                    job.control.cancel()
+
+            for job in self.jobs.values():
+                if job.domain_name in self.busy or now < job.start_at:
+                    continue
+
+                if job.deadline is not None and now >= job.deadline:
+                    logger.error("Backup of '%s' missed its window" % (
+                        job.domain_name))
+                    self.state.addResult(job.domain_name, None, 0, "missed")
+                    job.plan(job.deadline,
+                             self.state.getEstimate(job.domain_name))
+                    continue
+
+                estimate = self.state.getEstimate(job.domain_name)
+
+                if job.deadline is not None and now + estimate > \
+                        job.deadline:
+                    logger.warning(
+                        "Backup of '%s' could not finish before %s" % (
+                            job.domain_name, job.deadline))
+
+                due += [job]
+
+        self.start(due)
+
+    def start(self, jobs, manual=False):
+        """Check jobs and queue the ready ones"""
+
+        for check in preflight.run(jobs, workers=self.preflight_workers):
+            job = check.job
+
+            with self.lock:
+                # a job could be started by a command in the meantime
+                if job.domain_name in self.busy:
+                    continue
+
+                if check.ready:
+                    self.submit(job, manual=manual)
+                    continue
+
+                self.state.addResult(job.domain_name, None, 0, "blocked")
+                metrics.collector.domainResult(job.domain_name, 0, False)
+
+                if not manual:
+                    job.plan(max(datetime.datetime.now(), job.occurrence),
+                             self.state.getEstimate(job.domain_name))
+
+    def command(self, line):
+        """Execute a command received by the control socket. Return a
+        dictionary"""
+
+        words = line.split()
+
+        if not words or words[0] not in COMMANDS:
+            return {"ok": False,
+                    "error": "Commands are: %s" % (", ".join(COMMANDS))}
+
+        name, args = words[0], words[1:]
+        logger.info("Received command '%s'" % (line))
+
+        try:
+            if name == "status":
+                return {"ok": True, "jobs": self.getStatus()}
+
+            if name == "reload":
+                self.reload()
+
+            elif name == "stop":
+                self.stop()
+
+            else:
+                for domain_name in args:
+                    getattr(self, name)(domain_name)
+
+        except Exception as message:
+            logger.error("Command '%s' failed: %s" % (line, message))
+            return {"ok": False, "error": str(message)}
+
+        return {"ok": True}
+
+    def getStatus(self):
+        """Return the status of every job"""
+
+        with self.lock:
+            jobs = [self.busy.get(name, job) for name, job in
+                    sorted(self.jobs.items())]
+
+            status = []
+
+            for job in jobs:
+                item = job.toDict()
+                item["estimate"] = self.state.getEstimate(
+                    job.domain_name).total_seconds()
+                item.update(self.state.domains.get(job.domain_name, {}))
+                status += [item]
+
+            return status
+
+    def __getJob(self, domain_name):
+        with self.lock:
+            if domain_name in self.busy:
+                return self.busy[domain_name]
+
+            if domain_name not in self.jobs:
+                raise RuntimeError(
+                    "Domain '%s' is not scheduled" % (domain_name))
+
+            return self.jobs[domain_name]
+
+    def trigger(self, domain_name):
+        """Backup a domain now, out of its schedule and window"""
+
+        job = self.__getJob(domain_name)
+
+        if job.status != "scheduled":
+            raise RuntimeError("Backup of '%s' is already %s" % (
+                domain_name, job.status))
+
+        self.start([job], manual=True)
+
+        if job.status != "queued":
+            raise RuntimeError("Domain '%s' is blocked" % (domain_name))
+
+    def pause(self, domain_name):
+        """Pause a running backup, or hold a queued one"""
+
+        with self.lock:
+            job = self.__getJob(domain_name)
+
+            if job.status not in ["queued", "running"]:
+                raise RuntimeError("Backup of '%s' is %s" % (
+                    domain_name, job.status))
+
+            # a queued job waits before its snapshot
+            self.scheduler.remove(job)
+            job.control.pause()
+            job.status = "paused"
+
+    def resume(self, domain_name):
+        """Resume a paused backup"""
+
+        with self.lock:
+            job = self.__getJob(domain_name)
+
+            if job.status != "paused":
+                raise RuntimeError("Backup of '%s' is %s" % (
+                    domain_name, job.status))
+
+            job.control.resume()
+
+            if job.started is None:
+                job.status = "queued"
+                self.scheduler.submit(job)
+
+            else:
+                job.status = "running"
+
+    def cancel(self, domain_name):
+        """Cancel a queued or running backup, or skip the next scheduled
+        one"""
+
+        with self.lock:
+            job = self.__getJob(domain_name)
+
+            if job.status == "scheduled":
+                logger.warning("Skipping backup of '%s' at %s" % (
+                    domain_name, job.start_at))
+                job.plan(job.occurrence,
+                         self.state.getEstimate(domain_name))
+                return
+
+            job.control.cancel()
+
+            # a job not started is terminated here
+            if job.started is None and (
+                    self.scheduler.remove(job) or job.status == "paused"):
+                job.error = throttle.Cancelled("Backup was cancelled")
+
+            else:
+                return
+
+        self.finished(job)
+
+    def serve(self):
+        """Accept commands from control socket"""
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server = ControlServer(self.socket_path, ControlHandler)
+        self.server.controller = self
+
+        # only root could send commands
+        os.chmod(self.socket_path, 0o600)
+
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="control")
+        thread.daemon = True
+        thread.start()
+
+        logger.info("Waiting for commands on '%s'" % (self.socket_path))
+
+    def stop(self):
+        """Stop the daemon: queued jobs are dropped, running jobs are
+        cancelled"""
+
+        logger.info("Stopping daemon")
+
+        with self.lock:
+            self.stopping = True
+
+            for job in self.busy.values():
+                job.control.cancel()
+
+        self.event.set()
+
+    def run(self):
+        """Schedule jobs, and start them until stopped"""
+
+        self.reload()
+        self.serve()
+        self.scheduler.start()
+
+        try:
+            while not self.stopping:
+                self.tick()
+                self.event.wait(TICK)
+                self.event.clear()
+
+        finally:
+            # workers terminate once cancelled jobs are done
+            self.scheduler.close()
+            self.scheduler.join()
+
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+        logger.info("Daemon stopped")
+
+
+def sendCommand(socket_path, line):
+    """Send a command to a running daemon. Return its reply"""
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(socket_path)
+        client.sendall((line + "\n").encode("utf-8"))
+
+        data = b""
+
+        while not data.endswith(b"\n"):
+            chunk = client.recv(4096)
+
+            if not chunk:
+                break
+
+            data += chunk
+
+    finally:
+        client.close()
+
+    return json.loads(data.decode("utf-8"))
@@ -31,10 +31,10 @@ import json
 import logging
 import multiprocessing
 import os
-import shlex
-import shutil
+import re
 import signal
-import subprocess
+import threading
+import time
 import uuid
 
 # To inspect xml
@@ -43,11 +43,19 @@ import xml.etree.ElementTree as ET
 import libvirt
 import libvirt_qemu
 
+from . import connection
+
 # Logging istance
 logger = logging.getLogger(__name__)
 
-# A global connection instance
-conn = libvirt.open("qemu:///system")
+# seconds between block job progress reports
+PROGRESS_INTERVAL = 10
+
+# where snapshot top images are created by default
+OVERLAY_DIR = "/var/lib/libvirt/images"
+
+# the name of top images, from domain name, disk and snapshot name
+OVERLAY_NAME = "snapshot_%s_%s-%s.img"
 
 # a function found here:
 # https://blog.nelhage.com/2010/02/a-very-subtle-bug/
@@ -57,67 +65,44 @@ conn = libvirt.open("qemu:///system")
 def preexec_fn(): return signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 
-def dumpXML(domain, path):
-    """DumpXML inside PATH"""
-
-    logger.info("Dumping XMLs for domain %s" % (domain.name()))
-
-    # I need to return wrote files
-    xml_files = []
-
-    dest_file = "%s.xml" % (domain.name())
-    dest_file = os.path.join(path, dest_file)
-
-    if os.path.exists(dest_file):
-        raise Exception("File %s exists!!" % (dest_file))
-
-    dest_fh = open(dest_file, "w")
-
-    # dump different xmls files. First of all, the offline dump
-    xml = domain.XMLDesc()
-    dest_fh.write(xml)
-    dest_fh.close()
+# the xml files dumped for a domain, as file suffix and XMLDesc flags. First
+# of all, the offline dump, then the inactive and a migrate config file. All
+# flags: libvirt.VIR_DOMAIN_XML_INACTIVE, libvirt.VIR_DOMAIN_XML_MIGRATABLE,
+# libvirt.VIR_DOMAIN_XML_SECURE, libvirt.VIR_DOMAIN_XML_UPDATE_CPU
+XML_FILES = [
+    (".xml", 0),
+    ("-inactive.xml", libvirt.VIR_DOMAIN_XML_INACTIVE),
+    ("-migratable.xml", (libvirt.VIR_DOMAIN_XML_INACTIVE +
+                         libvirt.VIR_DOMAIN_XML_MIGRATABLE))]
 
-    xml_files += [dest_file]
-    logger.debug("File %s wrote" % (dest_file))
 
-    # All flags: libvirt.VIR_DOMAIN_XML_INACTIVE,
-    # libvirt.VIR_DOMAIN_XML_MIGRATABLE, libvirt.VIR_DOMAIN_XML_SECURE,
-    # libvirt.VIR_DOMAIN_XML_UPDATE_CPU
-    dest_file = "%s-inactive.xml" % (domain.name())
-    dest_file = os.path.join(path, dest_file)
+def getXMLs(domain):
+    """Return a list of (file name, xml) for a domain"""
 
-    if os.path.exists(dest_file):
-        raise Exception("File %s exists!!" % (dest_file))
+    return [(domain.name() + suffix, domain.XMLDesc(flags=flags))
+            for suffix, flags in XML_FILES]
 
-    dest_fh = open(dest_file, "w")
 
-    # dump different xmls files. First of all, the offline dump
-    xml = domain.XMLDesc(flags=libvirt.VIR_DOMAIN_XML_INACTIVE)
-    dest_fh.write(xml)
-    dest_fh.close()
+def dumpXML(domain, path):
+    """DumpXML inside PATH"""
 
-    xml_files += [dest_file]
-    logger.debug("File %s wrote" % (dest_file))
+    logger.info("Dumping XMLs for domain %s" % (domain.name()))
 
-    # Dump a migrate config file
-    dest_file = "%s-migratable.xml" % (domain.name())
-    dest_file = os.path.join(path, dest_file)
+    # I need to return wrote files
+    xml_files = []
 
-    if os.path.exists(dest_file):
-        raise Exception("File %s exists!!" % (dest_file))
+    for dest_file, xml in getXMLs(domain):
+        dest_file = os.path.join(path, dest_file)
 
-    dest_fh = open(dest_file, "w")
+        if os.path.exists(dest_file):
+            raise Exception("File %s exists!!" % (dest_file))
 
-    # dump different xmls files. First of all, the offline dump
-    xml = domain.XMLDesc(
-        flags=libvirt.VIR_DOMAIN_XML_INACTIVE +
-        libvirt.VIR_DOMAIN_XML_MIGRATABLE)
-    dest_fh.write(xml)
-    dest_fh.close()
+        dest_fh = open(dest_file, "w")
+        dest_fh.write(xml)
+        dest_fh.close()
 
-    xml_files += [dest_file]
-    logger.debug("File %s wrote" % (dest_file))
+        xml_files += [dest_file]
+        logger.debug("File %s wrote" % (dest_file))
 
     return xml_files
 
@@ -128,9 +113,13 @@ def getDisks(domain):
     """Get al disks from a particoular domain"""
 
     # the fromstring method returns the root node
-    root = ET.fromstring(domain.XMLDesc())
+    return parseDisks(ET.fromstring(domain.XMLDesc()))
+
+
+def parseDisks(root):
+    """Get all disks from the root node of a domain XML"""
 
-    # then use XPath to search a line like
+    # use XPath to search a line like
     # <disk type='file' device='disk'> under <device> tag
     devices = root.findall("./devices/disk[@device='disk']")
 
@@ -161,23 +150,37 @@ def getDisks(domain):
 class Snapshot():
     """A class to deal with libvirt snapshot"""
 
-    global conn
-
-    def __init__(self, domain_name):
-        """Instantiate a SnapShot instance from a domain name"""
+    def __init__(self, domain_name, commit_bandwidth=0,
+                 overlay_dir=OVERLAY_DIR):
+        """Instantiate a SnapShot instance from a domain name. Blockcommit
+        bandwidth could be limited (MiB/s, 0 means unlimited). Top images
+        will be created in overlay_dir"""
 
         self.domain_name = domain_name
+        self.commit_bandwidth = commit_bandwidth
+        self.overlay_dir = overlay_dir
         self.snapshot_xml = None
         self.disks = None
         self.snapshot_disk = None
         self.snapshotId = None
-        self.conn = conn
+        self.manager = connection.getManager()
         self.snapshot = None
 
+        # a domain shut off is read directly, without snapshot
+        self.offline = False
+
+        # track disks committed and pivoted
+        self.committed = []
+        self.commit_threads = {}
+        self.commit_errors = []
+
+        # duration and average bandwidth of every blockcommit
+        self.commit_stats = {}
+
     def getDomain(self):
         """Return the libvirt domain by domain_name attribute class"""
 
-        return self.conn.lookupByName(self.domain_name)
+        return self.manager.lookupByName(self.domain_name)
 
     @property
     def domain(self):
@@ -191,14 +194,14 @@ class Snapshot():
 
         return False
 
-    def domainHasGuestAgent(self):
-        """Test if Guest Agent is up and running"""
+    def domainHasGuestAgent(self, timeout=30):
+        """Test if Guest Agent is up and running. timeout is in seconds"""
 
         try:
             response = libvirt_qemu.qemuAgentCommand(
                 self.domain,
                 '{"execute":"guest-ping"}',
-                timeout=30,
+                timeout=timeout,
                 flags=0)
 
         except libvirt.libvirtError as error:
@@ -215,8 +218,16 @@ class Snapshot():
     def getDisks(self):
         """Call getDisk on my instance"""
 
-        # call getDisk to get the disks to do snapshot
-        return getDisks(self.domain)
+        # call getDisk to get the disks to do snapshot. Domain XML is
+        # cached by connection manager
+        return parseDisks(self.manager.getXML(self.domain_name))
+
+    def getXMLs(self):
+        """Call getXMLs on my instance"""
+
+        return [(self.domain_name + suffix,
+                 self.manager.getXMLDesc(self.domain_name, flags))
+                for suffix, flags in XML_FILES]
 
     def dumpXML(self, path):
         """Call dumpXML on my instance"""
@@ -235,7 +246,8 @@ class Snapshot():
 
     def getSnapshotXML(self):
         """Since I need to do a Snapshot with a XML file, I will create an XML
-        to call the appropriate libvirt method"""
+        to call the appropriate libvirt method. Top images are placed in
+        overlay_dir"""
 
         # call getDisk to get the disks to do snapshot
         self.disks = self.getDisks()
@@ -243,52 +255,51 @@ class Snapshot():
         # get a snapshot id
         self.snapshotId = str(uuid.uuid1()).split("-")[0]
 
-        # now construct all diskspec
-        diskspecs = []
+        if not os.path.exists(self.overlay_dir):
+            logger.info("Creating directory '%s'" % (self.overlay_dir))
+            os.makedirs(self.overlay_dir)
 
+        # the same document created by 'virsh snapshot-create-as --disk-only'
+        root = ET.Element("domainsnapshot")
+        ET.SubElement(root, "name").text = self.snapshotId
+        ET.SubElement(root, "memory", snapshot="no")
+        disks = ET.SubElement(root, "disks")
+
+        # now construct all diskspec
         for disk in iter(self.disks):
-            diskspecs += [
-                "--diskspec %s,file=/var/lib/libvirt/images/snapshot"
-                "_%s_%s-%s.img" % (
-                    disk, self.domain_name, disk, self.snapshotId)]
-
-        my_cmd = (
-            "virsh snapshot-create-as --domain {domain_name} {snapshotId} "
-            "{diskspecs} --disk-only --atomic --quiesce --print-xml").format(
-                domain_name=self.domain.name(),
-                snapshotId=self.snapshotId,
-                diskspecs=" ".join(diskspecs))
-
-        logger.debug("Executing: %s" % (my_cmd))
-
-        # split the executable
-        my_cmds = shlex.split(my_cmd)
-
-        # Launch command
-        create_xml = subprocess.Popen(
-            my_cmds, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=preexec_fn,
-            shell=False)
-
-        # read output in xml
-        self.snapshot_xml = create_xml.stdout.read().decode("ascii")
-
-        # Lancio il comando e aspetto che termini
-        status = create_xml.wait()
-
-        if status != 0:
-            logger.error("Error for %s:%s" %
-                         (my_cmds, create_xml.stderr.read()))
-            logger.critical("{exe} returned {stato} state".format(
-                stato=status, exe=my_cmds[0]))
-            raise Exception("snapshot-create-as didn't work properly")
+            top = os.path.join(
+                self.overlay_dir, OVERLAY_NAME % (
+                    self.domain_name, disk, self.snapshotId))
+
+            element = ET.SubElement(
+                disks, "disk", name=disk, snapshot="external")
+            ET.SubElement(element, "driver", type="qcow2")
+            ET.SubElement(element, "source", file=top)
+
+        self.snapshot_xml = ET.tostring(root, encoding="unicode")
+
+        logger.debug("Snapshot XML: %s" % (self.snapshot_xml))
 
         return self.snapshot_xml
 
+    def setOffline(self):
+        """Read the images of a domain shut off directly: no snapshot is
+        created and nothing is blockcommitted. The domain must not be
+        started while its images are read (see Lib/offline.py)"""
+
+        self.offline = True
+
     def callSnapshot(self):
         """Create a snapshot for domain"""
 
+        # images of a domain shut off are the ones to read
+        if self.offline:
+            logger.info("Domain %s is shut off: reading images without "
+                        "snapshot" % (self.domain_name))
+            self.disks = self.getDisks()
+            self.snapshot_disk = {}
+            return None
+
         # Don't redo a snapshot on the same item
         if self.snapshot is not None:
             logger.error("A snapshot is already defined for this domain")
@@ -311,6 +322,9 @@ class Snapshot():
         self.snapshot = self.domain.snapshotCreateXML(
             self.snapshot_xml, flags=sum([disk_only, atomic, quiesce]))
 
+        # domain XML is changed
+        self.manager.invalidate(self.domain_name)
+
         # Once i've created a snapshot, I can read disks to have snapshot
         # image name
         self.snapshot_disk = self.getDisks()
@@ -323,72 +337,273 @@ class Snapshot():
 
         return self.snapshot
 
-    def doBlockCommit(self):
-        """Do a blockcommit for every disks shapshotted"""
+    def __waitBlockJob(self, job, statuses):
+        """Wait a block job event in statuses, reporting progress and
+        bandwidth of the job. Return the final status"""
 
-        logger.info("Blockcommitting %s" % (self.domain.name()))
+        last_time, last_cur = time.time(), None
 
-        # A blockcommit for every disks. Using names like libvirt variables.
-        # Base is the original image file
-        for disk in iter(self.disks):
-            # the command to execute
-            my_cmd = (
-                "virsh blockcommit {domain_name} {disk} --active "
-                "--verbose --pivot").format(
-                    domain_name=self.domain.name(), disk=disk)
-            logger.debug("Executing: %s" % (my_cmd))
-
-            # split the executable
-            my_cmds = shlex.split(my_cmd)
-
-            # Launch command
-            blockcommit = subprocess.Popen(
-                my_cmds,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                preexec_fn=preexec_fn,
-                shell=False)
-
-            # read output throug processing
-            for line in blockcommit.stdout:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                logger.debug("%s" % (line))
-
-            # Lancio il comando e aspetto che termini
-            status = blockcommit.wait()
-
-            if status != 0:
-                logger.error("Error for %s:%s" %
-                             (my_cmds, blockcommit.stderr.read()))
-                logger.critical("{exe} returned {stato} state".format(
-                    stato=status, exe=my_cmds[0]))
-                raise Exception("blockcommit didn't work properly")
+        while True:
+            status = job.wait(statuses, PROGRESS_INTERVAL)
+
+            if status in statuses:
+                return status
+
+            info = self.domain.blockJobInfo(job.disk, 0)
+
+            # no block job: it was terminated, event could be late
+            if not info:
+                return job.wait(statuses, PROGRESS_INTERVAL)
+
+            now = time.time()
+            cur, end = info["cur"], info["end"]
+
+            if last_cur is not None:
+                speed = (cur - last_cur) / (now - last_time)
+                percent = 100.0 * cur / end if end else 0.0
+
+                logger.info(
+                    "Blockcommit %s %s: %.1f%% (%.1f MiB/s)" % (
+                        self.domain_name, job.disk, percent,
+                        speed / 1024 ** 2))
+
+            last_time, last_cur = now, cur
+
+    def blockCommitDisk(self, disk):
+        """Do a blockcommit for a disk shapshotted, and remove its top
+        image once pivoted"""
+
+        logger.info("Blockcommitting %s %s" % (self.domain_name, disk))
+
+        # events are delivered by libvirt event loop
+        events.start(self.manager.getConnection())
+        job = events.watch(self.domain_name, disk)
+
+        try:
+            start = time.time()
+
+            # Using names like libvirt variables. Base is the original
+            # image file: commit top into base of the active layer
+            self.domain.blockCommit(
+                disk, None, None, self.commit_bandwidth,
+                libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+
+            status = self.__waitBlockJob(job, [
+                libvirt.VIR_DOMAIN_BLOCK_JOB_READY,
+                libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED,
+                libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED])
+
+            if status != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+                raise Exception(
+                    "blockcommit didn't work properly for %s %s (status "
+                    "%s)" % (self.domain_name, disk, status))
+
+            # base and top are synchronized: pivot to base
+            logger.debug("Pivoting %s %s" % (self.domain_name, disk))
+            self.domain.blockJobAbort(
+                disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+
+            # domain XML is changed
+            self.manager.invalidate(self.domain_name)
+
+            elapsed = time.time() - start
+
+        finally:
+            events.unwatch(job)
+
+        size = os.path.getsize(self.snapshot_disk[disk])
+
+        self.commit_stats[disk] = {
+            "seconds": elapsed,
+            "bytes": size,
+            "bandwidth": size / max(elapsed, 1e-6)}
+
+        logger.info("Blockcommit %s %s completed in %.1fs" % (
+            self.domain_name, disk, elapsed))
 
         # After blockcommit, I need to check that image were successfully
         # pivoted
-        test_disks = self.getDisks()
+        base = self.disks[disk]
+        test_base = self.getDisks()[disk]
+        top = self.snapshot_disk[disk]
 
-        for disk, base in iter(self.disks.items()):
-            test_base = test_disks[disk]
-            top = self.snapshot_disk[disk]
+        if base == test_base and top != test_base:
+            # I can remove the snapshotted image
+            logger.debug("Removing %s" % (top))
+            os.remove(top)
 
-            if base == test_base and top != test_base:
-                # I can remove the snapshotted image
-                logger.debug("Removing %s" % (top))
-                os.remove(top)
+        else:
+            logger.error("original base: %s, top: %s, new_base: %s" %
+                         (base, top, test_base))
+            raise Exception(
+                "Something goes wrong for snaphost %s" % (self.snapshotId))
 
-            else:
-                logger.error("original base: %s, top: %s, new_base: %s" %
-                             (base, top, test_base))
-                raise Exception(
-                    "Something goes wrong for snaphost %s" % (self.snapshotId))
+        self.committed += [disk]
+
+    def __blockCommitWorker(self, disk):
+        """Do a blockcommit in a thread, and track errors"""
+
+        try:
+            self.blockCommitDisk(disk)
+
+        except Exception as message:
+            logger.exception(message)
+            self.commit_errors += [(disk, message)]
+
+    def startBlockCommit(self, disk):
+        """Start a blockcommit for a disk whose copy is completed, while the
+        other disks are copied. doBlockCommit will wait for it"""
+
+        if self.offline:
+            return
+
+        thread = threading.Thread(
+            target=self.__blockCommitWorker, args=(disk,),
+            name="blockcommit-%s-%s" % (self.domain_name, disk))
+        thread.start()
+
+        self.commit_threads[disk] = thread
+
+    def doBlockCommit(self):
+        """Do a blockcommit for every disks shapshotted not yet committed,
+        then delete snapshot once every disk is pivoted"""
+
+        # no snapshot was created
+        if self.offline:
+            return
+
+        logger.info("Blockcommitting %s" % (self.domain_name))
+
+        # A blockcommit for every disks, all at the same time. Disks of a
+        # recovered snapshot could be committed already
+        for disk in iter(self.disks):
+            if disk not in self.commit_threads and \
+                    disk not in self.committed:
+                self.startBlockCommit(disk)
+
+        # wait for all blockcommit (even started while copying)
+        for thread in self.commit_threads.values():
+            thread.join()
+
+        if self.commit_errors:
+            raise Exception(
+                "blockcommit didn't work properly for %s" % (
+                    ", ".join([disk for disk, error in self.commit_errors])))
 
         # If I arrive here, I can delete snapshot
         self.__snapshotDelete()
 
+    def getOrphanSnapshot(self):
+        """Return the current snapshot, if it was created by kvmBackup and
+        left by an interrupted backup, as a dictionary with its top images,
+        the images below them and the disks still using top images. Return
+        None for other snapshots"""
+
+        snapshot = self.domain.snapshotCurrent()
+        name = snapshot.getName()
+        root = ET.fromstring(snapshot.getXMLDesc())
+
+        tops = {}
+
+        for disk in root.findall("./disks/disk"):
+            source = disk.find("source")
+
+            if source is not None:
+                tops[disk.get("name")] = source.get("file")
+
+        # top images are named by domain, disk and snapshot
+        if not tops or any([
+                os.path.basename(top) != OVERLAY_NAME % (
+                    self.domain_name, disk, name)
+                for disk, top in iter(tops.items())]):
+            return None
+
+        # the domain definition when snapshot was created
+        domain = root.find("domain")
+
+        if domain is None:
+            return None
+
+        bases = parseDisks(domain)
+        current = self.getDisks()
+
+        return {
+            "snapshot": snapshot,
+            "name": name,
+            "tops": tops,
+            "bases": dict([(disk, bases[disk]) for disk in tops]),
+            "active": [disk for disk, top in iter(tops.items())
+                       if current.get(disk) == top]}
+
+    def adoptSnapshot(self, orphan):
+        """Use a snapshot returned by getOrphanSnapshot as the one of this
+        instance. Images below top images are the ones to backup"""
+
+        logger.info("Using snapshot %s of %s" % (
+            orphan["name"], self.domain_name))
+
+        self.snapshot = orphan["snapshot"]
+        self.snapshotId = orphan["name"]
+        self.disks = dict(orphan["bases"])
+        self.snapshot_disk = dict(orphan["tops"])
+
+        # disks already pivoted don't need a blockcommit
+        self.committed = [disk for disk in self.disks
+                          if disk not in orphan["active"]]
+
+    def recoverSnapshot(self, orphan):
+        """Commit the top images of a snapshot returned by
+        getOrphanSnapshot, and delete it"""
+
+        logger.warning(
+            "Committing snapshot %s left by an interrupted backup of %s" % (
+                orphan["name"], self.domain_name))
+
+        self.adoptSnapshot(orphan)
+        self.doBlockCommit()
+
+        # top images of disks pivoted before backup was interrupted
+        for disk, top in iter(orphan["tops"].items()):
+            if os.path.exists(top):
+                logger.warning("Removing orphaned top image '%s'" % (top))
+                os.remove(top)
+
+        # a new snapshot could be created
+        self.snapshot = None
+        self.snapshot_xml = None
+        self.committed = []
+        self.commit_threads = {}
+
+    def removeOrphanOverlays(self):
+        """Remove the top images of this domain left in overlay_dir by
+        interrupted backups. Return the removed paths"""
+
+        if not os.path.isdir(self.overlay_dir):
+            return []
+
+        disks = self.getDisks()
+        used = set(disks.values())
+
+        # top images of every disk of this domain, and of any snapshot
+        patterns = [re.compile(re.escape(OVERLAY_NAME % (
+            self.domain_name, disk, "@")).replace("@", "[0-9a-f]+") + "$")
+            for disk in disks]
+
+        removed = []
+
+        for name in sorted(os.listdir(self.overlay_dir)):
+            path = os.path.join(self.overlay_dir, name)
+
+            if path in used or not any(
+                    [pattern.match(name) for pattern in patterns]):
+                continue
+
+            logger.warning("Removing orphaned top image '%s'" % (path))
+            os.remove(path)
+            removed += [path]
+
+        return removed
+
     def __snapshotDelete(self):
         """delete current snapshot"""
 
@@ -397,62 +612,104 @@ class Snapshot():
         logger.info("Removing snapshot %s" % (self.snapshotId))
         self.snapshot.delete(flags=sum([metadata]))
 
-# from https://bitbucket.org/russellballestrini/virt-back
 
+class BlockJobEvents():
+    """Dispatch libvirt block job events to the threads waiting for them.
+    Events are received by a thread running the libvirt event loop"""
 
-def rotate(target, retention=3):
-    """file rotation routine"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.thread = None
+        self.connection = None
 
-    for i in range(retention-2, 0, -1):  # count backwards
-        old_name = "%s.%s" % (target, i)
-        new_name = "%s.%s" % (target, i + 1)
+    def __runEventLoop(self):
+        while True:
+            libvirt.virEventRunDefaultImpl()
 
-        if os.path.exists(old_name):
-            logger.debug("Moving %s into %s" % (old_name, new_name))
-            shutil.move(old_name, new_name)
+    def __callback(self, conn, dom, disk, type_, status, opaque):
+        """Called by libvirt for every block job event"""
 
-    # Moving the first file
-    if os.path.exists(target):
-        logger.debug("Moving %s into %s.1" % (target, target))
-        shutil.move(target, target + '.1')
+        key = (dom.name(), disk)
 
+        logger.debug("Block job event for %s %s: type %s, status %s" % (
+            dom.name(), disk, type_, status))
 
-def packArchive(target, cpu_limit=8):
-    """Launch pigz for compressing files"""
+        with self.lock:
+            job = self.jobs.get(key)
 
-    cpus = multiprocessing.cpu_count()
+        if job is not None:
+            job.setStatus(status)
 
-    # setting number of cpus
-    if cpus > cpu_limit:
-        cpus = cpu_limit
+    def start(self, connection):
+        """Start event loop and register callback on connection. Callback
+        is registered again if connection was reopened"""
+
+        with self.lock:
+            if connection is not self.connection:
+                connection.domainEventRegisterAny(
+                    None, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2,
+                    self.__callback, None)
+
+                self.connection = connection
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.__runEventLoop, name="libvirt-events")
+                self.thread.daemon = True
+                self.thread.start()
 
-    my_cmd = "pigz --best --processes %s %s" % (cpus, target)
-    logger.debug("Executing: %s" % (my_cmd))
+    def watch(self, domain_name, disk):
+        """Return a BlockJob receiving events for a disk"""
 
-    # split the executable
-    my_cmds = shlex.split(my_cmd)
+        job = BlockJob(domain_name, disk)
 
-    # Launch command
-    pigz = subprocess.Popen(
-        my_cmds,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        preexec_fn=preexec_fn,
-        shell=False)
+        with self.lock:
+            self.jobs[(domain_name, disk)] = job
 
-    # read output throug processing
-    for line in pigz.stdout:
-        line = line.strip()
-        if len(line) == 0:
-            continue
+        return job
 
-        logger.debug("%s" % (line))
+    def unwatch(self, job):
+        with self.lock:
+            self.jobs.pop((job.domain_name, job.disk), None)
 
-    # Lancio il comando e aspetto che termini
-    status = pigz.wait()
 
-    if status != 0:
-        logger.error("Error for %s:%s" % (my_cmds, pigz.stderr.read()))
-        logger.critical("{exe} returned {stato} state".format(
-            stato=status, exe=my_cmds[0]))
-        raise Exception("pigz didn't work properly")
+class BlockJob():
+    """The status of a block job, as received by events"""
+
+    def __init__(self, domain_name, disk):
+        self.domain_name = domain_name
+        self.disk = disk
+        self.status = None
+        self.condition = threading.Condition()
+
+    def setStatus(self, status):
+        with self.condition:
+            self.status = status
+            self.condition.notify_all()
+
+    def wait(self, statuses, timeout):
+        """Wait until job status is in statuses, or timeout expires. Return
+        the current status"""
+
+        with self.condition:
+            if self.status not in statuses:
+                self.condition.wait(timeout)
+
+            return self.status
+
+
+# A global block job events dispatcher
+events = BlockJobEvents()
+
+
+def getProcesses(cpu_limit=8):
+    """Return the number of processes to use for compression"""
+
+    cpus = multiprocessing.cpu_count()
+
+    # setting number of cpus
+    if cpus > cpu_limit:
+        cpus = cpu_limit
+
+    return cpus
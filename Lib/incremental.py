@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to do incremental backups with the persistent dirty bitmaps of
+libvirt checkpoints. Every backup creates a checkpoint named by the date of
+its archive: a full backup reads every allocated block of disks, while an
+incremental backup reads only the blocks changed since the checkpoint of the
+previous backup, and is chained to it. Checkpoints and backup jobs are
+managed by a Provider: LibvirtProvider starts a backup job in pull mode and
+reads disks with NBD, while tests could use a local fake (see
+bench/fakecheckpoints.py). A backup job without checkpoint is the 'pull'
+engine of the other modes: disks are read with many NBD connections, without
+overlays and blockcommit
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+
+# To inspect xml
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+from . import helper, nbd, retention
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# checkpoints created by kvmBackup start with this prefix
+CHECKPOINT_PREFIX = "kvmBackup-"
+
+# incremental backups done before a new full backup is forced
+MAX_INCREMENTALS = 6
+
+# describes the backup in archive, next to checksums
+INFO_SUFFIX = "-incremental.json"
+
+
+def getCheckpointName(date):
+    """Return the name of the checkpoint of a backup done at date"""
+
+    return CHECKPOINT_PREFIX + date.strftime(retention.STAMP_FORMAT)
+
+
+class Provider():
+    """The checkpoints and the backup jobs of a domain. A backup job
+    exposes a point-in-time view of every disk and creates a checkpoint:
+    blocks written after a checkpoint are dirty"""
+
+    def __init__(self, snapshot, parameters):
+        """snapshot is the helper.Snapshot instance of domain"""
+
+        self.snapshot = snapshot
+        self.parameters = parameters
+        self.domain_name = snapshot.domain_name
+
+        # set when a backup job begins: the disks to read, by target dev
+        self.disks = None
+        self.checkpoint = None
+        self.parent = None
+
+    def listCheckpoints(self):
+        """Return the names of the checkpoints created by kvmBackup, oldest
+        first"""
+
+        raise NotImplementedError()
+
+    def removeCheckpoint(self, name):
+        """Remove a checkpoint"""
+
+        raise NotImplementedError()
+
+    def begin(self, checkpoint=None, parent=None):
+        """Start a backup job which creates checkpoint, if any. If parent is
+        a checkpoint, only the blocks dirty since it will be read"""
+
+        raise NotImplementedError()
+
+    def getSize(self, dev):
+        """Return the size of a disk, as seen by guest"""
+
+        raise NotImplementedError()
+
+    def getExtents(self, dev):
+        """Return (offset, length) of the data to read: the blocks dirty
+        since parent checkpoint, or the allocated ones"""
+
+        raise NotImplementedError()
+
+    def read(self, dev, offset, length):
+        """Read length bytes of a disk from offset"""
+
+        raise NotImplementedError()
+
+    def open(self, dev, extents):
+        """Return a file object of a disk, which will be read in extents"""
+
+        return DiskReader(self, dev)
+
+    def end(self):
+        """Finish the backup job"""
+
+        raise NotImplementedError()
+
+
+class LibvirtProvider(Provider):
+    """Checkpoints of libvirt, and backup jobs in pull mode: disks and
+    their dirty bitmaps are exported by qemu NBD server in a unix socket"""
+
+    def __init__(self, snapshot, parameters):
+        Provider.__init__(self, snapshot, parameters)
+
+        # where NBD socket and scratch images are placed
+        self.scratch_dir = parameters.get(
+            "scratch_dir", parameters.get("overlay_dir", helper.OVERLAY_DIR))
+        self.socket_path = os.path.join(
+            self.scratch_dir, "%s%s.sock" % (
+                CHECKPOINT_PREFIX, self.domain_name))
+
+        # a NBD connection for every disk
+        self.clients = {}
+        self.running = False
+
+    @property
+    def domain(self):
+        return self.snapshot.domain
+
+    def listCheckpoints(self):
+        names = [checkpoint.getName() for checkpoint in
+                 self.domain.listAllCheckpoints()]
+
+        # checkpoint names sort by date
+        return sorted([name for name in names
+                       if name.startswith(CHECKPOINT_PREFIX)])
+
+    def removeCheckpoint(self, name):
+        logger.info("Removing checkpoint %s of %s" % (name, self.domain_name))
+
+        # the bitmaps of checkpoint are merged in the previous one, if any
+        self.domain.checkpointLookupByName(name).delete()
+
+    def getScratch(self, dev):
+        """Return the scratch image of a disk, which keeps the data written
+        by guest while it is read"""
+
+        return os.path.join(self.scratch_dir, "%s%s-%s.scratch" % (
+            CHECKPOINT_PREFIX, self.domain_name, dev))
+
+    def getBitmap(self, dev):
+        """Return the name of the dirty bitmap exported for a disk"""
+
+        return "backup-%s" % (dev)
+
+    def getBackupXML(self):
+        """Return the XML of a backup job in pull mode"""
+
+        root = ET.Element("domainbackup", mode="pull")
+
+        if self.parent is not None:
+            ET.SubElement(root, "incremental").text = self.parent
+
+        ET.SubElement(
+            root, "server", transport="unix", socket=self.socket_path)
+
+        disks = ET.SubElement(root, "disks")
+
+        for dev in sorted(self.disks):
+            disk = ET.SubElement(
+                disks, "disk", name=dev, backup="yes", type="file",
+                exportname=dev)
+
+            if self.parent is not None:
+                disk.set("exportbitmap", self.getBitmap(dev))
+
+            ET.SubElement(disk, "scratch", file=self.getScratch(dev))
+
+        return ET.tostring(root, encoding="unicode")
+
+    def getCheckpointXML(self):
+        """Return the XML of the checkpoint created by backup job, if
+        any"""
+
+        if self.checkpoint is None:
+            return None
+
+        root = ET.Element("domaincheckpoint")
+        ET.SubElement(root, "name").text = self.checkpoint
+
+        disks = ET.SubElement(root, "disks")
+
+        for dev in sorted(self.disks):
+            ET.SubElement(disks, "disk", name=dev, checkpoint="bitmap")
+
+        return ET.tostring(root, encoding="unicode")
+
+    def abortStaleJob(self):
+        """Abort a backup job left by an interrupted backup, if any"""
+
+        try:
+            self.domain.backupGetXMLDesc()
+
+        except libvirt.libvirtError:
+            return
+
+        logger.warning("Aborting the backup job left in %s" % (
+            self.domain_name))
+
+        self.domain.abortJob()
+
+    def begin(self, checkpoint=None, parent=None):
+        if not self.snapshot.domainIsActive():
+            raise RuntimeError(
+                "Backup jobs need domain '%s' to be running" % (
+                    self.domain_name))
+
+        self.checkpoint = checkpoint
+        self.parent = parent
+        self.disks = self.snapshot.getDisks()
+
+        self.abortStaleJob()
+
+        if not os.path.exists(self.scratch_dir):
+            logger.info("Creating directory '%s'" % (self.scratch_dir))
+            os.makedirs(self.scratch_dir)
+
+        for path in [self.socket_path] + [
+                self.getScratch(dev) for dev in self.disks]:
+            if os.path.exists(path):
+                logger.warning("Removing '%s'" % (path))
+                os.remove(path)
+
+        logger.info("Starting backup job of %s%s%s" % (
+            self.domain_name,
+            " with checkpoint %s" % (checkpoint) if checkpoint else "",
+            " since %s" % (parent) if parent else ""))
+
+        # file systems are consistent when checkpoint is created
+        self.domain.fsFreeze()
+
+        try:
+            self.domain.backupBegin(
+                self.getBackupXML(), self.getCheckpointXML())
+            self.running = True
+
+        finally:
+            self.domain.fsThaw()
+
+        for dev in self.disks:
+            contexts = [nbd.BASE_ALLOCATION]
+
+            if parent is not None:
+                contexts += [nbd.DIRTY_BITMAP + self.getBitmap(dev)]
+
+            self.clients[dev] = nbd.Client(
+                path=self.socket_path, export=dev, contexts=contexts)
+
+    def getSize(self, dev):
+        return self.clients[dev].size
+
+    def getExtents(self, dev):
+        client = self.clients[dev]
+
+        if self.parent is not None:
+            return client.getExtents(
+                nbd.DIRTY_BITMAP + self.getBitmap(dev), nbd.NBD_STATE_DIRTY)
+
+        # holes are zeros in a full backup
+        return client.getExtents(nbd.BASE_ALLOCATION, nbd.NBD_STATE_HOLE, 0)
+
+    def read(self, dev, offset, length):
+        return self.clients[dev].read(offset, length)
+
+    def open(self, dev, extents):
+        """Read extents with many NBD connections at the same time"""
+
+        def connect():
+            return nbd.Client(path=self.socket_path, export=dev)
+
+        return nbd.RangeReader(
+            connect, self.getSize(dev), extents,
+            readers=self.parameters.get("nbd_readers", nbd.READERS),
+            name="%s:%s" % (self.domain_name, dev))
+
+    def end(self):
+        for client in self.clients.values():
+            client.close()
+
+        self.clients = {}
+
+        # a backup job in pull mode is finished by aborting it
+        if self.running:
+            self.domain.abortJob()
+            self.running = False
+
+        logger.debug("Backup job of %s finished" % (self.domain_name))
+
+
+# providers by name: tests could add their fakes
+PROVIDERS = {"libvirt": LibvirtProvider}
+
+
+def getProvider(snapshot, parameters):
+    """Return the provider of checkpoints of a domain"""
+
+    name = parameters.get("checkpoint_provider", "libvirt")
+
+    if name not in PROVIDERS:
+        raise RuntimeError("Unknown checkpoint provider '%s'" % (name))
+
+    return PROVIDERS[name](snapshot, parameters)
+
+
+class DiskReader():
+    """A file object reading a disk of a backup job, as expected by
+    sparse.addExtents"""
+
+    def __init__(self, provider, dev):
+        self.provider = provider
+        self.dev = dev
+        self.name = "%s:%s" % (provider.domain_name, dev)
+        self.size = provider.getSize(dev)
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+
+        size = min(size, self.size - self.position)
+
+        if size <= 0:
+            return b""
+
+        data = self.provider.read(self.dev, self.position, size)
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        pass
+
+
+def getParent(generations, checkpoints, max_incrementals):
+    """Return the checkpoint an incremental backup could be chained to, or
+    None if a full backup is needed. generations are sorted newest first"""
+
+    if not generations or generations[0]["date"] is None:
+        return None
+
+    # incremental backups done since the last full one
+    incrementals = 0
+
+    for item in generations:
+        if not item["incremental"]:
+            break
+
+        incrementals += 1
+
+    if incrementals >= max_incrementals:
+        logger.info("%s incremental backups done: a full backup is needed" % (
+            incrementals))
+        return None
+
+    # the last backup must have been done with a checkpoint
+    parent = getCheckpointName(generations[0]["date"])
+
+    if parent not in checkpoints:
+        logger.info("Checkpoint %s not found: a full backup is needed" % (
+            parent))
+        return None
+
+    return parent
+
+
+def getChain(generations, name):
+    """Return the generations to restore in order to restore an
+    incremental backup: the full backup first, then the incremental ones.
+    generations are sorted newest first"""
+
+    names = [item["name"] for item in generations]
+
+    if name not in names:
+        raise Exception("'%s' is not a backup generation" % (name))
+
+    chain = []
+
+    for item in generations[names.index(name):]:
+        chain.insert(0, item)
+
+        if not item["incremental"]:
+            return chain
+
+    raise Exception("Cannot find the full backup of '%s'" % (name))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to time every backup phase, per domain and per disk, and to export
+timings in prometheus textfile collector format and as a JSON summary
+
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+
+class Phase():
+    """A timed phase of a domain backup"""
+
+    def __init__(self, domain, name, disk=None):
+        self.domain = domain
+        self.name = name
+        self.disk = disk
+        self.start = time.time()
+        self.seconds = None
+        self.bytes = None
+        self.status = "ok"
+
+        # other information, like the method used to copy a disk
+        self.info = {}
+
+    @property
+    def throughput(self):
+        """Bytes processed per second, if bytes are known"""
+
+        if self.bytes is None or not self.seconds:
+            return None
+
+        return self.bytes / self.seconds
+
+    def toDict(self):
+        data = {
+            "domain": self.domain,
+            "phase": self.name,
+            "disk": self.disk,
+            "start": self.start,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "throughput": self.throughput,
+            "status": self.status}
+
+        data.update(self.info)
+
+        return data
+
+
+class Metrics():
+    """Collect phases and domain results of a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = []
+        self.domains = {}
+
+    @contextmanager
+    def phase(self, domain, name, disk=None):
+        """Time a phase. The yielded Phase could be used to set the bytes
+        processed"""
+
+        phase = Phase(domain, name, disk)
+
+        try:
+            yield phase
+
+        except Exception:
+            phase.status = "failed"
+            raise
+
+        finally:
+            phase.seconds = time.time() - phase.start
+
+            with self.lock:
+                self.phases += [phase]
+
+            logger.debug("Phase '%s' for %s %s: %.2fs" % (
+                name, domain, disk or "", phase.seconds))
+
+    def record(self, domain, name, seconds, disk=None, bytes=None):
+        """Record a phase timed elsewhere"""
+
+        phase = Phase(domain, name, disk)
+        phase.start -= seconds
+        phase.seconds = seconds
+        phase.bytes = bytes
+
+        with self.lock:
+            self.phases += [phase]
+
+        return phase
+
+    def reset(self, domain):
+        """Forget the phases of a domain, before it is backed up again: only
+        the last backup of a domain is exported"""
+
+        with self.lock:
+            self.phases = [
+                phase for phase in self.phases if phase.domain != domain]
+
+    def domainResult(self, domain, seconds, success):
+        """Record the total time and the result of a domain backup"""
+
+        with self.lock:
+            self.domains[domain] = {
+                "seconds": seconds,
+                "success": success}
+
+    def getSummary(self):
+        """Return the summary of the run as a dictionary"""
+
+        with self.lock:
+            return {
+                "host": socket.gethostname().split(".")[0],
+                "start": self.start,
+                "seconds": time.time() - self.start,
+                "domains": dict(self.domains),
+                "phases": [phase.toDict() for phase in self.phases]}
+
+    def writeJSON(self, path):
+        """Write run summary as JSON"""
+
+        writeFile(path, json.dumps(self.getSummary(), indent=1))
+        logger.info("Run summary written in '%s'" % (path))
+
+    def writePrometheus(self, path):
+        """Write metrics in prometheus textfile collector format"""
+
+        summary = self.getSummary()
+        lines = []
+
+        def add(name, help_, type_, samples):
+            lines.extend([
+                "# HELP kvmbackup_%s %s" % (name, help_),
+                "# TYPE kvmbackup_%s %s" % (name, type_)])
+
+            # series must be unique: a phase done twice (like a block
+            # commit retried by a recovery) is exported once, with its last
+            # value
+            series = collections.OrderedDict()
+
+            for labels, value in samples:
+                labels = ",".join(
+                    ['%s="%s"' % (key, escape(value))
+                     for key, value in labels if value is not None])
+
+                if labels:
+                    labels = "{%s}" % (labels)
+
+                series.pop(labels, None)
+                series[labels] = value
+
+            for labels, value in series.items():
+                lines.append("kvmbackup_%s%s %s" % (name, labels, value))
+
+        phases = summary["phases"]
+
+        # copy phases have the method used too
+        def labels(phase):
+            return [("domain", phase["domain"]), ("phase", phase["phase"]),
+                    ("disk", phase["disk"]), ("method", phase.get("method"))]
+
+        add("phase_duration_seconds", "Duration of backup phases", "gauge",
+            [(labels(phase), phase["seconds"]) for phase in phases])
+
+        add("phase_bytes", "Bytes processed by backup phases", "gauge",
+            [(labels(phase), phase["bytes"]) for phase in phases
+             if phase["bytes"] is not None])
+
+        add("phase_throughput_bytes_per_second",
+            "Throughput of backup phases", "gauge",
+            [(labels(phase), phase["throughput"]) for phase in phases
+             if phase["throughput"] is not None])
+
+        add("phase_success", "1 if backup phase was successful", "gauge",
+            [(labels(phase), int(phase["status"] == "ok"))
+             for phase in phases])
+
+        domains = sorted(summary["domains"].items())
+
+        add("domain_duration_seconds", "Duration of domain backups", "gauge",
+            [([("domain", domain)], data["seconds"])
+             for domain, data in domains])
+
+        add("domain_success", "1 if domain backup was successful", "gauge",
+            [([("domain", domain)], int(data["success"]))
+             for domain, data in domains])
+
+        add("run_duration_seconds", "Duration of kvmBackup run", "gauge",
+            [([], summary["seconds"])])
+
+        add("last_run_timestamp_seconds", "Start time of kvmBackup run",
+            "gauge", [([], summary["start"])])
+
+        writeFile(path, "\n".join(lines) + "\n")
+        logger.info("Metrics written in '%s'" % (path))
+
+
+def escape(value):
+    """Escape a prometheus label value"""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def writeFile(path, data):
+    """Write a file atomically, since collectors could read it at any
+    time"""
+
+    partial = path + ".part"
+
+    with open(partial, "w") as handle:
+        handle.write(data)
+
+    os.rename(partial, path)
+
+
+# A global collector for the current run
+collector = Metrics()
+phase = collector.phase
+record = collector.record
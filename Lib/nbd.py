@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A minimal NBD client, to read the disks exported by a libvirt backup job in
+pull mode. Only what kvmBackup needs is implemented: the fixed newstyle
+handshake, structured replies, reads and block status of a metadata context
+(like 'base:allocation' or the 'qemu:dirty-bitmap:' of a checkpoint). See
+https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+
+A RangeReader reads the extents of a disk with many connections at the same
+time, and returns them in order like a file
+
+"""
+
+from __future__ import print_function
+
+import collections
+import logging
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+
+except ImportError:
+    import Queue as queue
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# handshake magic numbers
+NBD_MAGIC = b"NBDMAGIC"
+IHAVEOPT = 0x49484156454F5054
+REPLY_MAGIC = 0x3e889045565a9
+
+# handshake flags
+NBD_FLAG_FIXED_NEWSTYLE = 1
+NBD_FLAG_NO_ZEROES = 2
+
+# options
+NBD_OPT_ABORT = 2
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_OPT_SET_META_CONTEXT = 10
+
+# option replies. Errors have the highest bit set
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_META_CONTEXT = 4
+NBD_REP_FLAG_ERROR = 1 << 31
+
+# information requested with NBD_OPT_GO
+NBD_INFO_EXPORT = 0
+NBD_INFO_BLOCK_SIZE = 3
+
+# transmission magic numbers
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+# commands
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+NBD_CMD_BLOCK_STATUS = 7
+
+# structured reply chunks
+NBD_REPLY_FLAG_DONE = 1
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_OFFSET_HOLE = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+NBD_REPLY_TYPE_ERROR_OFFSET = (1 << 15) + 2
+
+# block status flags of 'base:allocation', and of dirty bitmaps
+NBD_STATE_HOLE = 1
+NBD_STATE_ZERO = 2
+NBD_STATE_DIRTY = 1
+
+# the contexts of allocation and of dirty bitmaps
+BASE_ALLOCATION = "base:allocation"
+DIRTY_BITMAP = "qemu:dirty-bitmap:"
+
+# the largest request sent to servers (qemu accepts 32 MiB)
+MAX_REQUEST = 32 * 1024 * 1024
+
+# block status is asked for this length at most
+MAX_STATUS = 1024 ** 3
+
+# connections of a range reader, and the size of ranges read by each one
+READERS = 4
+RANGE_SIZE = 4 * 1024 * 1024
+
+
+class NBDError(Exception):
+    pass
+
+
+class Client():
+    """A connection to an export of a NBD server, with one request at a
+    time"""
+
+    def __init__(self, path=None, host=None, port=10809, export="",
+                 contexts=None, timeout=None):
+        """Connect to a unix socket in path, or to host and port, and open
+        export. contexts are the metadata contexts whose block status will
+        be requested"""
+
+        self.export = export
+        self.size = None
+        self.flags = 0
+        self.max_request = MAX_REQUEST
+
+        # the ids given by server to metadata contexts, by name
+        self.contexts = {}
+
+        # requests are serialized
+        self.lock = threading.Lock()
+        self.handle = 0
+
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(path)
+            self.address = path
+
+        else:
+            self.socket = socket.create_connection(
+                (host, port), timeout=timeout)
+            self.address = "%s:%s" % (host, port)
+
+        try:
+            self.__handshake(contexts or [])
+
+        except Exception:
+            self.socket.close()
+            raise
+
+        logger.debug("Connected to export '%s' of '%s' (%s bytes)" % (
+            export, self.address, self.size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __recv(self, size):
+        """Read exactly size bytes from socket"""
+
+        chunks = []
+
+        while size > 0:
+            data = self.socket.recv(min(size, 1024 * 1024))
+
+            if not data:
+                raise NBDError(
+                    "Connection to '%s' closed by server" % (self.address))
+
+            chunks += [data]
+            size -= len(data)
+
+        return b"".join(chunks)
+
+    def __recvInto(self, view):
+        """Fill a memoryview with data from socket"""
+
+        while len(view) > 0:
+            received = self.socket.recv_into(view)
+
+            if received == 0:
+                raise NBDError(
+                    "Connection to '%s' closed by server" % (self.address))
+
+            view = view[received:]
+
+    def __sendOption(self, option, data=b""):
+        self.socket.sendall(
+            struct.pack(">QII", IHAVEOPT, option, len(data)) + data)
+
+    def __recvOption(self, option):
+        """Return the type and data of a reply to option"""
+
+        magic, reply_option, reply, length = struct.unpack(
+            ">QIII", self.__recv(20))
+
+        if magic != REPLY_MAGIC or reply_option != option:
+            raise NBDError("Unexpected reply to option %s from '%s'" % (
+                option, self.address))
+
+        data = self.__recv(length)
+
+        if reply & NBD_REP_FLAG_ERROR:
+            raise NBDError("Option %s refused by '%s' (%s): %s" % (
+                option, self.address, reply & ~NBD_REP_FLAG_ERROR,
+                data.decode("utf-8", "replace")))
+
+        return reply, data
+
+    def __handshake(self, contexts):
+        """Negotiate the export and its metadata contexts"""
+
+        magic, option, flags = struct.unpack(">8sQH", self.__recv(18))
+
+        if magic != NBD_MAGIC or option != IHAVEOPT:
+            raise NBDError("'%s' is not a newstyle NBD server" % (
+                self.address))
+
+        if not flags & NBD_FLAG_FIXED_NEWSTYLE:
+            raise NBDError("'%s' doesn't support fixed newstyle" % (
+                self.address))
+
+        self.socket.sendall(struct.pack(
+            ">I", NBD_FLAG_FIXED_NEWSTYLE | (flags & NBD_FLAG_NO_ZEROES)))
+
+        # reads and block status are replied in chunks
+        self.__sendOption(NBD_OPT_STRUCTURED_REPLY)
+        self.__recvOption(NBD_OPT_STRUCTURED_REPLY)
+
+        name = self.export.encode("utf-8")
+
+        if contexts:
+            data = struct.pack(">I", len(name)) + name
+            data += struct.pack(">I", len(contexts))
+
+            for context in contexts:
+                data += struct.pack(">I", len(context)) + context.encode(
+                    "utf-8")
+
+            self.__sendOption(NBD_OPT_SET_META_CONTEXT, data)
+
+            while True:
+                reply, data = self.__recvOption(NBD_OPT_SET_META_CONTEXT)
+
+                if reply == NBD_REP_ACK:
+                    break
+
+                if reply == NBD_REP_META_CONTEXT:
+                    context_id, = struct.unpack(">I", data[:4])
+                    self.contexts[data[4:].decode("utf-8")] = context_id
+
+            for context in contexts:
+                if context not in self.contexts:
+                    raise NBDError("Context '%s' not found in '%s'" % (
+                        context, self.address))
+
+        # open export, asking for its size and block sizes
+        data = struct.pack(">I", len(name)) + name
+        data += struct.pack(">HHH", 2, NBD_INFO_EXPORT, NBD_INFO_BLOCK_SIZE)
+
+        self.__sendOption(NBD_OPT_GO, data)
+
+        while True:
+            reply, data = self.__recvOption(NBD_OPT_GO)
+
+            if reply == NBD_REP_ACK:
+                break
+
+            if reply != NBD_REP_INFO:
+                continue
+
+            info, = struct.unpack(">H", data[:2])
+
+            if info == NBD_INFO_EXPORT:
+                self.size, self.flags = struct.unpack(">QH", data[2:12])
+
+            elif info == NBD_INFO_BLOCK_SIZE:
+                minimum, preferred, maximum = struct.unpack(
+                    ">III", data[2:14])
+                self.max_request = min(MAX_REQUEST, maximum)
+
+        if self.size is None:
+            raise NBDError("Size of export '%s' not received from '%s'" % (
+                self.export, self.address))
+
+    def __request(self, command, offset, length):
+        """Send a request. Return its handle"""
+
+        self.handle += 1
+
+        self.socket.sendall(struct.pack(
+            ">IHHQQI", REQUEST_MAGIC, 0, command, self.handle, offset,
+            length))
+
+        return self.handle
+
+    def __replies(self, handle):
+        """Yield (type, data) of every chunk replied to a request. Data of
+        reads are not returned: they must be read from socket"""
+
+        while True:
+            magic, = struct.unpack(">I", self.__recv(4))
+
+            if magic == SIMPLE_REPLY_MAGIC:
+                error, reply_handle = struct.unpack(">IQ", self.__recv(12))
+
+                if error:
+                    raise NBDError("Request failed on '%s': error %s" % (
+                        self.address, error))
+
+                yield NBD_REPLY_TYPE_NONE, None
+                return
+
+            if magic != STRUCTURED_REPLY_MAGIC:
+                raise NBDError("Invalid reply from '%s'" % (self.address))
+
+            flags, reply_type, reply_handle, length = struct.unpack(
+                ">HHQI", self.__recv(16))
+
+            if reply_handle != handle:
+                raise NBDError("Unexpected reply from '%s'" % (self.address))
+
+            if reply_type in [NBD_REPLY_TYPE_ERROR,
+                              NBD_REPLY_TYPE_ERROR_OFFSET]:
+                data = self.__recv(length)
+                error, size = struct.unpack(">IH", data[:6])
+
+                raise NBDError("Request failed on '%s': error %s %s" % (
+                    self.address, error,
+                    data[6:6 + size].decode("utf-8", "replace")))
+
+            if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+                # read data into buffer of caller
+                yield reply_type, length
+
+            elif length > 0:
+                yield reply_type, self.__recv(length)
+
+            if flags & NBD_REPLY_FLAG_DONE:
+                return
+
+    def read(self, offset, length):
+        """Read length bytes from offset. Holes are returned as zeros"""
+
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+
+        with self.lock:
+            for start in range(0, length, self.max_request):
+                size = min(self.max_request, length - start)
+                handle = self.__request(
+                    NBD_CMD_READ, offset + start, size)
+
+                for reply_type, data in self.__replies(handle):
+                    if reply_type == NBD_REPLY_TYPE_NONE:
+                        # a simple reply is followed by data
+                        self.__recvInto(view[start:start + size])
+
+                    elif reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+                        chunk_offset, = struct.unpack(">Q", self.__recv(8))
+                        begin = chunk_offset - offset
+
+                        self.__recvInto(view[begin:begin + data - 8])
+
+                    # holes are zeros already
+
+        return bytes(buffer)
+
+    def blockStatus(self, context, offset=0, length=None):
+        """Return a list of (offset, length, flags) of context, from offset
+        for length bytes (up to the end of export)"""
+
+        if length is None:
+            length = self.size - offset
+
+        context_id = self.contexts[context]
+        end = offset + length
+        extents = []
+
+        with self.lock:
+            while offset < end:
+                handle = self.__request(
+                    NBD_CMD_BLOCK_STATUS, offset,
+                    min(MAX_STATUS, end - offset))
+
+                received = []
+
+                for reply_type, data in self.__replies(handle):
+                    if reply_type != NBD_REPLY_TYPE_BLOCK_STATUS:
+                        continue
+
+                    reply_id, = struct.unpack(">I", data[:4])
+
+                    if reply_id != context_id:
+                        continue
+
+                    for i in range(4, len(data), 8):
+                        received += [struct.unpack(">II", data[i:i + 8])]
+
+                if not received:
+                    raise NBDError("No block status for '%s' from '%s'" % (
+                        context, self.address))
+
+                for size, flags in received:
+                    size = min(size, end - offset)
+
+                    if size <= 0:
+                        break
+
+                    extents += [(offset, size, flags)]
+                    offset += size
+
+        return extents
+
+    def getExtents(self, context, mask, value=None):
+        """Return (offset, length) of regions of context whose flags,
+        masked, are equal to value (mask by default), merging adjacent
+        ones"""
+
+        if value is None:
+            value = mask
+
+        extents = []
+
+        for offset, length, flags in self.blockStatus(context):
+            if flags & mask != value:
+                continue
+
+            if extents and sum(extents[-1]) == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+
+            else:
+                extents += [(offset, length)]
+
+        return extents
+
+    def close(self):
+        """Close connection"""
+
+        try:
+            with self.lock:
+                self.__request(NBD_CMD_DISC, 0, 0)
+
+        except (IOError, OSError):
+            pass
+
+        self.socket.close()
+
+
+class RangeReader():
+    """A file object reading the extents of an export with many
+    connections. Extents are split in ranges, which are read ahead by a pool
+    of threads and returned in order. Reads out of extents are done
+    directly"""
+
+    def __init__(self, connect, size, extents, readers=READERS,
+                 range_size=RANGE_SIZE, name=None):
+        """connect is a function returning a new Client of the export, which
+        has size bytes. extents are the (offset, length) which will be
+        read"""
+
+        self.connect = connect
+        self.size = size
+        self.name = name or "nbd"
+        self.position = 0
+
+        # idle connections, and the ones opened
+        self.idle = queue.Queue()
+        self.clients = []
+        self.lock = threading.Lock()
+
+        # the ranges to read in order
+        self.ranges = collections.deque()
+
+        for offset, length in extents:
+            for start in range(offset, offset + length, range_size):
+                self.ranges.append(
+                    (start, min(range_size, offset + length - start)))
+
+        # ranges read ahead, and the last one returned
+        self.window = readers * 2
+        self.pending = collections.deque()
+        self.current = (0, b"")
+
+        self.executor = ThreadPoolExecutor(max_workers=readers)
+
+        self.__fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getClient(self):
+        """Return an idle connection, or a new one"""
+
+        try:
+            return self.idle.get_nowait()
+
+        except queue.Empty:
+            client = self.connect()
+
+            with self.lock:
+                self.clients += [client]
+
+            return client
+
+    def __readRange(self, offset, length):
+        client = self.__getClient()
+
+        try:
+            return client.read(offset, length)
+
+        finally:
+            self.idle.put(client)
+
+    def __fill(self):
+        """Read ahead the next ranges"""
+
+        while self.ranges and len(self.pending) < self.window:
+            offset, length = self.ranges.popleft()
+
+            self.pending.append((offset, length, self.executor.submit(
+                self.__readRange, offset, length)))
+
+    def __find(self):
+        """Return the range with position, or None"""
+
+        offset, data = self.current
+
+        if offset <= self.position < offset + len(data):
+            return self.current
+
+        while self.pending:
+            offset, length, future = self.pending[0]
+
+            # the next ranges are after position
+            if offset > self.position:
+                return None
+
+            self.pending.popleft()
+            self.__fill()
+
+            # ranges skipped by seek are discarded
+            if self.position < offset + length:
+                self.current = (offset, future.result())
+                return self.current
+
+        return None
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+
+        elif whence == 2:
+            offset += self.size
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+
+        size = min(size, self.size - self.position)
+
+        if size <= 0:
+            return b""
+
+        found = self.__find()
+
+        if found is None:
+            # position is out of extents
+            data = self.__readRange(self.position, size)
+
+        else:
+            offset, data = found
+            start = self.position - offset
+            data = data[start:start + size]
+
+        self.position += len(data)
+
+        return data
+
+    def close(self):
+        """Stop reading ahead, and close connections"""
+
+        self.ranges.clear()
+
+        for offset, length, future in self.pending:
+            future.cancel()
+
+        self.executor.shutdown(wait=True)
+        self.pending.clear()
+
+        for client in self.clients:
+            client.close()
+
+        self.clients = []
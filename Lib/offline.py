@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to lock domains shut off while their images are read. Images of a
+domain shut off are read directly, without guest agent, snapshot and
+blockcommit: a lock file is held during backup, and the libvirt qemu hook
+(see hooks/qemu) refuses to start a locked domain
+
+"""
+
+from __future__ import print_function
+
+import fcntl
+import logging
+import os
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# where lock files are placed, one for each domain. The libvirt hook checks
+# the same directory: it can't be configured, since the hook doesn't read
+# the configuration of kvmBackup
+LOCK_DIR = "/var/run/kvmBackup"
+
+
+def getLockPath(domain_name):
+    """Return the lock file of a domain"""
+
+    return os.path.join(LOCK_DIR, domain_name + ".lock")
+
+
+class DomainLock():
+    """An exclusive lock on a domain, taken while its images are read"""
+
+    def __init__(self, domain_name):
+        self.domain_name = domain_name
+        self.path = getLockPath(domain_name)
+        self.handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        """Take the lock. Raise RuntimeError if it is held by someone
+        else"""
+
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        self.handle = open(self.path, "a")
+
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except (IOError, OSError):
+            self.handle.close()
+            self.handle = None
+
+            raise RuntimeError("Domain '%s' is locked by '%s'" % (
+                self.domain_name, self.path))
+
+        logger.debug("Domain '%s' locked by '%s'" % (
+            self.domain_name, self.path))
+
+    def release(self):
+        """Release the lock"""
+
+        if self.handle is None:
+            return
+
+        # lock file is left in place: only its lock matters
+        self.handle.close()
+        self.handle = None
+
+        logger.debug("Domain '%s' unlocked" % (self.domain_name))
+
+
+def isLocked(domain_name):
+    """Return True if a backup holds the lock of domain"""
+
+    try:
+        handle = open(getLockPath(domain_name))
+
+    except (IOError, OSError):
+        return False
+
+    try:
+        fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+    except (IOError, OSError):
+        return True
+
+    finally:
+        handle.close()
+
+    return False
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to read images and write backups without filling the page cache.
+With 'fadvise', files are read and written through the page cache, and
+their pages are dropped with posix_fadvise once used. With 'direct', files
+are read and written with O_DIRECT, using page aligned buffers
+
+"""
+
+from __future__ import print_function
+
+import fcntl
+import logging
+import mmap
+import os
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# how files are read and written
+MODES = ["buffered", "fadvise", "direct"]
+
+# offsets and sizes of O_DIRECT I/O are aligned to this size
+BLOCK_SIZE = 4096
+
+# the size of aligned buffers
+BUFSIZE = 4 * 1024 * 1024
+
+# written pages are synced and dropped every this bytes
+WRITEBACK_SIZE = 64 * 1024 * 1024
+
+
+def setDirect(fd, direct=True):
+    """Set or clear O_DIRECT on an open file"""
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+
+    if direct:
+        flags |= os.O_DIRECT
+
+    else:
+        flags &= ~os.O_DIRECT
+
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+class FileWrapper():
+    """Base class of file objects wrapping an open file"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.fd = handle.fileno()
+
+    def __getattr__(self, name):
+        # everything else is done by the real file
+        return getattr(self.handle, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.handle.close()
+
+
+class AdviseReader(FileWrapper):
+    """Read a file sequentially, and drop pages once read"""
+
+    def __init__(self, handle):
+        FileWrapper.__init__(self, handle)
+
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size=-1):
+        offset = self.handle.tell()
+        data = self.handle.read(size)
+
+        if data:
+            os.posix_fadvise(
+                self.fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+
+        return data
+
+
+class AdviseWriter(FileWrapper):
+    """Write a file, and drop its pages once they are on disk"""
+
+    def __init__(self, handle, writeback_size=WRITEBACK_SIZE):
+        FileWrapper.__init__(self, handle)
+
+        self.writeback_size = writeback_size
+        self.pending = 0
+
+    def __drop(self):
+        # dirty pages can't be dropped
+        self.handle.flush()
+        os.fdatasync(self.fd)
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+        self.pending = 0
+
+    def write(self, data):
+        result = self.handle.write(data)
+        self.pending += len(data)
+
+        if self.pending >= self.writeback_size:
+            self.__drop()
+
+        return result
+
+    def close(self):
+        if not self.handle.closed:
+            self.__drop()
+            self.handle.close()
+
+
+class DirectReader(FileWrapper):
+    """Read a file with O_DIRECT: aligned blocks are read in an aligned
+    buffer, and the requested data are returned"""
+
+    def __init__(self, handle, buffer_size=BUFSIZE):
+        FileWrapper.__init__(self, handle)
+
+        self.position = 0
+
+        setDirect(self.fd)
+
+        # anonymous maps are page aligned
+        self.buffer = mmap.mmap(-1, buffer_size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, os.fstat(self.fd).st_size - self.position)
+
+        chunks = []
+
+        while size > 0:
+            # read whole blocks, and skip what wasn't requested
+            start = self.position - self.position % BLOCK_SIZE
+            skip = self.position - start
+            length = min(len(self.buffer), skip + size)
+            length += (-length) % BLOCK_SIZE
+
+            read = os.preadv(
+                self.fd, [memoryview(self.buffer)[:length]], start)
+
+            if read <= skip:
+                break
+
+            data = self.buffer[skip:min(read, skip + size)]
+
+            chunks += [data]
+            self.position += len(data)
+            size -= len(data)
+
+            # end of file
+            if read < length:
+                break
+
+        return b"".join(chunks)
+
+    def close(self):
+        self.buffer.close()
+        self.handle.close()
+
+
+class DirectWriter(FileWrapper):
+    """Write a file with O_DIRECT: data are collected in an aligned buffer,
+    and written in aligned blocks. Unaligned heads and tails are written
+    without O_DIRECT"""
+
+    def __init__(self, handle, buffer_size=BUFSIZE):
+        FileWrapper.__init__(self, handle)
+
+        # the file offset of buffer start, and the bytes in buffer
+        self.offset = handle.tell()
+        self.used = 0
+
+        setDirect(self.fd)
+        self.direct = True
+
+        self.buffer = mmap.mmap(-1, buffer_size)
+
+    def __write(self, start, end, direct):
+        """Write buffer[start:end] at current offset"""
+
+        if direct != self.direct:
+            setDirect(self.fd, direct)
+            self.direct = direct
+
+        view = memoryview(self.buffer)[start:end]
+
+        while len(view) > 0:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+
+    def __flush(self, final=False):
+        """Write the aligned blocks in buffer, or all data if final"""
+
+        # reach an aligned offset without O_DIRECT
+        head = min((-self.offset) % BLOCK_SIZE, self.used)
+
+        if head > 0:
+            self.__write(0, head, False)
+            self.buffer.move(0, head, self.used - head)
+            self.used -= head
+
+        aligned = self.used - self.used % BLOCK_SIZE
+
+        if aligned > 0:
+            self.__write(0, aligned, True)
+
+        remainder = self.used - aligned
+
+        if remainder > 0 and final:
+            self.__write(aligned, self.used, False)
+            remainder = 0
+
+        elif remainder > 0:
+            self.buffer.move(0, aligned, remainder)
+
+        self.used = remainder
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+
+        while len(view) > 0:
+            size = min(len(view), len(self.buffer) - self.used)
+            self.buffer[self.used:self.used + size] = view[:size]
+            self.used += size
+            view = view[size:]
+
+            if self.used == len(self.buffer):
+                self.__flush()
+
+        return len(data)
+
+    def flush(self):
+        # only whole blocks could be written: data are written on close
+        pass
+
+    def tell(self):
+        return self.offset + self.used
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+
+        elif whence == os.SEEK_END:
+            self.__flush(final=True)
+            offset += os.fstat(self.fd).st_size
+
+        if offset != self.tell():
+            self.__flush(final=True)
+            self.offset = offset
+
+        return offset
+
+    def truncate(self, size=None):
+        self.__flush(final=True)
+
+        if size is None:
+            size = self.offset
+
+        os.ftruncate(self.fd, size)
+
+        return size
+
+    def close(self):
+        if self.handle.closed:
+            return
+
+        self.__flush(final=True)
+        self.buffer.close()
+
+        # file position of handle is the one of data written
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        setDirect(self.fd, False)
+        self.handle.close()
+
+
+def wrap(handle, direction, mode):
+    """Return a file object which reads or writes handle as required by
+    mode. If O_DIRECT is not supported, fadvise is used instead"""
+
+    if mode in [None, "buffered"]:
+        return handle
+
+    if mode == "direct":
+        try:
+            if direction == "read":
+                return DirectReader(handle)
+
+            return DirectWriter(handle)
+
+        except (IOError, OSError) as error:
+            logger.warning("O_DIRECT not supported for '%s' (%s): using "
+                           "fadvise" % (handle.name, error))
+
+    if direction == "read":
+        return AdviseReader(handle)
+
+    return AdviseWriter(handle)
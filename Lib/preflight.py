@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to check every domain before any backup starts. Domains are checked
+at the same time, so a hung guest agent doesn't delay the checks of the
+others. A domain is blocked if it is not running (and offline backups are
+disabled), if its guest agent doesn't reply, if it has a snapshot not
+created by kvmBackup, if an image can't be read or if there's no space for
+its backup: the plan lists the domains ready for backup and why the others
+are blocked
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import helper, metrics, offline, storage
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# how long a guest agent could take to reply (seconds)
+AGENT_TIMEOUT = 30
+
+# how many domains are checked at the same time
+WORKERS = 16
+
+# the bytes read from every image to check it is readable
+READ_SIZE = 4096
+
+
+class Check():
+    """The result of the checks of a domain"""
+
+    def __init__(self, job):
+        self.job = job
+        self.domain_name = job.domain_name
+
+        # why the domain can't be backed up, and what should be known
+        self.problems = []
+        self.warnings = []
+
+        # allocated bytes of images and free bytes in backup target
+        self.allocated = 0
+        self.free = None
+
+        self.seconds = 0
+
+    @property
+    def ready(self):
+        return not self.problems
+
+    def block(self, message):
+        logger.error("Domain '%s' blocked: %s" % (self.domain_name, message))
+        self.problems += [message]
+
+    def warn(self, message):
+        logger.warning("Domain '%s': %s" % (self.domain_name, message))
+        self.warnings += [message]
+
+    def toDict(self):
+        return {
+            "domain": self.domain_name,
+            "ready": self.ready,
+            "problems": self.problems,
+            "warnings": self.warnings,
+            "allocated": self.allocated,
+            "free": self.free,
+            "seconds": self.seconds}
+
+
+def checkAgent(snapshot, check, timeout, allow_offline=True):
+    """Check that domain is running and that its guest agent replies. A
+    domain shut off is read directly, if offline backups are allowed"""
+
+    if not snapshot.domainIsActive():
+        if not allow_offline:
+            check.block("domain is not active")
+
+        elif offline.isLocked(snapshot.domain_name):
+            check.block("domain is locked by another backup")
+
+        else:
+            check.warn("domain is shut off: doing an offline backup")
+
+        return
+
+    if not snapshot.domainHasGuestAgent(timeout=timeout):
+        check.block("guest agent is not responding")
+
+
+def checkSnapshot(snapshot, check):
+    """Check that domain has no snapshot, except the ones left by
+    interrupted backups"""
+
+    if not snapshot.hasCurrentSnapshot():
+        return
+
+    orphan = snapshot.getOrphanSnapshot()
+
+    if orphan is None:
+        check.block("domain has already a snapshot")
+
+    elif not snapshot.domainIsActive():
+        check.block("snapshot %s of an interrupted backup can't be "
+                    "recovered while domain is shut off" % (orphan["name"]))
+
+    else:
+        check.warn("snapshot %s of an interrupted backup will be "
+                   "recovered" % (orphan["name"]))
+
+
+def checkImages(snapshot, check):
+    """Check that every image could be read, and sum their allocated
+    bytes"""
+
+    for disk, source in iter(snapshot.getDisks().items()):
+        try:
+            with open(source, "rb") as handle:
+                handle.read(READ_SIZE)
+
+                check.allocated += os.fstat(handle.fileno()).st_blocks * 512
+
+        except (IOError, OSError) as error:
+            check.block("cannot read image of %s: %s" % (disk, error))
+
+
+def checkSpace(check):
+    """Check the free space in a local backup target. Staged backups copy
+    images before compressing them, so their allocated size is needed.
+    Other modes write compressed archives or new chunks only"""
+
+    backupdir = check.job.backupdir
+
+    if not storage.isLocal(backupdir):
+        return
+
+    stat = os.statvfs(backupdir)
+    check.free = stat.f_bavail * stat.f_frsize
+
+    if check.free >= check.allocated:
+        return
+
+    message = "%.1f GB of images, %.1f GB free in '%s'" % (
+        check.allocated / 1024.0 ** 3, check.free / 1024.0 ** 3, backupdir)
+
+    if check.job.parameters.get("mode", "staged") == "staged":
+        check.block(message)
+
+    else:
+        check.warn(message)
+
+
+def checkDomain(job):
+    """Do all the checks of a domain. Return a Check"""
+
+    check = Check(job)
+    parameters = job.parameters
+
+    with metrics.collector.phase(job.domain_name, "preflight") as phase:
+        try:
+            snapshot = helper.Snapshot(
+                job.domain_name,
+                overlay_dir=parameters.get("overlay_dir", helper.OVERLAY_DIR))
+
+            # domain could be changed since its XML was cached
+            snapshot.manager.invalidate(job.domain_name)
+
+            checkAgent(snapshot, check, parameters.get(
+                "agent_timeout", AGENT_TIMEOUT),
+                allow_offline=parameters.get("offline", True))
+            checkSnapshot(snapshot, check)
+            checkImages(snapshot, check)
+
+            if check.ready:
+                checkSpace(check)
+
+        except Exception as message:
+            logger.exception(message)
+            check.block("checks failed: %s" % (message))
+
+        if not check.ready:
+            phase.status = "blocked"
+
+    check.seconds = phase.seconds
+
+    return check
+
+
+def checkTargets(checks):
+    """Warn if the domains ready for backup in the same target need more
+    than the space available"""
+
+    targets = {}
+
+    for check in checks:
+        if check.ready and check.free is not None:
+            targets.setdefault(check.job.backupdir, []).append(check)
+
+    for backupdir, target_checks in iter(targets.items()):
+        allocated = sum([check.allocated for check in target_checks])
+        free = min([check.free for check in target_checks])
+
+        if allocated > free:
+            logger.warning(
+                "Domains to backup in '%s' have %.1f GB of images, %.1f GB "
+                "free" % (backupdir, allocated / 1024.0 ** 3,
+                          free / 1024.0 ** 3))
+
+
+def run(jobs, workers=WORKERS):
+    """Check all the domains of jobs at the same time. Return the checks in
+    the order of jobs"""
+
+    if not jobs:
+        return []
+
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        checks = list(executor.map(checkDomain, jobs))
+
+    checkTargets(checks)
+
+    ready = [check for check in checks if check.ready]
+
+    logger.info("Pre-flight done in %.1fs: %s domains ready, %s blocked" % (
+        time.time() - start, len(ready), len(checks) - len(ready)))
+
+    for check in checks:
+        if check.ready:
+            logger.info("Ready: '%s'" % (check.domain_name))
+
+        else:
+            logger.info("Blocked: '%s' (%s)" % (
+                check.domain_name, "; ".join(check.problems)))
+
+    return checks
@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to restore domains from archives (staged, stream and indexed) and
+from chunk store manifests. Images are written directly in their
+destination, with holes. Disks of indexed archives and of manifests are
+restored in parallel. An incremental backup is restored by restoring the
+full backup it is chained to, then by writing the blocks changed in every
+incremental backup. Archives could be read from remote storages too.
+Raw images read by backup jobs are converted back to the format of the
+original images, when they are restored in their original paths
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# To inspect xml
+import xml.etree.ElementTree as ET
+
+from . import (archive, checksum, chunkstore, compression, connection, helper,
+               incremental, retention, sparse, storage)
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+
+def findBackup(backupdir, domain_name, generation=0, parameters=None):
+    """Return the path (or the url, if backupdir is remote) of a backup
+    generation of a domain: 0 is the last backup, 1 the previous one and
+    so on. Storage options are read from domain parameters"""
+
+    backend = storage.getStorage(backupdir, parameters)
+
+    try:
+        generations = retention.listGenerations(backend, domain_name)
+
+        # generations are sorted newest first
+        if generation >= len(generations):
+            raise Exception("Cannot find backup %s of '%s' in '%s'" % (
+                generation, domain_name, backend.getURL(domain_name)))
+
+        return backend.getURL("/".join(
+            [domain_name, generations[generation]["name"]]))
+
+    finally:
+        backend.close()
+
+
+def convertImage(path, image_format):
+    """Convert the raw image in path to image_format with qemu-img. The
+    converted image replaces the raw one"""
+
+    partial = path + ".part"
+    cmds = ["qemu-img", "convert", "-f", "raw", "-O", image_format, path,
+            partial]
+
+    logger.debug("Executing: %s" % (" ".join(cmds)))
+
+    process = subprocess.Popen(
+        cmds,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        preexec_fn=helper.preexec_fn,
+        shell=False)
+
+    stdout, stderr = process.communicate()
+
+    if process.returncode != 0:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+        logger.error("Error for %s:%s" % (cmds, stderr))
+        raise Exception("%s didn't work properly" % (cmds[0]))
+
+    shutil.copymode(path, partial)
+    os.rename(partial, path)
+
+
+class Restore():
+    """Restore images and XMLs of a domain from a backup"""
+
+    def __init__(self, path, dest=None, workers=4, force=False,
+                 parameters=None, convert=True):
+        """Restore the backup in path, a local path or the url of a remote
+        storage configured by parameters. Images are placed in dest
+        directory, or in their original paths if dest is None. Existing
+        images are overwritten only if force is True. Raw images restored
+        in their original paths are converted to the original format,
+        unless convert is False"""
+
+        self.path = path
+        self.dest = dest
+        self.workers = workers
+        self.force = force
+        self.convert = convert
+
+        # the XMLs found in backup, by file name
+        self.xmls = {}
+
+        # the original path and the restored path of every image
+        self.images = {}
+
+        # images of incremental backups are raw guest views
+        self.raw = False
+
+        # images written in partial files, which will replace their targets
+        self.partials = {}
+
+        # the storage of backup, and the name of backup in it
+        self.backend, self.name = storage.getStorageByPath(path, parameters)
+
+    def checkLocal(self):
+        """Chunk stores are read only from a local directory"""
+
+        if not self.backend.isLocal():
+            raise Exception(
+                "'%s' could be restored only from a local directory: please "
+                "download it first" % (self.path))
+
+    def getTarget(self, name, source=None):
+        """Return where an image need to be written"""
+
+        if self.dest is not None:
+            return os.path.join(self.dest, os.path.basename(name))
+
+        if source is None:
+            raise Exception(
+                "Cannot determine original path of '%s': please specify a "
+                "destination directory" % (name))
+
+        return source
+
+    def needConvert(self):
+        """Return True if raw images will be converted once restored. Check
+        that qemu-img is available"""
+
+        if not self.raw or not self.convert or self.dest is not None:
+            return False
+
+        if shutil.which("qemu-img") is None:
+            raise Exception(
+                "'%s' has raw images, and qemu-img is needed to convert them "
+                "in their original paths: restore them with a destination "
+                "directory, or define domain from archive" % (self.path))
+
+        return True
+
+    def checkTarget(self, target):
+        """Check if target could be written, and create its directory"""
+
+        if os.path.exists(target) and not self.force:
+            raise Exception("'%s' exists: won't overwrite it" % (target))
+
+        dirname = os.path.dirname(target)
+
+        if dirname and not os.path.exists(dirname):
+            logger.info("Creating directory '%s'" % (dirname))
+
+            try:
+                os.makedirs(dirname)
+
+            except OSError:
+                # created by another thread
+                if not os.path.isdir(dirname):
+                    raise
+
+    def getSources(self):
+        """Return the original image paths, by image file name, from the
+        inactive domain XML"""
+
+        for name, xml in iter(self.xmls.items()):
+            if name.endswith("-inactive.xml"):
+                disks = helper.parseDisks(ET.fromstring(xml))
+
+                return dict([(os.path.basename(source), source)
+                             for source in disks.values()])
+
+        return {}
+
+    def getFormats(self):
+        """Return the formats of the original images, by image file name,
+        from the inactive domain XML"""
+
+        formats = {}
+
+        for name, xml in iter(self.xmls.items()):
+            if not name.endswith("-inactive.xml"):
+                continue
+
+            root = ET.fromstring(xml)
+
+            for disk in root.findall("./devices/disk[@device='disk']"):
+                source, driver = disk.find("source"), disk.find("driver")
+
+                if source is None or driver is None:
+                    continue
+
+                formats[os.path.basename(source.get("file", ""))] = \
+                    driver.get("type", "raw")
+
+        return formats
+
+    def convertImages(self, paths=None):
+        """Convert raw images (the restored ones, or the files in paths by
+        image name) to the format of the original images, which are still
+        used by the domain definition"""
+
+        formats = self.getFormats()
+
+        if paths is None:
+            paths = self.images
+
+        for name, target in sorted(paths.items()):
+            image_format = formats.get(os.path.basename(name), "raw")
+
+            if image_format == "raw":
+                continue
+
+            logger.info("Converting '%s' to %s" % (target, image_format))
+            convertImage(target, image_format)
+
+        # restored images have the formats of the domain XML
+        self.raw = False
+
+    def writeImage(self, source, name, size, mode=None, mtime=None,
+                   replace=True):
+        """Write an image from the file object source. Return the path of
+        restored image. If replace is False, image is left in a partial
+        file, which will replace the restored image (see replaceImages)"""
+
+        target = self.getTarget(name, self.getSources().get(
+            os.path.basename(name)))
+
+        self.checkTarget(target)
+
+        logger.info("Restoring '%s' in '%s'" % (name, target))
+
+        # write in a temporary file, and replace target only at the end
+        partial = target + ".part"
+        start = time.time()
+
+        with open(partial, "wb") as handle:
+            written = sparse.writeFile(source, handle, size)
+
+        if mode is not None:
+            os.chmod(partial, mode)
+
+        if mtime is not None:
+            os.utime(partial, (mtime, mtime))
+
+        if replace:
+            os.rename(partial, target)
+
+        else:
+            self.partials[name] = partial
+
+        elapsed = max(time.time() - start, 1e-6)
+
+        logger.info("'%s' restored in %.1fs (%.1f MB/s, %s bytes written)" % (
+            target, elapsed, size / elapsed / 1024 ** 2, written))
+
+        self.images[name] = target
+
+        return target
+
+    def replaceImages(self):
+        """Replace the restored images with their partial files. Raw images
+        are converted before, so that original images are replaced only
+        by images of their format"""
+
+        try:
+            if self.partials and self.needConvert():
+                self.convertImages(self.partials)
+
+            for name, partial in sorted(self.partials.items()):
+                os.rename(partial, self.images[name])
+
+        finally:
+            self.removePartials()
+
+    def removePartials(self):
+        """Remove the partial files not moved to their targets"""
+
+        for partial in self.partials.values():
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self.partials = {}
+
+    def restoreIndexed(self):
+        """Restore an indexed archive: images are restored in parallel, and
+        frames of every image are decompressed in parallel"""
+
+        reader = archive.IndexedReader(self.name, self.backend)
+
+        images = []
+
+        for member in reader.getMembers():
+            if member["name"].endswith(".xml"):
+                self.xmls[os.path.basename(member["name"])] = reader.read(
+                    member["name"]).decode("utf-8")
+
+            elif member["name"].endswith(checksum.CHECKSUM_SUFFIX):
+                continue
+
+            # disks read from a backup job are raw guest views
+            elif member["name"].endswith(incremental.INFO_SUFFIX):
+                self.raw = True
+
+            else:
+                images += [member["name"]]
+
+        # don't overwrite original images which can't be converted
+        self.needConvert()
+
+        def restoreMember(name, executor):
+            frames = reader.getReader(
+                name, executor=executor, prefetch=self.workers + 1)
+
+            try:
+                tar = tarfile.open(fileobj=frames, mode="r|")
+                tarinfo = tar.next()
+
+                target = self.writeImage(
+                    tar.extractfile(tarinfo), name, tarinfo.size,
+                    tarinfo.mode, tarinfo.mtime)
+
+                tar.close()
+
+            finally:
+                frames.close()
+
+            return target
+
+        # a pool for images, and another for frames: images wait for frames
+        with ThreadPoolExecutor(max_workers=self.workers) as frames, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(restoreMember, name, frames)
+                       for name in images]
+
+            for future in futures:
+                future.result()
+
+    def applyImage(self, source, name, tarinfo):
+        """Write the blocks changed in an image, read from the file object
+        source, on the restored image"""
+
+        targets = dict([(os.path.basename(key), target)
+                        for key, target in iter(self.images.items())])
+
+        if os.path.basename(name) not in targets:
+            raise Exception("'%s' is not in the backups restored" % (name))
+
+        target = targets[os.path.basename(name)]
+
+        # only the changed blocks are in a sparse member
+        extents = tarinfo.sparse or [(0, tarinfo.size)]
+        written = 0
+
+        logger.info("Applying '%s' on '%s'" % (name, target))
+
+        with open(target, "r+b") as handle:
+            for offset, length in extents:
+                source.seek(offset)
+                handle.seek(offset)
+
+                while length > 0:
+                    data = source.read(min(sparse.BUFSIZE, length))
+
+                    if not data:
+                        raise IOError("Unexpected end of '%s'" % (name))
+
+                    handle.write(data)
+                    length -= len(data)
+                    written += len(data)
+
+            # disk could be resized
+            handle.truncate(tarinfo.size)
+
+        logger.info("%s bytes written in '%s'" % (written, target))
+
+    def restoreArchive(self, name=None, apply=False):
+        """Restore a tar archive, named name in the storage of backup.
+        Archive is read sequentially, while it is decompressed by another
+        process. If apply is True, images are the blocks changed since the
+        archives already restored"""
+
+        name = name or self.name
+        path = self.backend.getURL(name)
+        compressor = compression.getCompressorByPath(name)
+
+        logger.debug("Decompressing '%s' with %s" % (path, compressor))
+        reader = compressor.openReader(path, self.backend.open(name, "rb"))
+
+        # images of backup jobs are known to be raw by a member written
+        # after them: original images are replaced once the whole archive
+        # is read, and raw images could be converted (or refused) before
+        replace = self.dest is not None or self.raw
+
+        try:
+            tar = tarfile.open(
+                fileobj=reader, mode="r|", bufsize=archive.BUFSIZE)
+
+            for tarinfo in tar:
+                name = tarinfo.name
+
+                if name.endswith(".xml"):
+                    self.xmls[os.path.basename(name)] = tar.extractfile(
+                        tarinfo).read().decode("utf-8")
+
+                elif name.endswith(checksum.CHECKSUM_SUFFIX):
+                    continue
+
+                # images of incremental mode were read by a backup job
+                elif name.endswith(incremental.INFO_SUFFIX):
+                    self.raw = True
+
+                elif tarinfo.isfile() and apply:
+                    # buffered member can't seek in a tar stream, while its
+                    # raw file seeks forward
+                    self.applyImage(
+                        tar.extractfile(tarinfo).raw, name, tarinfo)
+
+                elif tarinfo.isfile():
+                    # XMLs are the first members
+                    self.writeImage(
+                        tar.extractfile(tarinfo), name, tarinfo.size,
+                        tarinfo.mode, tarinfo.mtime, replace=replace)
+
+            tar.close()
+
+            self.replaceImages()
+
+        finally:
+            reader.close()
+            self.removePartials()
+
+    def restoreChain(self):
+        """Restore an incremental backup: the full backup it is chained to
+        is restored, then every incremental backup is applied in order"""
+
+        # images read by backup jobs are raw
+        self.raw = True
+        self.needConvert()
+
+        # backups are in the directory of domain
+        domain_name, backup_name = self.name.split("/")
+
+        chain = incremental.getChain(
+            retention.listGenerations(self.backend, domain_name),
+            backup_name)
+
+        for index, item in enumerate(chain):
+            name = "/".join([domain_name, item["name"]])
+
+            logger.info("Restoring %s of %s: '%s'" % (
+                index + 1, len(chain), self.backend.getURL(name)))
+
+            self.restoreArchive(name, apply=index > 0)
+
+    def restoreManifest(self):
+        """Restore images from a chunk store: images are restored in
+        parallel, and chunks of every image are decompressed in parallel"""
+
+        self.checkLocal()
+
+        manifest = chunkstore.readManifest(self.path)
+        self.xmls = manifest["xmls"]
+
+        # the chunk store is in backupdir
+        backupdir = os.path.dirname(os.path.dirname(
+            os.path.abspath(self.path)))
+        store = chunkstore.ChunkStore(backupdir, workers=self.workers)
+
+        def restoreDisk(disk):
+            target = self.getTarget(disk["name"], disk["source"])
+
+            self.checkTarget(target)
+
+            logger.info("Restoring '%s' in '%s'" % (disk["name"], target))
+
+            partial = target + ".part"
+            store.restoreFile(disk, partial)
+            os.rename(partial, target)
+
+            self.images[disk["name"]] = target
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(restoreDisk, disk)
+                       for disk in manifest["disks"]]
+
+            for future in futures:
+                future.result()
+
+    def run(self):
+        """Restore all images. Return the restored images, by name"""
+
+        logger.info("Restoring '%s'" % (self.path))
+
+        try:
+            # manifests are named by date, or end with their rotation number
+            if chunkstore.MANIFEST_EXT in os.path.basename(self.name):
+                self.restoreManifest()
+
+            # incremental archives have a previous extension
+            elif retention.INCREMENTAL_EXT + ".tar" in os.path.basename(
+                    self.name):
+                self.restoreChain()
+
+            elif archive.isIndexed(self.name, self.backend):
+                self.restoreIndexed()
+
+            else:
+                self.restoreArchive()
+
+        finally:
+            self.backend.close()
+
+        if self.needConvert():
+            self.convertImages()
+
+        return self.images
+
+    def getDomainXML(self):
+        """Return the inactive XML of the domain, with the paths of restored
+        images"""
+
+        [xml] = [xml for name, xml in iter(self.xmls.items())
+                 if name.endswith("-inactive.xml")]
+
+        root = ET.fromstring(xml)
+        targets = dict([(os.path.basename(name), target)
+                        for name, target in iter(self.images.items())])
+
+        for disk in root.findall("./devices/disk[@device='disk']"):
+            source = disk.find("source")
+
+            if source is None:
+                continue
+
+            name = os.path.basename(source.get("file", ""))
+
+            if name not in targets:
+                continue
+
+            source.set("file", targets[name])
+
+            # disks were read by a backup job
+            driver = disk.find("driver")
+
+            if self.raw and driver is not None:
+                driver.set("type", "raw")
+
+        return ET.tostring(root, encoding="unicode")
+
+    def defineDomain(self):
+        """Define the domain from its archived XML"""
+
+        xml = self.getDomainXML()
+
+        logger.info("Defining domain from '%s'" % (self.path))
+
+        return connection.getManager().getConnection().defineXML(xml)
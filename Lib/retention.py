@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to name backup generations by date, and to remove the ones no more
+needed. Every backup is written in a new file, like
+<domain>.20220131T230000.tar.gz, which is never renamed. A retention policy
+keeps the last backups, and the last backup of some days, weeks and months
+(grandfather-father-son): the other generations are deleted. Incremental
+backups (<domain>.20220131T230000.inc.tar.gz) are kept with the backups they
+are chained to. Archives rotated by number (<domain>.tar.gz.1) are older
+than any dated generation
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import logging
+import re
+
+from . import chunkstore, compression
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the date of a generation, in its name
+STAMP_FORMAT = "%Y%m%dT%H%M%S"
+STAMP_PATTERN = r"[0-9]{8}T[0-9]{6}"
+
+# incremental archives have this extension before the archive one
+INCREMENTAL_EXT = ".inc"
+
+# the rules of a retention policy
+RULES = ["keep_last", "keep_daily", "keep_weekly", "keep_monthly"]
+
+# how generations are grouped by daily, weekly and monthly rules
+PERIODS = [
+    ("keep_daily", lambda date: date.date()),
+    ("keep_weekly", lambda date: date.isocalendar()[:2]),
+    ("keep_monthly", lambda date: (date.year, date.month))]
+
+
+def getExtensions():
+    """Return the extensions of archives, incremental archives and
+    manifests"""
+
+    extensions = [".tar" + compressor.extension
+                  for compressor in compression.COMPRESSORS.values()]
+
+    incrementals = [INCREMENTAL_EXT + extension for extension in extensions]
+
+    return incrementals + extensions + [chunkstore.MANIFEST_EXT]
+
+
+def getName(domain_name, extension, date):
+    """Return the file name of a generation written at date"""
+
+    return "%s.%s%s" % (domain_name, date.strftime(STAMP_FORMAT), extension)
+
+
+def getDate(generations, date):
+    """Return the date of a new generation. Generations are never
+    overwritten: a later second is used if date is already taken"""
+
+    date = date.replace(microsecond=0)
+    taken = set([item["date"] for item in generations])
+
+    while date in taken:
+        date += datetime.timedelta(seconds=1)
+
+    return date
+
+
+def parseName(domain_name, name):
+    """Return a dictionary describing a generation from its file name, or
+    None if name is not a backup of domain"""
+
+    for extension in getExtensions():
+        match = re.match("%s\\.(%s)%s$" % (
+            re.escape(domain_name), STAMP_PATTERN, re.escape(extension)),
+            name)
+
+        if match:
+            return {
+                "name": name,
+                "date": datetime.datetime.strptime(
+                    match.group(1), STAMP_FORMAT),
+                "number": None,
+                "incremental": extension.startswith(INCREMENTAL_EXT)}
+
+        # generations rotated by number
+        match = re.match("%s(\\.([0-9]+))?$" % (
+            re.escape(domain_name + extension)), name)
+
+        if match:
+            return {
+                "name": name,
+                "date": None,
+                "number": int(match.group(2) or 0),
+                "incremental": False}
+
+    return None
+
+
+def listGenerations(backend, domain_name):
+    """Return the generations of a domain in storage, newest first"""
+
+    try:
+        names = backend.list(domain_name)
+
+    except (IOError, OSError):
+        return []
+
+    generations = [parseName(domain_name, name) for name in names]
+    generations = [item for item in generations if item is not None]
+
+    dated = sorted([item for item in generations if item["date"]],
+                   key=lambda item: item["date"], reverse=True)
+
+    numbered = sorted([item for item in generations if not item["date"]],
+                      key=lambda item: item["number"])
+
+    return dated + numbered
+
+
+def getPolicy(parameters):
+    """Return the retention policy of a domain. Without a 'retention'
+    section, the last 'rotate' generations are kept"""
+
+    policy = parameters.get("retention")
+
+    if policy is None:
+        return {"keep_last": parameters.get("rotate", 3)}
+
+    for rule, value in iter(policy.items()):
+        if rule not in RULES:
+            raise RuntimeError("Unknown retention rule '%s'" % (rule))
+
+        if not isinstance(value, int) or value < 0:
+            raise RuntimeError(
+                "Retention rule '%s' needs a positive number" % (rule))
+
+    return policy
+
+
+def selectGenerations(generations, policy):
+    """Return the names of the generations kept by policy. generations are
+    sorted newest first"""
+
+    keep = set([item["name"] for item in
+                generations[:policy.get("keep_last", 0)]])
+
+    # the newest generation of every period, for the last periods
+    for rule, getPeriod in PERIODS:
+        periods = set()
+
+        for item in generations:
+            if len(periods) >= policy.get(rule, 0):
+                break
+
+            if item["date"] is None:
+                continue
+
+            period = getPeriod(item["date"])
+
+            if period not in periods:
+                periods.add(period)
+                keep.add(item["name"])
+
+    # the last backup is never removed
+    if generations:
+        keep.add(generations[0]["name"])
+
+    # an incremental backup needs the older ones, up to a full backup
+    for index, item in enumerate(generations):
+        if item["name"] not in keep or not item["incremental"]:
+            continue
+
+        for older in generations[index + 1:]:
+            keep.add(older["name"])
+
+            if not older["incremental"]:
+                break
+
+    return keep
+
+
+def applyPolicy(backend, domain_name, policy):
+    """Remove the generations of a domain not kept by policy. Return the
+    names of removed files"""
+
+    generations = listGenerations(backend, domain_name)
+    keep = selectGenerations(generations, policy)
+
+    removed = []
+
+    for item in generations:
+        if item["name"] in keep:
+            continue
+
+        path = "/".join([domain_name, item["name"]])
+
+        logger.info("Removing expired backup '%s'" % (backend.getURL(path)))
+        backend.remove(path)
+
+        removed += [item["name"]]
+
+    return removed
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to run backup of many domains at the same time, with a limited
+number of workers per host and per backup target. Jobs could be submitted
+while workers are running, like the daemon does
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import threading
+import time
+
+from . import helper
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+
+class Job():
+    """A domain to backup in a backup target"""
+
+    def __init__(self, domain_name, parameters, backupdir):
+        self.domain_name = domain_name
+        self.parameters = parameters
+        self.backupdir = backupdir
+        self.size = 0
+        self.error = None
+
+        # how long the backup took
+        self.seconds = 0
+
+        # jobs with the earliest deadline start first, if any
+        self.deadline = None
+
+        # pause or cancel a running backup (see throttle.Control)
+        self.control = None
+
+    def getKey(self):
+        """The order of pending jobs: jobs with a deadline, the earliest
+        first, then bigger jobs first"""
+
+        if self.deadline is None:
+            return (1, 0, -self.size)
+
+        return (0, self.deadline, -self.size)
+
+    def getSize(self):
+        """Get the size in bytes of all the domain disks"""
+
+        try:
+            disks = helper.Snapshot(self.domain_name).getDisks()
+
+            self.size = sum(
+                [os.path.getsize(source) for source in disks.values()])
+
+        except Exception as message:
+            logger.warning(
+                "Cannot determine disks size for '%s': %s" % (
+                    self.domain_name, message))
+            self.size = 0
+
+        return self.size
+
+
+class Scheduler():
+    """Run backup jobs with a pool of workers. At most 'workers' jobs run
+    at the same time, and at most 'target_workers' write in the same backup
+    target. Bigger domains are started first"""
+
+    def __init__(self, function, workers=1, target_workers=None,
+                 callback=None):
+        """function will be called as function(domain_name, parameters,
+        backupdir) for each job, and callback(job) once job is terminated"""
+
+        self.function = function
+        self.callback = callback
+        self.workers = max(1, workers)
+
+        if target_workers is None:
+            target_workers = self.workers
+
+        self.target_workers = max(1, target_workers)
+
+        self.pending = []
+        self.running = {}
+        self.condition = threading.Condition()
+
+        # workers stop when there are no more jobs and no more could come
+        self.closed = False
+        self.threads = []
+
+    def __nextJob(self):
+        """Get the first pending job with a free backup target. Return
+        None when there are no more jobs. Need to be called with condition
+        acquired"""
+
+        while self.pending or not self.closed:
+            for job in self.pending:
+                running = self.running.get(job.backupdir, 0)
+
+                if running < self.target_workers:
+                    self.pending.remove(job)
+                    self.running[job.backupdir] = running + 1
+                    return job
+
+            # all targets are busy (or no jobs were submitted): wait for a
+            # job to finish or to be submitted
+            self.condition.wait()
+
+        return None
+
+    def __worker(self):
+        """Do jobs until there are pending jobs"""
+
+        while True:
+            with self.condition:
+                job = self.__nextJob()
+
+            if job is None:
+                break
+
+            logger.info("Starting backup of '%s' (%.1f GB)" % (
+                job.domain_name, job.size / 1024.0 ** 3))
+
+            start = time.time()
+
+            # one domain failure must not stop the others
+            try:
+                self.function(job.domain_name, job.parameters, job.backupdir)
+
+            except Exception as message:
+                logger.exception(message)
+                logger.error("Domain '%s' was not backed up" % (
+                    job.domain_name))
+                job.error = message
+
+            job.seconds = time.time() - start
+
+            with self.condition:
+                self.running[job.backupdir] -= 1
+                self.condition.notify_all()
+
+            if self.callback is not None:
+                self.callback(job)
+
+    def start(self, workers=None):
+        """Start workers (all of them by default)"""
+
+        if workers is None:
+            workers = self.workers
+
+        for i in range(min(self.workers, workers)):
+            thread = threading.Thread(
+                target=self.__worker, name="worker-%s" % (i))
+            thread.daemon = True
+            thread.start()
+            self.threads += [thread]
+
+    def submit(self, job):
+        """Add a job to pending jobs"""
+
+        with self.condition:
+            self.pending += [job]
+
+            # largest first (or earliest deadline first), in order to
+            # finish the longest backup as soon as possible
+            self.pending.sort(key=lambda job: job.getKey())
+            self.condition.notify_all()
+
+    def remove(self, job):
+        """Remove a pending job. Return False if it is not pending"""
+
+        with self.condition:
+            if job not in self.pending:
+                return False
+
+            self.pending.remove(job)
+
+            return True
+
+    def close(self):
+        """No more jobs will be submitted: workers stop once pending jobs
+        are done"""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def join(self):
+        """Wait for workers termination"""
+
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, jobs):
+        """Run all jobs and wait for their termination. Return the jobs in
+        the order they were scheduled"""
+
+        for job in jobs:
+            job.getSize()
+
+        scheduled = sorted(jobs, key=lambda job: job.getKey())
+
+        self.start(workers=len(jobs))
+
+        for job in scheduled:
+            self.submit(job)
+
+        self.close()
+        self.join()
+
+        return scheduled
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to read only the allocated extents of thin provisioned images,
+and to write them as GNU sparse tar members (format 1.0). Restored images
+are written with holes. Images are copied with the fastest method available:
+a reflink on filesystems sharing extents (like XFS and btrfs), an in-kernel
+copy_file_range, or a buffered copy
+
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tarfile
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the size of buffers used to read images
+BUFSIZE = 4 * 1024 * 1024
+
+# blocks of zeros of this size are not written when restoring images
+ZERO_BLOCK = 64 * 1024
+
+# how images could be copied, fastest first
+COPY_METHODS = ["reflink", "copy_file_range", "buffered"]
+
+# the ioctl sharing the extents of a file with another one (linux/fs.h)
+FICLONE = 0x40049409
+
+# a copy method failing with these errors is not supported: the next one is
+# tried
+UNSUPPORTED = [errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS, errno.EBADF]
+
+
+def getExtents(handle, size=None):
+    """Return a list of (offset, length) of allocated data in a file,
+    using SEEK_DATA and SEEK_HOLE. If the filesystem doesn't support them,
+    the whole file is returned as a single extent"""
+
+    fd = handle.fileno()
+
+    if size is None:
+        size = os.fstat(fd).st_size
+
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+
+    extents = []
+    offset = 0
+
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+
+        except OSError as error:
+            # ENXIO: there are no more data after offset
+            if error.errno == errno.ENXIO:
+                break
+
+            # SEEK_DATA is not supported by this filesystem
+            logger.debug("SEEK_DATA not supported for '%s': %s" % (
+                handle.name, error))
+            return [(0, size)]
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+
+        extents += [(start, end - start)]
+        offset = end
+
+    # restore file position
+    os.lseek(fd, 0, os.SEEK_SET)
+
+    return extents
+
+
+def isSparse(extents, size):
+    """Return True if extents don't cover the whole file"""
+
+    return sum([length for offset, length in extents]) < size
+
+
+def copyFile(source, dest, throttle=None):
+    """Copy source in dest reading only allocated extents. Holes are kept
+    in destination file, and file metadata are copied like shutil.copy2.
+    Reads and writes are limited by throttle, if any"""
+
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        if throttle is not None:
+            src, dst = throttle.reader(src), throttle.writer(dst)
+
+        size = os.fstat(src.fileno()).st_size
+        extents = getExtents(src, size)
+
+        for offset, length in extents:
+            src.seek(offset)
+            dst.seek(offset)
+
+            while length > 0:
+                data = src.read(min(BUFSIZE, length))
+
+                if not data:
+                    raise IOError("Unexpected end of file in '%s'" % (
+                        source))
+
+                dst.write(data)
+                length -= len(data)
+
+        # a file could end with a hole
+        dst.truncate(size)
+
+        # write what is buffered by throttle, if any
+        dst.close()
+
+    shutil.copystat(source, dest)
+
+    return extents
+
+
+def copyRanges(src, dst, extents, size, throttle=None):
+    """Copy extents from the open file src to dst with copy_file_range:
+    data are copied in kernel, and shared by filesystems supporting it.
+    Holes are kept. Reads and writes are limited by throttle, if any"""
+
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+    for offset, length in extents:
+        while length > 0:
+            count = min(BUFSIZE, length)
+
+            if throttle is not None:
+                throttle.consume("read", count)
+
+            copied = os.copy_file_range(
+                src.fileno(), dst.fileno(), count, offset, offset)
+
+            if copied == 0:
+                raise IOError("Unexpected end of file in '%s'" % (src.name))
+
+            if throttle is not None:
+                throttle.consume("write", copied)
+
+            offset += copied
+            length -= copied
+
+    # a file could end with a hole
+    os.ftruncate(dst.fileno(), size)
+
+
+def copyImage(source, dest, sparse=True, throttle=None, method="auto"):
+    """Copy source in dest like shutil.copy2, trying the methods of
+    COPY_METHODS from method on ('auto' tries all of them). Only allocated
+    extents are copied if sparse is True. Return the bytes of data copied
+    and the method used"""
+
+    if method == "auto":
+        methods = COPY_METHODS
+
+    elif method in COPY_METHODS:
+        methods = COPY_METHODS[COPY_METHODS.index(method):]
+
+    else:
+        raise RuntimeError("Unknown copy method '%s'" % (method))
+
+    # kernel copies use page cache
+    if throttle is not None and throttle.io_mode != "buffered":
+        methods = [item for item in methods if item != "copy_file_range"]
+
+    with open(source, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        extents = getExtents(src, size) if sparse else [(0, size)]
+
+        for name in methods:
+            if name == "buffered":
+                break
+
+            try:
+                with open(dest, "wb") as dst:
+                    if name == "reflink":
+                        # data are shared, not copied
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+                    else:
+                        copyRanges(src, dst, extents, size, throttle)
+
+            except (IOError, OSError) as error:
+                if error.errno not in UNSUPPORTED:
+                    raise
+
+                logger.debug("Cannot copy '%s' with %s: %s" % (
+                    source, name, error))
+                continue
+
+            shutil.copystat(source, dest)
+
+            return sum([length for offset, length in extents]), name
+
+    # the buffered copy
+    if sparse:
+        extents = copyFile(source, dest, throttle=throttle)
+
+    elif throttle is not None and throttle.isActive():
+        with throttle.open(source, "rb") as src, \
+                throttle.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst, BUFSIZE)
+
+        shutil.copystat(source, dest)
+
+    else:
+        shutil.copy2(source, dest)
+
+    return sum([length for offset, length in extents]), "buffered"
+
+
+def writeFile(source, dest, size=None):
+    """Copy the file object source in the open file dest, skipping blocks
+    of zeros which become holes. Return the bytes written"""
+
+    zeros = bytes(ZERO_BLOCK)
+    written = 0
+
+    while True:
+        data = source.read(BUFSIZE)
+
+        if not data:
+            break
+
+        for start in range(0, len(data), ZERO_BLOCK):
+            block = data[start:start + ZERO_BLOCK]
+
+            if block == zeros[:len(block)]:
+                dest.seek(len(block), os.SEEK_CUR)
+
+            else:
+                dest.write(block)
+                written += len(block)
+
+    # a file could end with a hole
+    dest.truncate(dest.tell() if size is None else size)
+
+    return written
+
+
+class SparseReader():
+    """A file like object which returns the GNU sparse 1.0 map followed by
+    the allocated extents of a file, as expected by tarfile.addfile"""
+
+    def __init__(self, handle, extents, size, checksum=None):
+        self.handle = handle
+        self.extents = list(extents)
+        self.checksum = checksum
+
+        # GNU tar requires the map to end at the file size
+        if not self.extents or sum(self.extents[-1]) < size:
+            self.extents += [(size, 0)]
+
+        # the sparse map: number of entries, then offset and size of every
+        # extent, one per line and padded to tar blocks
+        lines = [str(len(self.extents))]
+
+        for offset, length in self.extents:
+            lines += [str(offset), str(length)]
+
+        sparse_map = ("\n".join(lines) + "\n").encode("ascii")
+        blocks, remainder = divmod(len(sparse_map), tarfile.BLOCKSIZE)
+
+        if remainder > 0:
+            sparse_map += tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+        self.buffer = sparse_map
+        self.map_size = len(sparse_map)
+        self.data_size = sum([length for offset, length in self.extents])
+        self.current = 0
+
+    @property
+    def size(self):
+        """The size of tar member data"""
+
+        return self.map_size + self.data_size
+
+    def read(self, size):
+        """Read size bytes from map and extents"""
+
+        chunks = []
+
+        while size > 0:
+            if self.buffer:
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+            elif self.current < len(self.extents):
+                offset, length = self.extents[self.current]
+
+                if length == 0:
+                    self.current += 1
+                    continue
+
+                self.handle.seek(offset)
+                data = self.handle.read(min(size, length))
+
+                if not data:
+                    raise IOError("Unexpected end of file in '%s'" % (
+                        self.handle.name))
+
+                if self.checksum is not None:
+                    self.checksum.update(offset, data)
+
+                # track what remains to read in this extent
+                if len(data) < length:
+                    self.extents[self.current] = (
+                        offset + len(data), length - len(data))
+
+                else:
+                    self.current += 1
+
+            else:
+                break
+
+            chunks += [data]
+            size -= len(data)
+
+        return b"".join(chunks)
+
+
+class ChecksumReader():
+    """A file object which adds the data read to a checksum"""
+
+    def __init__(self, handle, checksum):
+        self.handle = handle
+        self.checksum = checksum
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+
+        self.checksum.update(self.position, data)
+        self.position += len(data)
+
+        return data
+
+
+def addExtents(tar, tarinfo, handle, extents, checksum=None):
+    """Add the extents of handle to tar as tarinfo member. If extents don't
+    cover the whole file, a GNU sparse 1.0 member is written. Data read are
+    added to checksum, if any. Return the bytes read"""
+
+    if not isSparse(extents, tarinfo.size):
+        if checksum is not None:
+            handle = ChecksumReader(handle, checksum)
+
+        tar.addfile(tarinfo, handle)
+        return tarinfo.size
+
+    reader = SparseReader(handle, extents, tarinfo.size, checksum)
+    arcname = tarinfo.name
+
+    logger.debug("'%s' has %s bytes allocated in %s extents" % (
+        arcname, reader.data_size, len(extents)))
+
+    # the real name and size are written in pax headers, while member
+    # name is the one used by GNU tar
+    dirname, basename = os.path.split(arcname)
+    tarinfo.pax_headers = {
+        "GNU.sparse.major": "1",
+        "GNU.sparse.minor": "0",
+        "GNU.sparse.name": arcname,
+        "GNU.sparse.realsize": str(tarinfo.size)}
+    tarinfo.name = os.path.join(dirname, "GNUSparseFile.0", basename)
+    tarinfo.size = reader.size
+
+    tar.addfile(tarinfo, reader)
+
+    return reader.data_size
+
+
+def addFile(tar, source, arcname, sparse=True, checksum=None,
+            throttle=None):
+    """Add source to tar as arcname, reading it once. If sparse is True and
+    source has holes, a GNU sparse 1.0 member is written with only the
+    allocated extents. Data read are added to checksum, and limited by
+    throttle, if any"""
+
+    tarinfo = tar.gettarinfo(source, arcname=arcname)
+
+    with open(source, "rb") as handle:
+        if throttle is not None:
+            handle = throttle.reader(handle)
+
+        if sparse:
+            extents = getExtents(handle, tarinfo.size)
+
+        else:
+            extents = [(0, tarinfo.size)]
+
+        return addExtents(tar, tarinfo, handle, extents, checksum)
@@ -0,0 +1,766 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to write backups in different storages: a local directory, a S3
+compatible bucket or a SFTP server. Every backend writes a file in a
+temporary place, and makes it visible only when it is completed. Files
+sent to S3 are split in parts uploaded in parallel. Files could be read
+back as streams, to restore and verify remote backups
+
+"""
+
+from __future__ import print_function
+
+import collections
+import logging
+import os
+import posixpath
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlparse
+
+except ImportError:
+    from urlparse import urlparse
+
+# optional storage modules
+try:
+    import boto3
+
+except ImportError:
+    boto3 = None
+
+try:
+    import paramiko
+
+except ImportError:
+    paramiko = None
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the default size of parts uploaded to S3
+PART_SIZE = 64 * 1024 * 1024
+
+# S3 parts can't be smaller, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# S3 parts can't be bigger, and an upload can't have more parts
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+# parts of an upload of unknown size double every PART_GROWTH parts
+PART_GROWTH = 1000
+
+# parts uploaded at the same time
+WORKERS = 4
+
+# the size of buffers used to upload files
+BUFSIZE = 4 * 1024 * 1024
+
+
+class Storage():
+    """Base class of storage backends. Files are named by paths relative
+    to the root of storage, with '/' as separator"""
+
+    def getURL(self, name):
+        """Return a description of a file, used in logs"""
+
+        raise NotImplementedError
+
+    def getPath(self, name):
+        """Return the local path of a file, or None if storage is remote"""
+
+        return None
+
+    def isLocal(self):
+        return False
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def remove(self, name):
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Return the names of the files in prefix directory"""
+
+        raise NotImplementedError
+
+    def makedirs(self, name):
+        """Create a directory, if the storage has directories"""
+
+        pass
+
+    def open(self, name, mode="wb", size=None):
+        """Return a writer of name: data are visible when writer is closed,
+        and discarded when writer is aborted. size, if known, is the size
+        of the written file. With mode 'rb', return a file object reading
+        name"""
+
+        raise NotImplementedError
+
+    def abortUploads(self, prefix=""):
+        """Discard the uploads left incomplete in prefix directory by
+        interrupted backups, if storage keeps them. Return how many were
+        discarded"""
+
+        return 0
+
+    def close(self):
+        """Close the connections to storage, if any"""
+
+        pass
+
+    def upload(self, path, name):
+        """Copy a local file in storage"""
+
+        writer = self.open(name, size=os.path.getsize(path))
+
+        try:
+            with open(path, "rb") as handle:
+                shutil.copyfileobj(handle, writer, BUFSIZE)
+
+            writer.close()
+
+        except Exception:
+            writer.abort()
+            raise
+
+
+class LocalWriter():
+    """Write a local file in a temporary file, renamed when closing"""
+
+    def __init__(self, path):
+        self.path = path
+        self.partial = path + ".part"
+        self.handle = open(self.partial, "wb")
+        self.done = False
+
+    def __getattr__(self, name):
+        # everything else is done by the real file
+        return getattr(self.handle, name)
+
+    def write(self, data):
+        return self.handle.write(data)
+
+    def close(self):
+        # writers could be closed by many wrappers
+        if self.done:
+            return
+
+        self.handle.close()
+        os.rename(self.partial, self.path)
+        self.done = True
+
+    def abort(self):
+        if self.done:
+            return
+
+        logger.warning("Removing incomplete file '%s'" % (self.partial))
+
+        self.handle.close()
+        self.done = True
+
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+
+
+class LocalStorage(Storage):
+    """A local (or locally mounted) directory"""
+
+    def __init__(self, root=""):
+        self.root = root
+
+    def getURL(self, name):
+        return self.getPath(name)
+
+    def getPath(self, name):
+        return os.path.join(self.root, name)
+
+    def isLocal(self):
+        return True
+
+    def exists(self, name):
+        return os.path.exists(self.getPath(name))
+
+    def remove(self, name):
+        os.remove(self.getPath(name))
+
+    def list(self, prefix=""):
+        return sorted(os.listdir(self.getPath(prefix)))
+
+    def makedirs(self, name):
+        path = self.getPath(name)
+
+        if not os.path.isdir(path):
+            logger.info("Creating directory '%s'" % (path))
+            os.makedirs(path)
+
+    def open(self, name, mode="wb", size=None):
+        if mode == "rb":
+            return open(self.getPath(name), "rb")
+
+        return LocalWriter(self.getPath(name))
+
+
+class S3Writer():
+    """Upload a S3 object in parts, uploaded in parallel by threads. At
+    most workers parts are kept in memory. Since an upload has at most
+    MAX_PARTS parts, parts are bigger for big objects, and grow while an
+    upload of unknown size goes on"""
+
+    def __init__(self, client, bucket, key, part_size=PART_SIZE,
+                 workers=WORKERS, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.workers = workers
+        self.size = size
+
+        if size is not None:
+            self.part_size = min(
+                MAX_PART_SIZE, max(part_size, -(-size // MAX_PARTS)))
+
+        # data of the current part, and the bytes written
+        self.buffer = bytearray()
+        self.position = 0
+
+        self.upload_id = None
+        self.parts = []
+        self.pending = collections.deque()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.done = False
+
+    def __upload(self, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=data)
+
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def getPartSize(self):
+        """Return the size of the next part"""
+
+        if self.size is not None:
+            return self.part_size
+
+        number = len(self.parts) + len(self.pending)
+
+        return min(MAX_PART_SIZE,
+                   self.part_size * 2 ** (number // PART_GROWTH))
+
+    def __submit(self, data):
+        """Start the upload of a part"""
+
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)
+            self.upload_id = response["UploadId"]
+
+        # wait for the oldest part, before reading another one
+        if len(self.pending) >= self.workers:
+            self.parts += [self.pending.popleft().result()]
+
+        number = len(self.parts) + len(self.pending) + 1
+
+        if number > MAX_PARTS:
+            raise IOError("'s3://%s/%s' needs more than %s parts" % (
+                self.bucket, self.key, MAX_PARTS))
+
+        self.pending.append(self.executor.submit(self.__upload, number, data))
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+
+        part_size = self.getPartSize()
+
+        while len(self.buffer) >= part_size:
+            self.__submit(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+
+            part_size = self.getPartSize()
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Upload the last part, and complete the upload"""
+
+        if self.done:
+            return
+
+        try:
+            if self.upload_id is None:
+                # a small object is uploaded in a single request
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+
+            else:
+                if self.buffer:
+                    self.__submit(bytes(self.buffer))
+
+                while self.pending:
+                    self.parts += [self.pending.popleft().result()]
+
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={"Parts": self.parts})
+
+        except Exception:
+            self.abort()
+            raise
+
+        self.buffer = bytearray()
+        self.executor.shutdown()
+        self.done = True
+
+    def abort(self):
+        """Discard the uploaded parts"""
+
+        if self.done:
+            return
+
+        self.done = True
+        self.buffer = bytearray()
+
+        # uploading parts can't be stopped
+        for future in self.pending:
+            future.cancel()
+
+        self.executor.shutdown()
+
+        if self.upload_id is not None:
+            logger.warning("Aborting upload of 's3://%s/%s'" % (
+                self.bucket, self.key))
+
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3Reader():
+    """Read a S3 object as a stream. Seeking starts a new request from
+    the new position"""
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+
+        self.size = client.head_object(
+            Bucket=bucket, Key=key)["ContentLength"]
+        self.position = 0
+        self.body = None
+
+    def __closeBody(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        if offset != self.position:
+            self.__closeBody()
+
+        self.position = offset
+
+        return self.position
+
+    def read(self, size=-1):
+        if self.position >= self.size:
+            return b""
+
+        if self.body is None:
+            self.body = self.client.get_object(
+                Bucket=self.bucket, Key=self.key,
+                Range="bytes=%s-" % (self.position))["Body"]
+
+        if size is None or size < 0:
+            data = self.body.read()
+
+        else:
+            data = self.body.read(size)
+
+        self.position += len(data)
+
+        return data
+
+    def readRange(self, offset, size):
+        """Return size bytes from offset, with a request of their own:
+        could be called by many threads"""
+
+        if size <= 0:
+            return b""
+
+        body = self.client.get_object(
+            Bucket=self.bucket, Key=self.key,
+            Range="bytes=%s-%s" % (offset, offset + size - 1))["Body"]
+
+        try:
+            return body.read()
+
+        finally:
+            body.close()
+
+    def close(self):
+        self.__closeBody()
+
+
+class S3Storage(Storage):
+    """A prefix in a S3 compatible bucket, like 's3://bucket/prefix'"""
+
+    def __init__(self, url, client=None, endpoint=None, part_size=PART_SIZE,
+                 workers=WORKERS):
+        """A client is created with boto3 if not provided. endpoint is the
+        url of a S3 compatible service (ie MinIO)"""
+
+        parsed = urlparse(url)
+
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.workers = workers
+
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError(
+                    "boto3 python module is required to write in '%s'" % (
+                        url))
+
+            client = boto3.client("s3", endpoint_url=endpoint)
+
+        self.client = client
+
+    def getKey(self, name):
+        if not self.prefix:
+            return name.strip("/")
+
+        return "/".join([self.prefix, name.strip("/")]).strip("/")
+
+    def getURL(self, name):
+        return "s3://%s/%s" % (self.bucket, self.getKey(name))
+
+    def exists(self, name):
+        key = self.getKey(name)
+
+        response = self.client.list_objects_v2(
+            Bucket=self.bucket, Prefix=key, MaxKeys=1)
+
+        return any([item["Key"] == key
+                    for item in response.get("Contents", [])])
+
+    def remove(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.getKey(name))
+
+    def list(self, prefix=""):
+        key = self.getKey(prefix)
+
+        if key:
+            key += "/"
+
+        names = []
+        kwargs = {"Bucket": self.bucket, "Prefix": key, "Delimiter": "/"}
+
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+
+            names += [item["Key"][len(key):]
+                      for item in response.get("Contents", [])]
+            names += [item["Prefix"][len(key):].rstrip("/")
+                      for item in response.get("CommonPrefixes", [])]
+
+            if not response.get("IsTruncated"):
+                break
+
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+        return sorted(names)
+
+    def open(self, name, mode="wb", size=None):
+        if mode == "rb":
+            return S3Reader(self.client, self.bucket, self.getKey(name))
+
+        return S3Writer(self.client, self.bucket, self.getKey(name),
+                        self.part_size, self.workers, size)
+
+    def abortUploads(self, prefix=""):
+        """Abort multipart uploads in prefix directory: a process killed
+        while uploading leaves them, and their parts are billed until they
+        are aborted"""
+
+        key = self.getKey(prefix)
+
+        if key:
+            key += "/"
+
+        aborted = 0
+        kwargs = {"Bucket": self.bucket, "Prefix": key}
+
+        while True:
+            response = self.client.list_multipart_uploads(**kwargs)
+
+            for upload in response.get("Uploads", []):
+                logger.warning("Aborting incomplete upload of 's3://%s/%s'" % (
+                    self.bucket, upload["Key"]))
+
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=upload["Key"],
+                    UploadId=upload["UploadId"])
+                aborted += 1
+
+            if not response.get("IsTruncated"):
+                break
+
+            kwargs["KeyMarker"] = response["NextKeyMarker"]
+            kwargs["UploadIdMarker"] = response["NextUploadIdMarker"]
+
+        return aborted
+
+
+class SFTPWriter():
+    """Write a remote file in a temporary file, renamed when closing"""
+
+    def __init__(self, sftp, path):
+        self.sftp = sftp
+        self.path = path
+        self.partial = path + ".part"
+        self.handle = sftp.open(self.partial, "wb")
+        self.done = False
+
+        # don't wait for the acknowledge of every write
+        self.handle.set_pipelined(True)
+
+    def tell(self):
+        return self.handle.tell()
+
+    def write(self, data):
+        self.handle.write(data)
+
+        return len(data)
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        if self.done:
+            return
+
+        self.handle.close()
+        self.sftp.posix_rename(self.partial, self.path)
+        self.sftp.close()
+        self.done = True
+
+    def abort(self):
+        if self.done:
+            return
+
+        logger.warning("Removing incomplete file '%s'" % (self.partial))
+
+        self.done = True
+        self.handle.close()
+        self.sftp.remove(self.partial)
+        self.sftp.close()
+
+
+class SFTPReader():
+    """Read a remote file with its own session"""
+
+    def __init__(self, sftp, path):
+        self.sftp = sftp
+        self.handle = sftp.open(path, "rb", BUFSIZE)
+
+        # ranges could be read by many threads
+        self.lock = threading.Lock()
+
+    def tell(self):
+        return self.handle.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.handle.seek(offset, whence)
+
+        return self.handle.tell()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.handle.read()
+
+        return self.handle.read(size)
+
+    def readRange(self, offset, size):
+        """Return size bytes from offset. Could be called by many
+        threads"""
+
+        with self.lock:
+            self.handle.seek(offset)
+
+            return self.handle.read(size)
+
+    def close(self):
+        self.handle.close()
+        self.sftp.close()
+
+
+class SFTPStorage(Storage):
+    """A directory in a SFTP server, like 'sftp://user@host:port/path'.
+    Keys are read from ssh agent, from default locations or from
+    key_filename, and the server must be in known hosts"""
+
+    def __init__(self, url, key_filename=None):
+        parsed = urlparse(url)
+
+        if paramiko is None:
+            raise RuntimeError(
+                "paramiko python module is required to write in '%s'" % (
+                    url))
+
+        self.host = parsed.hostname
+        self.root = parsed.path or "."
+
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.connect(
+            self.host, port=parsed.port or 22, username=parsed.username,
+            key_filename=key_filename)
+
+        self.sftp = self.client.open_sftp()
+
+        # a SFTP session can't be used by many threads at the same time
+        self.lock = threading.Lock()
+
+    def getRemotePath(self, name):
+        return "/".join([self.root.rstrip("/"), name.strip("/")])
+
+    def getURL(self, name):
+        return "sftp://%s%s" % (self.host, self.getRemotePath(name))
+
+    def exists(self, name):
+        try:
+            with self.lock:
+                self.sftp.stat(self.getRemotePath(name))
+
+        except IOError:
+            return False
+
+        return True
+
+    def remove(self, name):
+        with self.lock:
+            self.sftp.remove(self.getRemotePath(name))
+
+    def list(self, prefix=""):
+        with self.lock:
+            return sorted(self.sftp.listdir(self.getRemotePath(prefix)))
+
+    def makedirs(self, name):
+        path = ""
+
+        for item in self.getRemotePath(name).split("/"):
+            path += item + "/"
+
+            try:
+                with self.lock:
+                    if stat.S_ISDIR(self.sftp.stat(path).st_mode):
+                        continue
+
+            except IOError:
+                logger.info("Creating directory '%s'" % (path))
+
+                with self.lock:
+                    self.sftp.mkdir(path)
+
+    def open(self, name, mode="wb", size=None):
+        # every file uses its own session, so backups could be parallel
+        if mode == "rb":
+            return SFTPReader(
+                self.client.open_sftp(), self.getRemotePath(name))
+
+        return SFTPWriter(self.client.open_sftp(), self.getRemotePath(name))
+
+    def close(self):
+        self.sftp.close()
+        self.client.close()
+
+
+def isLocal(backupdir):
+    """Return True if backupdir is a local path"""
+
+    return "://" not in backupdir
+
+
+def getStorage(backupdir, parameters=None):
+    """Return the storage of backupdir, which is a local path or a url like
+    's3://bucket/prefix' or 'sftp://user@host/path'. S3 and SFTP options
+    are read from domain parameters"""
+
+    parameters = parameters or {}
+
+    if isLocal(backupdir):
+        return LocalStorage(backupdir)
+
+    scheme = urlparse(backupdir).scheme
+
+    if scheme == "s3":
+        return S3Storage(
+            backupdir, endpoint=parameters.get("s3_endpoint"),
+            part_size=int(parameters.get("part_size", 64) * 1024 * 1024),
+            workers=parameters.get("upload_workers", WORKERS))
+
+    if scheme == "sftp":
+        return SFTPStorage(
+            backupdir, key_filename=parameters.get("sftp_key"))
+
+    raise RuntimeError("Unknown storage '%s'" % (backupdir))
+
+
+def getStorageByPath(path, parameters=None):
+    """Return the storage of the backupdir in which the backup path (a local
+    path or a url) is placed, and the name of backup in that storage"""
+
+    # urls are split like posix paths
+    if isLocal(path):
+        path = os.path.abspath(path)
+        dirname, basename = os.path.dirname, os.path.basename
+
+    else:
+        dirname, basename = posixpath.dirname, posixpath.basename
+
+    domain_dir = dirname(path)
+    name = "/".join([basename(domain_dir), basename(path)])
+
+    return getStorage(dirname(domain_dir), parameters), name
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to limit bandwidth and IOPS of image reads and of backup writes.
+Limits are token buckets shared by all the domains of a host, of a backup
+target, or owned by a single domain. Rates could be reduced when the
+latency of a device, read from /proc/diskstats, is too high. Files could
+bypass the page cache too (see pagecache). Reads and writes of a domain
+could be paused or cancelled by the control of its job
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import threading
+import time
+
+from . import pagecache, storage
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# where device statistics are read
+DISKSTATS = "/proc/diskstats"
+
+# how often device latency is checked (seconds)
+INTERVAL = 1.0
+
+# rates are never reduced below this fraction
+MIN_FACTOR = 0.05
+
+# how much rates are increased every interval with a low latency
+FACTOR_STEP = 0.05
+
+# the limits which could be defined in a throttle section
+LIMITS = ["read_bandwidth", "write_bandwidth", "read_iops", "write_iops"]
+
+
+class TokenBucket():
+    """A token bucket: tokens are added at rate per second, up to burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def __refill(self):
+        """Add the tokens of the time passed. Need to be called with lock
+        acquired"""
+
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def setRate(self, rate, burst=None):
+        """Change rate and burst. Tokens already reserved are still
+        waited for"""
+
+        with self.lock:
+            self.__refill()
+
+            self.rate = float(rate)
+            self.burst = float(burst or rate)
+            self.tokens = min(self.burst, self.tokens)
+
+    def consume(self, amount, factor=1.0):
+        """Take amount tokens, waiting for them if needed. With a factor
+        lower than 1, tokens are consumed faster"""
+
+        with self.lock:
+            self.__refill()
+
+            # tokens are reserved now, and waited outside the lock
+            self.tokens -= amount / factor
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Cancelled(Exception):
+    """Raised by reads and writes of a cancelled backup"""
+
+    pass
+
+
+class Control():
+    """Pause, resume or cancel the reads and writes of a running backup"""
+
+    def __init__(self):
+        self.running = threading.Event()
+        self.running.set()
+        self.cancelled = False
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.running.set()
+
+    def wait(self):
+        """Wait while paused. Raise Cancelled if cancelled"""
+
+        self.running.wait()
+
+        if self.cancelled:
+            raise Cancelled("Backup was cancelled")
+
+
+class LatencyMonitor():
+    """Track the latency of a block device, and reduce rates when it is
+    above a threshold: rates are halved, and then increased slowly when
+    latency is low (additive increase, multiplicative decrease)"""
+
+    def __init__(self, device, threshold, interval=INTERVAL):
+        """Monitor device (a st_dev number). threshold is in milliseconds"""
+
+        self.major = os.major(device)
+        self.minor = os.minor(device)
+        self.threshold = threshold
+        self.interval = interval
+        self.factor = 1.0
+        self.lock = threading.Lock()
+
+        self.last = time.time()
+        self.stats = self.readStats()
+
+        if self.stats is None:
+            logger.warning(
+                "Device %s:%s not found in %s: latency won't be "
+                "monitored" % (self.major, self.minor, DISKSTATS))
+
+    def readStats(self):
+        """Return (completed I/O, milliseconds spent in I/O) of device"""
+
+        try:
+            with open(DISKSTATS) as handle:
+                for line in handle:
+                    fields = line.split()
+
+                    if int(fields[0]) == self.major and \
+                            int(fields[1]) == self.minor:
+                        # reads and writes completed, and their times
+                        return (int(fields[3]) + int(fields[7]),
+                                int(fields[6]) + int(fields[10]))
+
+        except (IOError, OSError, IndexError, ValueError) as error:
+            logger.debug("Cannot read %s: %s" % (DISKSTATS, error))
+
+        return None
+
+    def getFactor(self):
+        """Return the fraction of rates to use"""
+
+        if self.stats is None:
+            return 1.0
+
+        with self.lock:
+            now = time.time()
+
+            if now - self.last < self.interval:
+                return self.factor
+
+            stats = self.readStats()
+
+            if stats is None:
+                return self.factor
+
+            ios, ticks = stats[0] - self.stats[0], stats[1] - self.stats[1]
+            self.stats, self.last = stats, now
+
+            latency = float(ticks) / ios if ios > 0 else 0.0
+
+            if latency > self.threshold:
+                factor = max(MIN_FACTOR, self.factor / 2)
+
+                if factor < self.factor:
+                    logger.info(
+                        "Device %s:%s latency is %.1f ms: reducing rates "
+                        "to %.0f%%" % (self.major, self.minor, latency,
+                                       factor * 100))
+
+            else:
+                factor = min(1.0, self.factor + FACTOR_STEP)
+
+            self.factor = factor
+
+            return self.factor
+
+
+class ThrottledFile():
+    """A file object whose reads or writes are limited by a throttle"""
+
+    def __init__(self, handle, throttle, direction, monitor=None):
+        self.handle = handle
+        self.throttle = throttle
+        self.direction = direction
+        self.monitor = monitor
+
+    def __getattr__(self, name):
+        # everything else is done by the real file
+        return getattr(self.handle, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+
+        if data:
+            self.throttle.consume(self.direction, len(data), self.monitor)
+
+        return data
+
+    def write(self, data):
+        self.throttle.consume(self.direction, len(data), self.monitor)
+
+        return self.handle.write(data)
+
+
+class Throttle():
+    """How a domain reads images and writes backups: its own limits, the
+    ones of its backup target and the ones of the host, and the page cache
+    mode"""
+
+    def __init__(self, buckets=None, latency=None, io_mode="buffered",
+                 control=None):
+        """buckets is a list of dictionaries of token buckets by limit name.
+        If latency is defined, rates are reduced when latency of devices
+        (in milliseconds) is above it. io_mode is one of pagecache.MODES.
+        control, if any, is checked before every read and write"""
+
+        if io_mode not in pagecache.MODES:
+            raise RuntimeError("Unknown io_mode '%s'" % (io_mode))
+
+        self.buckets = dict([(limit, []) for limit in LIMITS])
+        self.latency = latency
+        self.io_mode = io_mode
+        self.control = control
+
+        for bucket in buckets or []:
+            for limit, item in iter(bucket.items()):
+                self.buckets[limit] += [item]
+
+    def isActive(self):
+        """Return True if some limit, page cache mode or control is
+        defined"""
+
+        return any(self.buckets.values()) or self.io_mode != "buffered" or \
+            self.control is not None
+
+    def getRate(self, direction):
+        """Return the lowest bandwidth limit of direction (bytes per second),
+        or None"""
+
+        rates = [bucket.rate for bucket in
+                 self.buckets[direction + "_bandwidth"]]
+
+        return min(rates) if rates else None
+
+    def consume(self, direction, amount, monitor=None):
+        """Wait until amount bytes could be read or written"""
+
+        if self.control is not None:
+            self.control.wait()
+
+        factor = monitor.getFactor() if monitor is not None else 1.0
+
+        for bucket in self.buckets[direction + "_bandwidth"]:
+            bucket.consume(amount, factor)
+
+        for bucket in self.buckets[direction + "_iops"]:
+            bucket.consume(1, factor)
+
+    def wrap(self, handle, direction):
+        """Return handle, limited and bypassing page cache if needed"""
+
+        # remote storages have no page cache and no device
+        local = hasattr(handle, "fileno")
+
+        if local:
+            handle = pagecache.wrap(handle, direction, self.io_mode)
+
+        if not self.buckets[direction + "_bandwidth"] and \
+                not self.buckets[direction + "_iops"] and \
+                self.control is None:
+            return handle
+
+        monitor = None
+
+        if self.latency and local:
+            monitor = getMonitor(os.fstat(handle.fileno()).st_dev,
+                                 self.latency)
+
+        return ThrottledFile(handle, self, direction, monitor)
+
+    def reader(self, handle):
+        """Return a file object which limits reads from handle"""
+
+        return self.wrap(handle, "read")
+
+    def writer(self, handle):
+        """Return a file object which limits writes to handle"""
+
+        return self.wrap(handle, "write")
+
+    def open(self, path, mode="rb"):
+        """Open a file, and limit its reads or writes"""
+
+        handle = open(path, mode)
+
+        if "r" in mode:
+            return self.reader(handle)
+
+        return self.writer(handle)
+
+
+# token buckets and latency monitors are shared, by key
+buckets = {}
+monitors = {}
+
+# the limits shared by domains, from host configuration (see configure)
+host_limits = {}
+
+# the controls of running backups, by domain name
+controls = {}
+registry_lock = threading.Lock()
+
+
+def getBuckets(key, limits):
+    """Return the token buckets of key, from limits (MiB/s for bandwidth
+    and operations/s for IOPS). Buckets are created once, then their rates
+    follow limits: backups using them see the new rates, while limits
+    removed apply only to the next backups"""
+
+    limits = limits or {}
+
+    with registry_lock:
+        current = buckets.setdefault(key, {})
+
+        for limit in LIMITS:
+            rate = limits.get(limit)
+
+            if not rate:
+                current.pop(limit, None)
+                continue
+
+            if limit.endswith("_bandwidth"):
+                rate = rate * 1024 * 1024
+
+            if limit not in current:
+                logger.debug("Limiting %s of %s to %s" % (limit, key, rate))
+                current[limit] = TokenBucket(rate)
+
+            elif current[limit].rate != rate:
+                logger.info("Changing %s of %s to %s" % (limit, key, rate))
+                current[limit].setRate(rate)
+
+        if not current:
+            buckets.pop(key)
+
+        return dict(current)
+
+
+def configure(host_conf):
+    """Read the 'target_throttle' and 'host_throttle' sections of host
+    configuration, which are shared by domains. Called again when
+    configuration is reloaded: shared buckets follow the new limits"""
+
+    with registry_lock:
+        for section in ["target_throttle", "host_throttle"]:
+            host_limits[section] = host_conf.get(section)
+
+        targets = [key for key in buckets if key[0] == "target"]
+
+    getBuckets(("host", ), host_limits["host_throttle"])
+
+    for key in targets:
+        getBuckets(key, host_limits["target_throttle"])
+
+
+def getMonitor(device, threshold):
+    """Return the latency monitor of a device"""
+
+    with registry_lock:
+        if device not in monitors:
+            monitors[device] = LatencyMonitor(device, threshold)
+
+        return monitors[device]
+
+
+def getThrottle(domain_name, parameters, backupdir):
+    """Return the throttle of a domain, from its 'throttle' and 'io_mode'
+    parameters, and from the 'target_throttle' (of backupdir) and
+    'host_throttle' of host configuration"""
+
+    return Throttle([
+        getBuckets(("domain", domain_name), parameters.get("throttle")),
+        getBuckets(("target", os.path.abspath(backupdir)
+                    if storage.isLocal(backupdir) else backupdir),
+                   host_limits.get("target_throttle")),
+        getBuckets(("host", ), host_limits.get("host_throttle"))],
+        latency=parameters.get("throttle_latency"),
+        io_mode=parameters.get("io_mode", "buffered"),
+        control=controls.get(domain_name))
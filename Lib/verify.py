@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A module to verify backups against the checksums computed while images were
+read. Archives are decompressed and images are hashed by a pool of
+processes: images of indexed archives and chunks of chunk stores are
+verified in parallel. Images could be compared with live images too, and
+mismatched chunks are reported. Archives could be read from remote
+storages too
+
+"""
+
+from __future__ import print_function
+
+import hashlib
+import logging
+import os
+import tarfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import (archive, checksum, chunkstore, compression, incremental,
+               sparse, storage)
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# chunks of a chunk store verified by a single task
+CHUNKS_BATCH = 256
+
+# mismatched chunks logged for every image
+MAX_REPORTED = 20
+
+
+def checksumStream(handle, size, chunk_size=checksum.CHUNK_SIZE):
+    """Compute the checksums of the file object handle. Blocks of zeros
+    are not hashed"""
+
+    file_checksum = checksum.FileChecksum(size, chunk_size)
+    zeros = bytes(sparse.BUFSIZE)
+    offset = 0
+
+    while True:
+        data = handle.read(sparse.BUFSIZE)
+
+        if not data:
+            break
+
+        # zeros are hashed only when needed by checksum
+        if data != zeros[:len(data)]:
+            file_checksum.update(offset, data)
+
+        offset += len(data)
+
+    if offset != size:
+        raise IOError("Expected %s bytes, %s read" % (size, offset))
+
+    return file_checksum.finish()
+
+
+def checkArchive(path, parameters=None):
+    """Read a whole tar archive, from a local path or from the url of a
+    remote storage configured by parameters. Return the checksums of its
+    images and the checksums stored in archive, if any"""
+
+    backend, name = storage.getStorageByPath(path, parameters)
+    computed, stored = {}, None
+
+    try:
+        compressor = compression.getCompressorByPath(name)
+        reader = compressor.openReader(path, backend.open(name, "rb"))
+
+    except Exception:
+        backend.close()
+        raise
+
+    try:
+        tar = tarfile.open(fileobj=reader, mode="r|", bufsize=archive.BUFSIZE)
+
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+
+            handle = tar.extractfile(tarinfo)
+
+            if tarinfo.name.endswith(checksum.CHECKSUM_SUFFIX):
+                stored = checksum.loadChecksums(handle.read())
+
+            elif tarinfo.name.endswith(".xml") or tarinfo.name.endswith(
+                    incremental.INFO_SUFFIX):
+                handle.read()
+
+            else:
+                computed[tarinfo.name] = checksumStream(handle, tarinfo.size)
+
+        tar.close()
+
+    finally:
+        reader.close()
+        backend.close()
+
+    return computed, stored
+
+
+def checkMember(path, name, parameters=None):
+    """Read an image of an indexed archive, from a local path or from the
+    url of a remote storage configured by parameters, and return its
+    checksums"""
+
+    backend, archive_name = storage.getStorageByPath(path, parameters)
+
+    try:
+        reader = archive.IndexedReader(archive_name, backend)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            frames = reader.getReader(name, executor=executor)
+
+            try:
+                tar = tarfile.open(fileobj=frames, mode="r|")
+                tarinfo = tar.next()
+                result = checksumStream(
+                    tar.extractfile(tarinfo), tarinfo.size)
+                tar.close()
+
+            finally:
+                frames.close()
+
+    finally:
+        backend.close()
+
+    return result
+
+
+def checkChunks(backupdir, digests):
+    """Return a list of (digest, error) for chunks which are missing or
+    damaged"""
+
+    store = chunkstore.ChunkStore(backupdir, workers=1)
+    damaged = []
+
+    for digest in digests:
+        try:
+            data = store.getChunk(digest)
+
+        except (IOError, OSError, zlib.error) as error:
+            damaged += [(digest, str(error))]
+            continue
+
+        if hashlib.sha256(data).hexdigest() != digest:
+            damaged += [(digest, "checksum mismatch")]
+
+    return damaged
+
+
+def checkLive(source, chunk_size):
+    """Return the checksums of a live image"""
+
+    return checksum.checksumFile(source, chunk_size)
+
+
+class Verify():
+    """Verify many backups with a pool of processes"""
+
+    def __init__(self, workers=None, live=False):
+        """Backups are read by workers processes. If live is True, images
+        are compared with the live images too"""
+
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.live = live
+
+        # the backups submitted
+        self.checks = []
+
+        # a dictionary for every image verified
+        self.results = []
+
+    def submit(self, domain_name, path, parameters=None):
+        """Submit the checks of a backup to process pool. Backups in remote
+        storages are configured by domain parameters"""
+
+        logger.info("Verifying '%s'" % (path))
+
+        check = {
+            "domain": domain_name,
+            "path": path,
+            "expected": {},
+            "chunks": [],
+            "images": {},
+            "archive": None,
+            "manifest": None,
+            "live": {}}
+
+        backend, archive_name = storage.getStorageByPath(path, parameters)
+
+        try:
+            self.__submit(check, backend, archive_name, parameters)
+
+        finally:
+            backend.close()
+
+        self.checks += [check]
+
+    def __submit(self, check, backend, archive_name, parameters):
+        """Submit the checks of a backup, named archive_name in backend"""
+
+        path = check["path"]
+
+        # chunk stores are only in local directories
+        if not backend.isLocal() and \
+                chunkstore.MANIFEST_EXT in os.path.basename(path):
+            raise Exception(
+                "'%s' could be verified only in a local directory: please "
+                "download it first" % (path))
+
+        # manifests are named by date, or end with their rotation number
+        if chunkstore.MANIFEST_EXT in os.path.basename(path):
+            manifest = chunkstore.readManifest(path)
+            backupdir = os.path.dirname(os.path.dirname(
+                os.path.abspath(path)))
+
+            # the checksums of images stored in manifest, by image name
+            check["manifest"] = {}
+            digests = set()
+
+            for disk in manifest["disks"]:
+                check["expected"][disk["name"]] = checksum.fromChunks(
+                    disk["chunks"], disk["size"], manifest["chunk_size"])
+                check["expected"][disk["name"]]["source"] = disk["source"]
+
+                # manifests written before checksums have no sha256
+                check["manifest"][disk["name"]] = disk.get("sha256")
+
+                digests.update([digest for offset, digest in disk["chunks"]])
+
+            digests = sorted(digests)
+
+            for start in range(0, len(digests), CHUNKS_BATCH):
+                check["chunks"] += [self.executor.submit(
+                    checkChunks, backupdir,
+                    digests[start:start + CHUNKS_BATCH])]
+
+        elif archive.isIndexed(archive_name, backend):
+            reader = archive.IndexedReader(archive_name, backend)
+
+            for member in reader.getMembers():
+                name = member["name"]
+
+                if name.endswith(checksum.CHECKSUM_SUFFIX):
+                    check["expected"] = checksum.loadChecksums(
+                        reader.read(name))
+
+                elif name.endswith(".xml") or name.endswith(
+                        incremental.INFO_SUFFIX):
+                    reader.read(name)
+
+                else:
+                    check["images"][name] = self.executor.submit(
+                        checkMember, path, name, parameters)
+
+        else:
+            check["archive"] = self.executor.submit(
+                checkArchive, path, parameters)
+
+    def __submitLive(self, check):
+        """Compute the checksums of live images"""
+
+        for name, expected in iter(check["expected"].items()):
+            # images read by a backup job are not image files
+            if "source" not in expected:
+                continue
+
+            check["live"][name] = self.executor.submit(
+                checkLive, expected["source"], expected["chunk_size"])
+
+    def __addResult(self, check, name, status, mismatched=None,
+                    chunk_size=None, message=None):
+        result = {
+            "domain": check["domain"],
+            "path": check["path"],
+            "image": name,
+            "status": status,
+            "mismatched": []}
+
+        if mismatched:
+            result["mismatched"] = [
+                [index * chunk_size, chunk_size] for index in mismatched]
+
+        if message:
+            result["message"] = message
+
+        self.results += [result]
+
+        if status == "ok":
+            logger.info("'%s' in '%s': ok" % (name, check["path"]))
+            return
+
+        if status == "no checksums":
+            logger.warning("'%s' in '%s': read, but no checksums stored" % (
+                name, check["path"]))
+            return
+
+        logger.error("'%s' in '%s': %s%s" % (
+            name, check["path"], status,
+            " (%s)" % (message) if message else ""))
+
+        for offset, length in result["mismatched"][:MAX_REPORTED]:
+            logger.error("  chunk at offset %s (%s bytes) mismatched" % (
+                offset, length))
+
+        if len(result["mismatched"]) > MAX_REPORTED:
+            logger.error("  ... and %s more chunks" % (
+                len(result["mismatched"]) - MAX_REPORTED))
+
+    def __compare(self, check, name, actual, status, label=None):
+        """Compare computed checksums with the ones stored in backup"""
+
+        expected = check["expected"].get(name)
+        label = label or name
+
+        if expected is None:
+            self.__addResult(check, label, "no checksums")
+            return
+
+        mismatched = checksum.compare(expected, actual)
+
+        if mismatched:
+            self.__addResult(check, label, status, mismatched,
+                             expected["chunk_size"])
+
+        else:
+            self.__addResult(check, label, "ok")
+
+    def __collect(self, check):
+        """Wait for the checks of a backup, and compare results"""
+
+        if check["archive"] is not None:
+            computed, stored = check["archive"].result()
+            check["expected"] = stored or {}
+
+            # live images could be checked only once checksums are read
+            if self.live:
+                self.__submitLive(check)
+
+            for name, actual in sorted(computed.items()):
+                self.__compare(check, name, actual, "damaged")
+
+        if check["manifest"] is not None:
+            damaged = {}
+
+            for future in check["chunks"]:
+                damaged.update(future.result())
+
+            for name, expected in sorted(check["expected"].items()):
+                indexes = [
+                    index for index, digest in enumerate(expected["chunks"])
+                    if digest in damaged]
+
+                if indexes:
+                    self.__addResult(
+                        check, name, "damaged", indexes,
+                        expected["chunk_size"],
+                        "%s chunks missing or damaged" % (len(indexes)))
+
+                elif check["manifest"][name] not in [
+                        None, expected["sha256"]]:
+                    self.__addResult(
+                        check, name, "damaged",
+                        message="image checksum differs from manifest")
+
+                else:
+                    self.__addResult(check, name, "ok")
+
+        for name, future in sorted(check["images"].items()):
+            try:
+                actual = future.result()
+
+            except Exception as error:
+                self.__addResult(check, name, "unreadable",
+                                 message=str(error))
+                continue
+
+            self.__compare(check, name, actual, "damaged")
+
+        for name, future in sorted(check["live"].items()):
+            try:
+                actual = future.result()
+
+            except Exception as error:
+                self.__addResult(check, "live " + name, "unreadable",
+                                 message=str(error))
+                continue
+
+            self.__compare(check, name, actual, "differs from live image",
+                           label="live " + name)
+
+    def run(self):
+        """Wait for every backup to be verified. Return the number of images
+        with problems"""
+
+        # live images of indexed archives and manifests are checked while
+        # backups are read
+        if self.live:
+            for check in self.checks:
+                if check["archive"] is None:
+                    self.__submitLive(check)
+
+        for check in self.checks:
+            try:
+                self.__collect(check)
+
+            except Exception as error:
+                logger.exception(error)
+                self.__addResult(check, None, "unreadable", message=str(error))
+
+        self.executor.shutdown()
+
+        return len([result for result in self.results
+                    if result["status"] not in ["ok", "no checksums"]])
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A fake checkpoint provider for incremental backups, which doesn't need
+libvirt. Disks are plain image files, read as guest views. A checkpoint
+stores the digests of every block of disks: blocks whose digest differs
+from the one of a checkpoint are dirty. Call install() after
+fakelibvirt.install() and before doing backups
+
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+
+from Lib import incremental, sparse
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the granularity of dirty bitmaps, like qemu
+BLOCK_SIZE = 64 * 1024
+
+
+def getDigests(path):
+    """Return the digest of every block of a file. Holes have no digest"""
+
+    size = os.path.getsize(path)
+    digests = [None] * ((size + BLOCK_SIZE - 1) // BLOCK_SIZE)
+
+    with open(path, "rb") as handle:
+        for offset, length in sparse.getExtents(handle, size):
+            first = offset // BLOCK_SIZE
+            last = (offset + length - 1) // BLOCK_SIZE
+
+            for index in range(first, last + 1):
+                handle.seek(index * BLOCK_SIZE)
+                digests[index] = hashlib.sha1(
+                    handle.read(BLOCK_SIZE)).hexdigest()
+
+    return digests
+
+
+def getRanges(indexes, size):
+    """Return (offset, length) of the blocks with indexes, merging
+    adjacent ones"""
+
+    extents = []
+
+    for index in sorted(indexes):
+        offset = index * BLOCK_SIZE
+        length = min(BLOCK_SIZE, size - offset)
+
+        if extents and sum(extents[-1]) == offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+
+        else:
+            extents += [(offset, length)]
+
+    return extents
+
+
+class FakeProvider(incremental.Provider):
+    """Checkpoints saved as JSON files in a directory"""
+
+    # where checkpoints are saved, set by install()
+    state_dir = None
+
+    def __init__(self, snapshot, parameters):
+        incremental.Provider.__init__(self, snapshot, parameters)
+
+        self.path = os.path.join(self.state_dir, self.domain_name)
+
+        # the digests of disks, saved with checkpoint when job ends
+        self.digests = {}
+
+    def getCheckpointPath(self, name):
+        return os.path.join(self.path, name + ".json")
+
+    def listCheckpoints(self):
+        if not os.path.exists(self.path):
+            return []
+
+        return sorted([name[:-5] for name in os.listdir(self.path)
+                       if name.endswith(".json")])
+
+    def removeCheckpoint(self, name):
+        logger.info("Removing checkpoint %s of %s" % (name, self.domain_name))
+        os.remove(self.getCheckpointPath(name))
+
+    def begin(self, checkpoint=None, parent=None):
+        self.checkpoint = checkpoint
+        self.parent = parent
+        self.disks = self.snapshot.getDisks()
+
+        for dev, source in iter(self.disks.items()):
+            self.digests[dev] = getDigests(source)
+
+        # a backup job could have no checkpoint
+        if checkpoint is None:
+            return
+
+        # like libvirt, checkpoint is created when job begins
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        with open(self.getCheckpointPath(checkpoint), "w") as handle:
+            json.dump(self.digests, handle)
+
+    def getSize(self, dev):
+        return os.path.getsize(self.disks[dev])
+
+    def getExtents(self, dev):
+        size = self.getSize(dev)
+
+        if self.parent is None:
+            with open(self.disks[dev], "rb") as handle:
+                return sparse.getExtents(handle, size)
+
+        with open(self.getCheckpointPath(self.parent)) as handle:
+            previous = json.load(handle).get(dev, [])
+
+        current = self.digests[dev]
+
+        # blocks changed, or beyond the previous size
+        dirty = [index for index, digest in enumerate(current)
+                 if index >= len(previous) or previous[index] != digest]
+
+        return getRanges(dirty, size)
+
+    def read(self, dev, offset, length):
+        with open(self.disks[dev], "rb") as handle:
+            handle.seek(offset)
+            return handle.read(length)
+
+    def end(self):
+        self.digests = {}
+
+
+def install(state_dir):
+    """Use the fake provider for incremental backups, saving checkpoints in
+    state_dir"""
+
+    FakeProvider.state_dir = state_dir
+    incremental.PROVIDERS["libvirt"] = FakeProvider
+
+    return FakeProvider
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A fake of the libvirt and libvirt_qemu API used by kvmBackup. Domains are
+backed by plain image files: snapshots create empty top images and block
+commits pivot back to the original images. Backup jobs in pull mode export
+images with the NBD server of fakenbd (checkpoints are not supported). Call
+install() before importing kvmBackup modules
+
+"""
+
+from __future__ import print_function
+
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# To inspect xml
+import xml.etree.ElementTree as ET
+
+import fakenbd
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# libvirt constants used by kvmBackup
+VIR_DOMAIN_XML_SECURE = 1
+VIR_DOMAIN_XML_INACTIVE = 2
+VIR_DOMAIN_XML_UPDATE_CPU = 4
+VIR_DOMAIN_XML_MIGRATABLE = 8
+
+VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY = 16
+VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE = 64
+VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC = 128
+VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY = 2
+
+VIR_DOMAIN_BLOCK_COMMIT_ACTIVE = 4
+VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT = 2
+VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT = 4
+VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2 = 16
+
+VIR_DOMAIN_BLOCK_JOB_COMPLETED = 0
+VIR_DOMAIN_BLOCK_JOB_FAILED = 1
+VIR_DOMAIN_BLOCK_JOB_CANCELED = 2
+VIR_DOMAIN_BLOCK_JOB_READY = 3
+
+
+class libvirtError(Exception):
+    pass
+
+
+class Hypervisor():
+    """The state of fake domains, shared by every connection"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.domains = {}
+        self.callbacks = []
+
+        # seconds needed by a block commit to reach the ready state
+        self.commit_delay = 0.0
+
+        # seconds waited by every NBD request of backup jobs
+        self.nbd_latency = 0.0
+
+    def addDomain(self, name, disks, active=True, agent=True):
+        """Define a domain. disks is a dictionary of dev: image path"""
+
+        with self.lock:
+            self.domains[name] = {
+                "active": active,
+                "agent": agent,
+                "disks": dict(disks),
+                "base": None,
+                "snapshot": None,
+                "snapshot_xml": None,
+                "jobs": {},
+                "backup": None}
+
+    def getDomain(self, name):
+        with self.lock:
+            if name not in self.domains:
+                raise libvirtError(
+                    "Domain not found: no domain with matching name '%s'" % (
+                        name))
+
+            return self.domains[name]
+
+    def emit(self, domain, disk, status):
+        """Call block job callbacks, like libvirt event loop does"""
+
+        for callback, opaque in list(self.callbacks):
+            callback(None, domain, disk,
+                     VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT, status, opaque)
+
+
+# the global fake hypervisor
+hypervisor = Hypervisor()
+
+
+class virDomainSnapshot():
+    def __init__(self, domain, name):
+        self.domain = domain
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def getXMLDesc(self, flags=0):
+        return hypervisor.getDomain(self.domain.name())["snapshot_xml"]
+
+    def delete(self, flags=0):
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self.domain.name())
+            state["snapshot"] = None
+            state["snapshot_xml"] = None
+
+
+class virDomain():
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def isActive(self):
+        return int(hypervisor.getDomain(self._name)["active"])
+
+    def XMLDesc(self, flags=0):
+        state = hypervisor.getDomain(self._name)
+
+        # inactive XML describes the images used when domain is started
+        disks = state["disks"]
+
+        if flags & VIR_DOMAIN_XML_INACTIVE and state["base"]:
+            disks = state["base"]
+
+        root = ET.Element("domain", type="kvm")
+        ET.SubElement(root, "name").text = self._name
+        devices = ET.SubElement(root, "devices")
+
+        for dev, source in sorted(disks.items()):
+            disk = ET.SubElement(devices, "disk", type="file", device="disk")
+            ET.SubElement(disk, "driver", name="qemu", type="qcow2")
+            ET.SubElement(disk, "source", file=source)
+            ET.SubElement(disk, "target", dev=dev, bus="virtio")
+
+        return ET.tostring(root, encoding="unicode")
+
+    def hasCurrentSnapshot(self, flags=0):
+        return int(hypervisor.getDomain(self._name)["snapshot"] is not None)
+
+    def snapshotCurrent(self, flags=0):
+        name = hypervisor.getDomain(self._name)["snapshot"]
+
+        if name is None:
+            raise libvirtError("domain has no current snapshot")
+
+        return virDomainSnapshot(self, name)
+
+    def snapshotCreateXML(self, xmlDesc, flags=0):
+        root = ET.fromstring(xmlDesc)
+        name = root.find("name").text
+
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self._name)
+
+            if state["snapshot"] is not None:
+                raise libvirtError("domain has already a snapshot")
+
+            state["base"] = dict(state["disks"])
+
+            # like libvirt, snapshot XML has the domain definition
+            root.append(ET.fromstring(self.XMLDesc()))
+            state["snapshot_xml"] = ET.tostring(root, encoding="unicode")
+
+            for disk in root.findall("./disks/disk"):
+                top = disk.find("source").get("file")
+
+                # an empty top image. open is the libvirt function here
+                io.open(top, "w").close()
+                state["disks"][disk.get("name")] = top
+
+            state["snapshot"] = name
+
+        return virDomainSnapshot(self, name)
+
+    def blockCommit(self, disk, base, top, bandwidth=0, flags=0):
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self._name)
+
+            if disk in state["jobs"]:
+                raise libvirtError("disk '%s' already in active block job" % (
+                    disk))
+
+            size = os.path.getsize(state["disks"][disk])
+            job = {"type": VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT,
+                   "bandwidth": bandwidth, "cur": 0, "end": size}
+            state["jobs"][disk] = job
+
+        def ready():
+            time.sleep(hypervisor.commit_delay)
+            job["cur"] = job["end"]
+            hypervisor.emit(self, disk, VIR_DOMAIN_BLOCK_JOB_READY)
+
+        thread = threading.Thread(target=ready)
+        thread.daemon = True
+        thread.start()
+
+        return 0
+
+    def blockJobInfo(self, disk, flags=0):
+        with hypervisor.lock:
+            return dict(hypervisor.getDomain(self._name)["jobs"].get(disk, {}))
+
+    def blockJobAbort(self, disk, flags=0):
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self._name)
+            state["jobs"].pop(disk, None)
+
+            if flags & VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT:
+                state["disks"][disk] = state["base"][disk]
+
+        hypervisor.emit(self, disk, VIR_DOMAIN_BLOCK_JOB_COMPLETED)
+
+        return 0
+
+    def fsFreeze(self, mountpoints=None, flags=0):
+        return 0
+
+    def fsThaw(self, mountpoints=None, flags=0):
+        return 0
+
+    def listAllCheckpoints(self, flags=0):
+        return []
+
+    def backupBegin(self, backupXML, checkpointXML=None, flags=0):
+        if checkpointXML is not None:
+            raise libvirtError("checkpoints are not supported by fake")
+
+        root = ET.fromstring(backupXML)
+
+        if root.get("mode") != "pull":
+            raise libvirtError("only backup jobs in pull mode are supported")
+
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self._name)
+
+            if not state["active"]:
+                raise libvirtError("domain is not running")
+
+            if state["backup"] is not None or state["jobs"]:
+                raise libvirtError("domain has an active block job")
+
+            # the images of disks, by export name
+            exports = {}
+
+            for disk in root.findall("./disks/disk"):
+                if disk.get("backup", "yes") != "yes":
+                    continue
+
+                exports[disk.get("exportname", disk.get("name"))] = \
+                    state["disks"][disk.get("name")]
+
+            server = fakenbd.Server(
+                root.find("server").get("socket"), exports,
+                latency=hypervisor.nbd_latency)
+            server.start()
+
+            state["backup"] = {"xml": backupXML, "server": server}
+
+        return 0
+
+    def backupGetXMLDesc(self, flags=0):
+        backup = hypervisor.getDomain(self._name)["backup"]
+
+        if backup is None:
+            raise libvirtError("no domain backup job present")
+
+        return backup["xml"]
+
+    def abortJob(self):
+        with hypervisor.lock:
+            state = hypervisor.getDomain(self._name)
+
+            if state["backup"] is None:
+                raise libvirtError("no job is active on the domain")
+
+            state["backup"]["server"].stop()
+            state["backup"] = None
+
+        return 0
+
+
+class virConnect():
+    def __init__(self, uri):
+        self.uri = uri
+
+    def isAlive(self):
+        return 1
+
+    def close(self):
+        return 0
+
+    def listAllDomains(self, flags=0):
+        with hypervisor.lock:
+            return [virDomain(name) for name in sorted(hypervisor.domains)]
+
+    def lookupByName(self, name):
+        hypervisor.getDomain(name)
+        return virDomain(name)
+
+    def defineXML(self, xml):
+        root = ET.fromstring(xml)
+        name = root.find("name").text
+
+        disks = dict([
+            (disk.find("target").get("dev"), disk.find("source").get("file"))
+            for disk in root.findall("./devices/disk[@device='disk']")])
+
+        with hypervisor.lock:
+            active = name in hypervisor.domains and \
+                hypervisor.domains[name]["active"]
+
+            hypervisor.addDomain(name, disks, active=active)
+
+        return virDomain(name)
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        hypervisor.callbacks += [(cb, opaque)]
+        return len(hypervisor.callbacks)
+
+
+def open(name=None):
+    return virConnect(name)
+
+
+def virEventRegisterDefaultImpl():
+    return 0
+
+
+def virEventRunDefaultImpl():
+    # events are emitted by block job threads
+    time.sleep(0.1)
+    return 0
+
+
+def qemuAgentCommand(domain, cmd, timeout, flags):
+    """The libvirt_qemu function: reply to guest-ping only"""
+
+    state = hypervisor.getDomain(domain.name())
+
+    if not state["agent"] or not state["active"]:
+        raise libvirtError("Guest agent is not responding")
+
+    if json.loads(cmd)["execute"] != "guest-ping":
+        raise libvirtError("command not supported by fake guest agent")
+
+    return json.dumps({"return": {}})
+
+
+def install():
+    """Replace libvirt and libvirt_qemu modules with this fake"""
+
+    module = sys.modules[__name__]
+
+    sys.modules["libvirt"] = module
+    sys.modules["libvirt_qemu"] = module
+
+    return hypervisor
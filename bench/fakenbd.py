@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A NBD server standing in for qemu-nbd and for the NBD server of libvirt
+backup jobs. Plain image files are exported read only in a unix socket,
+with the fixed newstyle handshake, structured replies, the 'base:allocation'
+context (from the holes of files) and 'qemu:dirty-bitmap:' contexts (from
+lists of extents). Files are served as they are: unlike qemu, writes done
+while they are read are not hidden. Every connection is served by its own
+thread, and latency could be added to replies to mimic a remote server. Run
+it like qemu-nbd:
+
+    python bench/fakenbd.py --socket /tmp/vda.sock --export vda=vda.img
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# handshake magic numbers and flags
+NBD_MAGIC = b"NBDMAGIC"
+IHAVEOPT = 0x49484156454F5054
+REPLY_MAGIC = 0x3e889045565a9
+NBD_FLAG_FIXED_NEWSTYLE = 1
+NBD_FLAG_NO_ZEROES = 2
+
+# options, and their replies
+NBD_OPT_ABORT = 2
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_OPT_SET_META_CONTEXT = 10
+
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_META_CONTEXT = 4
+NBD_REP_ERR_UNSUP = 1 | (1 << 31)
+NBD_REP_ERR_UNKNOWN = 6 | (1 << 31)
+
+NBD_INFO_EXPORT = 0
+NBD_INFO_BLOCK_SIZE = 3
+
+# transmission flags: the export has flags and is read only
+NBD_FLAG_HAS_FLAGS = 1
+NBD_FLAG_READ_ONLY = 2
+
+# commands, and their replies
+SIMPLE_REPLY_MAGIC = 0x67446698
+STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+NBD_CMD_BLOCK_STATUS = 7
+
+NBD_REPLY_FLAG_DONE = 1
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_OFFSET_HOLE = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+
+NBD_EINVAL = 22
+
+# metadata contexts, and their flags
+BASE_ALLOCATION = "base:allocation"
+DIRTY_BITMAP = "qemu:dirty-bitmap:"
+
+NBD_STATE_HOLE = 1
+NBD_STATE_ZERO = 2
+NBD_STATE_DIRTY = 1
+
+# block sizes announced to clients
+PREFERRED_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 32 * 1024 * 1024
+
+
+def getExtents(handle, size):
+    """Return (offset, length) of the data of a file, skipping holes"""
+
+    extents = []
+    offset = 0
+
+    while offset < size:
+        try:
+            start = os.lseek(handle.fileno(), offset, os.SEEK_DATA)
+
+        except OSError as error:
+            # no data after offset
+            if error.errno == errno.ENXIO:
+                break
+
+            raise
+
+        end = min(os.lseek(handle.fileno(), start, os.SEEK_HOLE), size)
+        extents += [(start, end - start)]
+        offset = end
+
+    return extents
+
+
+class Connection():
+    """A client of the server"""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+
+        # set by negotiation
+        self.structured = False
+        self.export = None
+        self.handle = None
+
+        # context ids, with the extents of their dirty bitmaps (None for
+        # 'base:allocation')
+        self.contexts = {}
+
+    def recv(self, size):
+        chunks = []
+
+        while size > 0:
+            data = self.socket.recv(min(size, 1024 * 1024))
+
+            if not data:
+                raise EOFError()
+
+            chunks += [data]
+            size -= len(data)
+
+        return b"".join(chunks)
+
+    def sendOption(self, option, reply, data=b""):
+        self.socket.sendall(struct.pack(
+            ">QIII", REPLY_MAGIC, option, reply, len(data)) + data)
+
+    def sendChunk(self, handle, reply_type, data=b"", done=False):
+        self.socket.sendall(struct.pack(
+            ">IHHQI", STRUCTURED_REPLY_MAGIC,
+            NBD_REPLY_FLAG_DONE if done else 0, reply_type, handle,
+            len(data)) + data)
+
+    def sendError(self, handle, error):
+        if self.structured:
+            self.sendChunk(
+                handle, NBD_REPLY_TYPE_ERROR,
+                struct.pack(">IH", error, 0), done=True)
+
+        else:
+            self.socket.sendall(struct.pack(
+                ">IIQ", SIMPLE_REPLY_MAGIC, error, handle))
+
+    def negotiate(self):
+        """Return True when an export was opened"""
+
+        self.socket.sendall(NBD_MAGIC + struct.pack(
+            ">QH", IHAVEOPT,
+            NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+
+        self.recv(4)
+
+        while True:
+            magic, option, length = struct.unpack(">QII", self.recv(16))
+            data = self.recv(length)
+
+            if option == NBD_OPT_STRUCTURED_REPLY:
+                self.structured = True
+                self.sendOption(option, NBD_REP_ACK)
+
+            elif option == NBD_OPT_SET_META_CONTEXT:
+                self.setContexts(data)
+
+            elif option == NBD_OPT_GO:
+                size, = struct.unpack(">I", data[:4])
+                name = data[4:4 + size].decode("utf-8")
+
+                if name not in self.server.exports:
+                    self.sendOption(
+                        option, NBD_REP_ERR_UNKNOWN,
+                        ("Export '%s' not found" % (name)).encode("utf-8"))
+                    continue
+
+                self.export = name
+                self.handle = open(self.server.exports[name], "rb")
+
+                self.sendOption(option, NBD_REP_INFO, struct.pack(
+                    ">HQH", NBD_INFO_EXPORT, self.getSize(),
+                    NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY))
+                self.sendOption(option, NBD_REP_INFO, struct.pack(
+                    ">HIII", NBD_INFO_BLOCK_SIZE, 1,
+                    PREFERRED_BLOCK_SIZE, MAX_BLOCK_SIZE))
+                self.sendOption(option, NBD_REP_ACK)
+
+                return True
+
+            elif option == NBD_OPT_ABORT:
+                self.sendOption(option, NBD_REP_ACK)
+                return False
+
+            else:
+                self.sendOption(option, NBD_REP_ERR_UNSUP)
+
+    def setContexts(self, data):
+        """Reply to NBD_OPT_SET_META_CONTEXT with the contexts found"""
+
+        size, = struct.unpack(">I", data[:4])
+        name = data[4:4 + size].decode("utf-8")
+        position = 4 + size
+
+        count, = struct.unpack(">I", data[position:position + 4])
+        position += 4
+
+        bitmaps = self.server.bitmaps.get(name, {})
+
+        for i in range(count):
+            size, = struct.unpack(">I", data[position:position + 4])
+            context = data[position + 4:position + 4 + size].decode("utf-8")
+            position += 4 + size
+
+            if context == BASE_ALLOCATION:
+                extents = None
+
+            elif (context.startswith(DIRTY_BITMAP) and
+                    context[len(DIRTY_BITMAP):] in bitmaps):
+                extents = bitmaps[context[len(DIRTY_BITMAP):]]
+
+            else:
+                continue
+
+            context_id = len(self.contexts) + 1
+            self.contexts[context_id] = extents
+
+            self.sendOption(
+                NBD_OPT_SET_META_CONTEXT, NBD_REP_META_CONTEXT,
+                struct.pack(">I", context_id) + context.encode("utf-8"))
+
+        self.sendOption(NBD_OPT_SET_META_CONTEXT, NBD_REP_ACK)
+
+    def getSize(self):
+        return os.fstat(self.handle.fileno()).st_size
+
+    def getAllocation(self, offset, length):
+        """Return (offset, length, flags) of data and holes of export"""
+
+        status = []
+        position = offset
+
+        for start, size in getExtents(self.handle, self.getSize()):
+            start, end = max(start, offset), min(start + size, offset + length)
+
+            if start >= end:
+                continue
+
+            if start > position:
+                status += [(position, start - position,
+                            NBD_STATE_HOLE | NBD_STATE_ZERO)]
+
+            status += [(start, end - start, 0)]
+            position = end
+
+        if position < offset + length:
+            status += [(position, offset + length - position,
+                        NBD_STATE_HOLE | NBD_STATE_ZERO)]
+
+        return status
+
+    def getDirty(self, extents, offset, length):
+        """Return (offset, length, flags) of a dirty bitmap"""
+
+        status = []
+        position = offset
+
+        for start, size in extents:
+            start, end = max(start, offset), min(start + size, offset + length)
+
+            if start >= end:
+                continue
+
+            if start > position:
+                status += [(position, start - position, 0)]
+
+            status += [(start, end - start, NBD_STATE_DIRTY)]
+            position = end
+
+        if position < offset + length:
+            status += [(position, offset + length - position, 0)]
+
+        return status
+
+    def read(self, handle, offset, length):
+        if not self.structured:
+            self.handle.seek(offset)
+            data = self.handle.read(length)
+
+            self.socket.sendall(struct.pack(
+                ">IIQ", SIMPLE_REPLY_MAGIC, 0, handle) + data.ljust(
+                    length, b"\0"))
+            return
+
+        # data are sent in chunks, holes are not sent at all
+        for start, size, flags in self.getAllocation(offset, length):
+            if flags & NBD_STATE_HOLE:
+                self.sendChunk(handle, NBD_REPLY_TYPE_OFFSET_HOLE,
+                               struct.pack(">QI", start, size))
+
+            else:
+                self.handle.seek(start)
+                self.sendChunk(
+                    handle, NBD_REPLY_TYPE_OFFSET_DATA,
+                    struct.pack(">Q", start) + self.handle.read(size).ljust(
+                        size, b"\0"))
+
+        self.sendChunk(handle, NBD_REPLY_TYPE_NONE, done=True)
+
+    def blockStatus(self, handle, offset, length):
+        for context_id, extents in sorted(self.contexts.items()):
+            if extents is None:
+                status = self.getAllocation(offset, length)
+
+            else:
+                status = self.getDirty(extents, offset, length)
+
+            data = struct.pack(">I", context_id) + b"".join([
+                struct.pack(">II", size, flags)
+                for start, size, flags in status])
+
+            self.sendChunk(handle, NBD_REPLY_TYPE_BLOCK_STATUS, data)
+
+        self.sendChunk(handle, NBD_REPLY_TYPE_NONE, done=True)
+
+    def serve(self):
+        """Reply to commands, until client disconnects"""
+
+        while True:
+            magic, flags, command, handle, offset, length = struct.unpack(
+                ">IHHQQI", self.recv(28))
+
+            if command == NBD_CMD_DISC:
+                return
+
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            if offset + length > self.getSize():
+                self.sendError(handle, NBD_EINVAL)
+
+            elif command == NBD_CMD_READ:
+                self.read(handle, offset, length)
+
+            elif (command == NBD_CMD_BLOCK_STATUS and self.structured and
+                    self.contexts):
+                self.blockStatus(handle, offset, length)
+
+            else:
+                self.sendError(handle, NBD_EINVAL)
+
+    def run(self):
+        try:
+            if self.negotiate():
+                self.serve()
+
+        except (EOFError, IOError, OSError):
+            pass
+
+        finally:
+            if self.handle is not None:
+                self.handle.close()
+
+            self.socket.close()
+            self.server.remove(self)
+
+
+class Server():
+    """A NBD server of image files in a unix socket"""
+
+    def __init__(self, path, exports, bitmaps=None, latency=0.0):
+        """exports is a dictionary of name: image path. bitmaps are the
+        dirty bitmaps of exports, as a dictionary of export: {bitmap:
+        [(offset, length)]}. latency is the seconds waited by every
+        request"""
+
+        self.path = path
+        self.exports = dict(exports)
+        self.bitmaps = bitmaps or {}
+        self.latency = latency
+
+        self.socket = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Listen in socket, serving clients in a thread"""
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(16)
+
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+        logger.debug("Serving %s in '%s'" % (
+            sorted(self.exports), self.path))
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+
+            except (IOError, OSError):
+                return
+
+            connection = Connection(self, sock)
+
+            with self.lock:
+                self.connections += [connection]
+
+            thread = threading.Thread(target=connection.run)
+            thread.daemon = True
+            thread.start()
+
+    def remove(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def stop(self):
+        """Close socket and connections"""
+
+        if self.socket is None:
+            return
+
+        # shutdown wakes up accept
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+
+        except (IOError, OSError):
+            pass
+
+        self.socket.close()
+        self.socket = None
+        self.thread.join()
+
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.socket.shutdown(socket.SHUT_RDWR)
+
+                except (IOError, OSError):
+                    pass
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        logger.debug("Server in '%s' stopped" % (self.path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export image files with NBD in a unix socket")
+    parser.add_argument(
+        "--socket", required=True, help="the unix socket to listen in")
+    parser.add_argument(
+        "--export", action="append", required=True,
+        help="an export, as name=path. Could be repeated")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="seconds waited by every request (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    server = Server(
+        args.socket, [item.split("=", 1) for item in args.export],
+        latency=args.latency)
+    server.start()
+
+    print("Serving in '%s': press Ctrl-C to stop" % (args.socket))
+
+    try:
+        while True:
+            time.sleep(1)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.stop()
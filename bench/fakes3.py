@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+A fake of the boto3 S3 client used by kvmBackup. Buckets are directories
+and objects are files in a root directory, while parts of multipart
+uploads are files in a hidden directory. Call install() before importing
+kvmBackup modules
+
+"""
+
+from __future__ import print_function
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import sys
+import threading
+import uuid
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# where uploads in progress are stored, inside root
+UPLOADS_DIR = ".uploads"
+
+
+class FakeS3Client():
+    """A S3 client which stores objects in root directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+        # the number of requests, by method
+        self.calls = {}
+
+        # the maximum number of parts uploaded at the same time
+        self.uploading = 0
+        self.max_uploading = 0
+
+        # bucket and key of uploads in progress, by upload id
+        self.uploads = {}
+
+    def __count(self, method):
+        with self.lock:
+            self.calls.setdefault(method, 0)
+            self.calls[method] += 1
+
+    def __getPath(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def __getUpload(self, upload_id):
+        return os.path.join(self.root, UPLOADS_DIR, upload_id)
+
+    def __write(self, path, data):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, "wb") as handle:
+            handle.write(data)
+
+    def put_object(self, Bucket, Key, Body):
+        self.__count("put_object")
+        self.__write(self.__getPath(Bucket, Key), bytes(Body))
+
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def head_object(self, Bucket, Key):
+        self.__count("head_object")
+        path = self.__getPath(Bucket, Key)
+
+        if not os.path.isfile(path):
+            raise IOError("Object '%s' not found in '%s'" % (Key, Bucket))
+
+        return {"ContentLength": os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.__count("get_object")
+
+        # the body is a stream, like a boto3 StreamingBody
+        handle = open(self.__getPath(Bucket, Key), "rb")
+
+        # ranges like 'bytes=start-' or 'bytes=start-end'
+        if Range is not None:
+            start, end = Range.split("=")[1].split("-")
+            handle.seek(int(start))
+
+            if end:
+                data = handle.read(int(end) - int(start) + 1)
+                handle.close()
+                handle = io.BytesIO(data)
+
+        return {"Body": handle}
+
+    def delete_object(self, Bucket, Key):
+        self.__count("delete_object")
+        path = self.__getPath(Bucket, Key)
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.__count("copy_object")
+
+        target = self.__getPath(Bucket, Key)
+
+        if not os.path.exists(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+
+        shutil.copyfile(
+            self.__getPath(CopySource["Bucket"], CopySource["Key"]), target)
+
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None,
+                        MaxKeys=1000, ContinuationToken=None):
+        self.__count("list_objects_v2")
+
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+
+        for dirpath, dirnames, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                key = os.path.relpath(
+                    os.path.join(dirpath, filename), bucket_dir)
+
+                if key.startswith(Prefix):
+                    keys += [key]
+
+        contents, prefixes = [], set()
+
+        for key in sorted(keys):
+            rest = key[len(Prefix):]
+
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+
+            else:
+                contents += [{"Key": key}]
+
+        # the continuation token is the index of the next key
+        start = int(ContinuationToken or 0)
+        response = {
+            "Contents": contents[start:start + MaxKeys],
+            "CommonPrefixes": [{"Prefix": prefix}
+                               for prefix in sorted(prefixes)],
+            "IsTruncated": start + MaxKeys < len(contents)}
+
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + MaxKeys)
+
+        return response
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.__count("create_multipart_upload")
+
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.__getUpload(upload_id))
+
+        with self.lock:
+            self.uploads[upload_id] = (Bucket, Key)
+
+        return {"UploadId": upload_id}
+
+    def list_multipart_uploads(self, Bucket, Prefix="", KeyMarker=None,
+                               UploadIdMarker=None):
+        self.__count("list_multipart_uploads")
+
+        with self.lock:
+            uploads = sorted([
+                (key, upload_id) for upload_id, (bucket, key) in
+                self.uploads.items()
+                if bucket == Bucket and key.startswith(Prefix)])
+
+        # all uploads are listed at once
+        return {
+            "Uploads": [{"Key": key, "UploadId": upload_id}
+                        for key, upload_id in uploads],
+            "IsTruncated": False}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.__count("upload_part")
+
+        with self.lock:
+            self.uploading += 1
+            self.max_uploading = max(self.max_uploading, self.uploading)
+
+        try:
+            self.__write(os.path.join(
+                self.__getUpload(UploadId), str(PartNumber)), Body)
+
+        finally:
+            with self.lock:
+                self.uploading -= 1
+
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber,
+                         CopySource, CopySourceRange):
+        self.__count("upload_part_copy")
+
+        start, end = [
+            int(value) for value in CopySourceRange[6:].split("-")]
+
+        with open(self.__getPath(
+                CopySource["Bucket"], CopySource["Key"]), "rb") as handle:
+            handle.seek(start)
+            data = handle.read(end - start + 1)
+
+        self.__write(os.path.join(
+            self.__getUpload(UploadId), str(PartNumber)), data)
+
+        return {"CopyPartResult": {"ETag": hashlib.md5(data).hexdigest()}}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self.__count("complete_multipart_upload")
+
+        upload_dir = self.__getUpload(UploadId)
+        path = self.__getPath(Bucket, Key)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+
+        if numbers != list(range(1, len(numbers) + 1)):
+            raise IOError("Parts of '%s' are not in order" % (Key))
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, "wb") as handle:
+            for number in numbers:
+                with open(os.path.join(upload_dir, str(number)), "rb") as src:
+                    shutil.copyfileobj(src, handle)
+
+        shutil.rmtree(upload_dir)
+
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.__count("abort_multipart_upload")
+        shutil.rmtree(self.__getUpload(UploadId), ignore_errors=True)
+
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+
+        return {}
+
+
+# the client returned by client()
+s3 = None
+
+
+def client(service_name, **kwargs):
+    """Return the fake S3 client"""
+
+    if service_name != "s3" or s3 is None:
+        raise RuntimeError("Only a S3 client is provided by fakes3")
+
+    return s3
+
+
+def install(root):
+    """Replace boto3 module with this fake, storing objects in root"""
+
+    global s3
+
+    s3 = FakeS3Client(root)
+    sys.modules["boto3"] = sys.modules[__name__]
+
+    return s3
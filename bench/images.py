@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Generate synthetic disk images for benchmarks. Dense images are fully
+allocated, sparse images are thin provisioned with a fraction of allocated
+blocks. Data is half random and half repeated text, in order to be only
+partially compressible, like real images
+
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import random
+
+# Logging istance
+logger = logging.getLogger(__name__)
+
+# the size of data blocks written
+BLOCK_SIZE = 1024 * 1024
+
+# image kinds
+KINDS = ["dense", "sparse"]
+
+
+def getBlock(rand):
+    """Return a block of half random and half compressible data"""
+
+    half = BLOCK_SIZE // 2
+
+    text = b"kvmBackup synthetic image block %08d\n" % (
+        rand.randint(0, 10 ** 8))
+    text = (text * (half // len(text) + 1))[:half]
+
+    return os.urandom(half) + text
+
+
+def makeImage(path, size, kind="dense", ratio=0.25, seed=42):
+    """Write an image of size bytes in path. With kind 'sparse', only ratio
+    of the image blocks are allocated"""
+
+    if kind not in KINDS:
+        raise Exception("Unknown image kind '%s'" % (kind))
+
+    rand = random.Random(seed)
+    blocks = size // BLOCK_SIZE
+
+    logger.info("Creating %s image '%s' (%s MiB)" % (
+        kind, path, size // 1024 ** 2))
+
+    with open(path, "wb") as handle:
+        if kind == "dense":
+            allocated = range(blocks)
+
+        else:
+            # allocated blocks are spread along the image
+            allocated = sorted(
+                rand.sample(range(blocks), max(1, int(blocks * ratio))))
+
+        for index in allocated:
+            handle.seek(index * BLOCK_SIZE)
+            handle.write(getBlock(rand))
+
+        handle.truncate(size)
+
+    return path
+
+
+def getImage(directory, size, kind="dense", ratio=0.25):
+    """Return a cached image, creating it if necessary"""
+
+    path = os.path.join(directory, "%s-%s-%s.img" % (
+        kind, size // 1024 ** 2, int(ratio * 100)))
+
+    if not os.path.exists(path):
+        makeImage(path + ".part", size, kind, ratio)
+        os.rename(path + ".part", path)
+
+    return path
@@ -0,0 +1,467 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Run the whole backup pipeline against a fake libvirt and synthetic images,
+and report throughput, wall time, peak RSS and temporary disk usage for
+every configuration. Each configuration runs in its own process, in order
+to measure its memory usage. The last backup of every configuration is
+then restored and verified: restored images must be equal to the images of
+the fake domain
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fakelibvirt
+import fakes3
+import images
+
+# the program name
+prog_name = os.path.basename(sys.argv[0])
+
+# Logging istance
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(prog_name)
+
+# where kvmBackup.py and Lib are
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the name of the fake domain
+DOMAIN = "bench"
+
+
+class DiskUsage():
+    """Sample the space used in some directories, in order to find the peak
+    usage during a backup"""
+
+    def __init__(self, paths, interval=0.05):
+        self.paths = paths
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def getUsage(self):
+        """Return the allocated bytes in paths"""
+
+        usage = 0
+
+        for path in self.paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        stat = os.lstat(os.path.join(dirpath, filename))
+
+                    except OSError:
+                        # removed while walking
+                        continue
+
+                    usage += stat.st_blocks * 512
+
+        return usage
+
+    def __sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.getUsage())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling, and return the final usage"""
+
+        self.stopped.set()
+        self.thread.join()
+
+        usage = self.getUsage()
+        self.peak = max(self.peak, usage)
+
+        return usage
+
+
+def getDigest(path):
+    """Return the sha256 of a file"""
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as handle:
+        for data in iter(lambda: handle.read(images.BLOCK_SIZE), b""):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def checkBackup(config, parameters, target):
+    """Restore and verify the last backup of the fake domain. Raise an
+    exception if restored images differ from domain images. Return the
+    check status"""
+
+    import kvmBackup
+    from Lib import restore
+
+    path = restore.findBackup(target, DOMAIN, parameters=parameters)
+    dest = os.path.join(config["rundir"], "restored")
+
+    restore.Restore(path, dest=dest, parameters=parameters).run()
+
+    problems = kvmBackup.verifyBackups({DOMAIN: parameters}, target)
+
+    if problems:
+        raise Exception("%s images of '%s' are damaged" % (problems, path))
+
+    for image in config["images"]:
+        restored = os.path.join(dest, os.path.basename(image))
+
+        if getDigest(restored) != getDigest(image):
+            raise Exception("'%s' differs from '%s'" % (restored, image))
+
+    # restored images are not needed
+    shutil.rmtree(dest)
+
+    return "ok"
+
+
+def runConfiguration(config):
+    """Backup the fake domain as described by config. This is called in a
+    dedicated process"""
+
+    hypervisor = fakelibvirt.install()
+    hypervisor.commit_delay = config["commit_delay"]
+    hypervisor.nbd_latency = config["nbd_latency"]
+
+    backupdir = os.path.join(config["rundir"], "backup")
+    overlay_dir = os.path.join(config["rundir"], "overlays")
+    os.makedirs(backupdir)
+
+    # archives could be uploaded in a fake S3 bucket, stored in backupdir
+    target = backupdir
+
+    if config["storage"] == "s3":
+        fakes3.install(backupdir)
+        target = "s3://bench/backup"
+
+    # now kvmBackup could be imported
+    sys.path.insert(0, REPO_DIR)
+
+    import kvmBackup
+    from Lib import metrics
+
+    # checkpoints of incremental backups are saved in run directory
+    if config["mode"] == "incremental":
+        import fakecheckpoints
+        fakecheckpoints.install(os.path.join(config["rundir"], "checkpoints"))
+
+    if not config["verbose"]:
+        logging.getLogger().setLevel(logging.WARNING)
+        kvmBackup.logger.setLevel(logging.WARNING)
+
+    disks = {}
+
+    for i, image in enumerate(config["images"]):
+        disks["vd%s" % (chr(ord("a") + i))] = image
+
+    hypervisor.addDomain(DOMAIN, disks)
+
+    parameters = {
+        "mode": config["mode"],
+        "compression": config["compression"],
+        "sparse": config["sparse"],
+        "rotate": config["runs"] + 1,
+        "overlay_dir": overlay_dir,
+        "pipelined_commit": config["pipelined_commit"],
+        "engine": config["engine"],
+        "nbd_readers": config["nbd_readers"]}
+
+    usage = DiskUsage([backupdir, overlay_dir])
+    usage.start()
+
+    wall = []
+
+    # backups after the first one rotate archives
+    for i in range(config["runs"]):
+        start = time.time()
+        kvmBackup.backup(DOMAIN, dict(parameters), target)
+        wall += [time.time() - start]
+
+    final = usage.stop()
+
+    # resources used by backups, before checking them
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children_rss = resource.getrusage(
+        resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    # sum time spent in every phase
+    phases = {}
+
+    for phase in metrics.collector.getSummary()["phases"]:
+        if phase["disk"] is None or phase["phase"] != "blockcommit":
+            phases.setdefault(phase["phase"], 0)
+            phases[phase["phase"]] += phase["seconds"] / config["runs"]
+
+    check = "skipped"
+
+    if config["check"]:
+        check = checkBackup(config, parameters, target)
+
+    return {
+        "wall": wall,
+        "peak_rss": peak_rss,
+        "children_rss": children_rss,
+        "peak_disk": usage.peak,
+        "final_disk": final,
+        "phases": phases,
+        "checked": check}
+
+
+def getConfigurations(args, image_paths):
+    """Return a configuration for every combination of arguments"""
+
+    configurations = []
+
+    for mode, compression, sparse in itertools.product(
+            args.modes.split(","), args.compressions.split(","),
+            args.sparse.split(",")):
+
+        # only streamed archives could be written in a remote storage
+        if args.storage != "local" and mode not in [
+                "stream", "indexed", "incremental"]:
+            logger.warning("Skipping %s mode with %s storage" % (
+                mode, args.storage))
+            continue
+
+        # only streamed archives could be read from a backup job
+        engine = args.engine
+
+        if mode not in ["stream", "indexed"]:
+            engine = "snapshot"
+
+        configurations += [{
+            "mode": mode,
+            "engine": engine,
+            "nbd_readers": args.nbd_readers,
+            "nbd_latency": args.nbd_latency,
+            "compression": compression,
+            "sparse": sparse == "yes",
+            "runs": args.runs,
+            "images": image_paths,
+            "commit_delay": args.commit_delay,
+            "pipelined_commit": args.pipelined_commit,
+            "storage": args.storage,
+            "check": not args.no_check,
+            "verbose": args.verbose}]
+
+    return configurations
+
+
+def runBenchmark(config, workdir, index):
+    """Run a configuration in a new process, and return its results"""
+
+    config = dict(config)
+    config["rundir"] = os.path.join(workdir, "run-%s" % (index))
+    os.makedirs(config["rundir"])
+
+    config_path = os.path.join(config["rundir"], "config.json")
+
+    with open(config_path, "w") as handle:
+        json.dump(config, handle)
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--run", config_path],
+        stdout=subprocess.PIPE, stderr=None if config["verbose"] else
+        subprocess.PIPE, universal_newlines=True)
+
+    stdout, stderr = process.communicate()
+
+    if process.returncode != 0:
+        logger.error(stderr)
+        raise Exception("Benchmark %s failed" % (json.dumps(config)))
+
+    result = json.loads(stdout.splitlines()[-1])
+
+    # the backup itself is not needed
+    shutil.rmtree(config["rundir"])
+
+    return result
+
+
+def printResults(results):
+    """Print a summary table"""
+
+    header = "%-12s %-6s %-6s %9s %9s %9s %9s %10s %10s %-7s" % (
+        "mode", "comp", "sparse", "wall(s)", "MB/s", "data MB/s",
+        "RSS(MiB)", "temp(MiB)", "final(MiB)", "check")
+
+    print(header)
+    print("-" * len(header))
+
+    for result in results:
+        compression = result["compression"]
+
+        # disks read from a backup job
+        mode = result["mode"]
+
+        if result["engine"] == "pull":
+            mode += "/pull"
+
+        print("%-12s %-6s %-6s %9.2f %9.1f %9.1f %9.1f %10.1f %10.1f %-7s" % (
+            mode, compression,
+            "yes" if result["sparse"] else "no", result["mean_wall"],
+            result["mb_s"], result["data_mb_s"],
+            max(result["peak_rss"], result["children_rss"]) / 1024 ** 2,
+            (result["peak_disk"] - result["final_disk"]) / 1024 ** 2,
+            result["final_disk"] / 1024 ** 2, result["checked"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark kvmBackup with a fake libvirt')
+    parser.add_argument(
+        "--size", type=int, default=256,
+        help="the size of every image in MiB (def. 256)")
+    parser.add_argument(
+        "--images", type=str, default="dense,sparse",
+        help="comma separated kinds of the domain images (def. dense,sparse)")
+    parser.add_argument(
+        "--ratio", type=float, default=0.25,
+        help="allocated fraction of sparse images (def. 0.25)")
+    parser.add_argument(
+        "--modes", type=str, default="staged,stream,chunks",
+        help="comma separated backup modes (def. staged,stream,chunks)")
+    parser.add_argument(
+        "--compressions", type=str, default="gzip",
+        help="comma separated compression engines (def. gzip)")
+    parser.add_argument(
+        "--sparse", type=str, default="yes",
+        help="comma separated sparse options, yes or no (def. yes)")
+    parser.add_argument(
+        "--runs", type=int, default=2,
+        help="backups for each configuration, with rotation (def. 2)")
+    parser.add_argument(
+        "--commit-delay", type=float, default=0.0,
+        help="seconds needed by a fake block commit (def. 0)")
+    parser.add_argument(
+        "--pipelined-commit", action='store_true',
+        help="commit every disk as soon as it is read")
+    parser.add_argument(
+        "--engine", type=str, default="snapshot",
+        choices=["snapshot", "pull"],
+        help="read disks of stream and indexed modes from a snapshot or "
+             "from a backup job in pull mode (def. snapshot)")
+    parser.add_argument(
+        "--nbd-readers", type=int, default=4,
+        help="NBD connections reading every disk in pull engine (def. 4)")
+    parser.add_argument(
+        "--nbd-latency", type=float, default=0.0,
+        help="seconds waited by every request of fake NBD server (def. 0)")
+    parser.add_argument(
+        "--storage", type=str, default="local", choices=["local", "s3"],
+        help="write archives in a local directory or in a fake S3 bucket "
+             "(def. local)")
+    parser.add_argument(
+        "--no-check", action='store_true',
+        help="don't restore and verify the last backup of every "
+             "configuration")
+    parser.add_argument(
+        "--workdir", type=str,
+        help="where images and backups are placed (def. a temporary dir)")
+    parser.add_argument(
+        "--keep", action='store_true',
+        help="don't remove images at the end")
+    parser.add_argument(
+        "--output", type=str, help="write results as JSON in this file")
+    parser.add_argument(
+        "-v", "--verbose", action='store_true',
+        help="verbose logging")
+    parser.add_argument("--run", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        with open(args.run) as handle:
+            config = json.load(handle)
+
+        print(json.dumps(runConfiguration(config)))
+        sys.exit(0)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="kvmBackup-bench-")
+    image_dir = os.path.join(workdir, "images")
+
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+
+    image_paths = [
+        images.getImage(image_dir, args.size * 1024 ** 2, kind, args.ratio)
+        for kind in args.images.split(",")]
+
+    # logical and allocated size of domain images
+    size = sum([os.path.getsize(path) for path in image_paths])
+    allocated = sum([os.stat(path).st_blocks * 512 for path in image_paths])
+
+    results = []
+
+    try:
+        for index, config in enumerate(getConfigurations(args, image_paths)):
+            logger.info("Running %s mode with %s compression" % (
+                config["mode"], config["compression"]))
+
+            result = runBenchmark(config, workdir, index)
+            result.update(config)
+
+            mean_wall = sum(result["wall"]) / len(result["wall"])
+
+            result.update({
+                "size": size,
+                "allocated": allocated,
+                "mean_wall": mean_wall,
+                "mb_s": size / mean_wall / 1e6,
+                "data_mb_s": allocated / mean_wall / 1e6})
+
+            results += [result]
+
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    printResults(results)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=1)
+
+        logger.info("Results written in '%s'" % (args.output))
@@ -28,18 +28,26 @@ from __future__ import print_function
 
 import argparse
 import datetime
+import json
 import logging
 import os
+import re
 import shutil
+import signal
 import socket
 import sys
 import tarfile
+import threading
 
-import libvirt
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+
 # my functions
-from Lib import flock, helper
+from Lib import (archive, checksum, chunkstore, compression, connection,
+                 daemon, flock, helper, incremental, metrics, offline,
+                 preflight, restore, retention, scheduler, sparse, storage,
+                 throttle, verify)
 
 # the program name
 prog_name = os.path.basename(sys.argv[0])
@@ -59,6 +67,31 @@ under certain conditions; see LICENSE.txt for details.
 
 """
 
+# How backup archives are done. 'staged' copies images in a dated directory,
+# then add them to a tar file which is compressed, 'stream' reads images
+# once and compress them directly in the final archive, 'indexed' streams
+# images in an archive of independently compressed frames, from which a
+# single file could be extracted, 'chunks' stores images in a deduplicating
+# chunk store
+MODES = ["staged", "stream", "indexed", "chunks", "incremental"]
+
+# how a consistent view of disks is read: from images frozen by a snapshot,
+# or from the NBD export of a backup job in pull mode
+ENGINES = ["snapshot", "pull"]
+
+# the options which could be defined at host level, as defaults for every
+# domain, and overridden by domains. Other host options (like 'workers' or
+# 'state_file') are about the whole host
+DOMAIN_OPTIONS = [
+    "agent_timeout", "checkpoint_interval", "checkpoint_provider",
+    "checksum", "chunk_size", "commit_bandwidth", "compression",
+    "compression_level", "compression_threads", "copy_method",
+    "day_of_week", "defer_archive", "disk_workers", "engine", "frame_size",
+    "io_mode", "max_incrementals", "mode", "nbd_readers", "offline",
+    "overlay_dir", "part_size", "pipelined_commit", "retention", "rotate",
+    "s3_endpoint", "schedule", "schedule_time", "scratch_dir", "sftp_key",
+    "sparse", "throttle", "throttle_latency", "upload_workers", "window"]
+
 
 def loadConf(file_conf):
     """A function to open a config file"""
@@ -99,6 +132,19 @@ def loadConf(file_conf):
         raise RuntimeError(
             "Error in configuration file. Check for kvmbackup documentation")
 
+    # a domain could be defined without options
+    for domain_name in mydomains:
+        if mydomains[domain_name] is None:
+            mydomains[domain_name] = {}
+
+    # host options about domains are defaults for every domain
+    for key, value in iter(config[hostname].items()):
+        if key not in DOMAIN_OPTIONS:
+            continue
+
+        for parameters in mydomains.values():
+            parameters.setdefault(key, value)
+
     return mydomains, backupdir, config
 
 
@@ -133,127 +179,857 @@ def filterDomains(domains, user_domains):
     return found_domains
 
 
+def verifyBackups(mydomains, backupdir, user_domains=None, workers=None,
+                  live=False):
+    """Verify the last backup of every domain, and compare them with live
+    images if live is True. Return the number of images with problems"""
+
+    verifier = verify.Verify(workers=workers, live=live)
+    problems = 0
+
+    for domain_name, parameters in sorted(mydomains.items()):
+        if user_domains is not None and domain_name not in user_domains:
+            logger.info("Ignoring domain '%s'" % (domain_name))
+            continue
+
+        # a domain could be placed in a different backup target
+        target = parameters.get("backupdir", backupdir)
+
+        try:
+            verifier.submit(
+                domain_name,
+                restore.findBackup(target, domain_name, parameters=parameters),
+                parameters)
+
+        except Exception as message:
+            logger.error(message)
+            problems += 1
+
+    return problems + verifier.run()
+
+
+def blockCommit(snapshot):
+    """Block commit every disk and record a phase for each of them"""
+
+    domain = snapshot.domain_name
+
+    # images of a domain shut off were read directly
+    if snapshot.offline:
+        return
+
+    with metrics.phase(domain, "blockcommit"):
+        snapshot.doBlockCommit()
+
+    # disks could be committed while others were copied: their time is
+    # measured by snapshot instance
+    for disk, stats in iter(snapshot.commit_stats.items()):
+        metrics.record(domain, "blockcommit", stats["seconds"], disk=disk,
+                       bytes=stats["bytes"])
+
+
+def streamBackup(snapshot, parameters, compressor, archive_name, date,
+                 limits, backend):
+    """Read every image once and stream it to a compressed archive in
+    backend storage, without copying images or writing an uncompressed
+    tar"""
+
+    domain = snapshot.domain_name
+
+    if parameters.get("mode") == "indexed":
+        stream = archive.IndexedArchive(
+            archive_name, compressor, sparse=parameters.get("sparse", True),
+            checksum=parameters.get("checksum", True), throttle=limits,
+            frame_size=int(parameters.get("frame_size", 16) * 1024 * 1024),
+            storage=backend)
+
+    else:
+        stream = archive.StreamArchive(
+            archive_name, compressor, sparse=parameters.get("sparse", True),
+            checksum=parameters.get("checksum", True), throttle=limits,
+            storage=backend)
+
+    # the archive url, for logging
+    archive_path = stream.target
+
+    try:
+        # Add xmls to archive, without writing them in datadir
+        logger.info("Adding XMLs files for domain '%s' to archive '%s'" %
+                    (domain, archive_path))
+
+        with metrics.phase(domain, "xml"):
+            for xml_file, xml in snapshot.getXMLs():
+                stream.addXML(os.path.join(date, xml_file), xml)
+
+        # images of a domain shut off are read directly
+        if (parameters.get("engine", "snapshot") == "pull" and
+                not snapshot.offline):
+            pullDisks(snapshot, parameters, stream, date)
+
+            # wait for compression to finish
+            with metrics.phase(domain, "compression"):
+                stream.close()
+
+            return
+
+        # call snapshot
+        with metrics.phase(domain, "snapshot"):
+            snapshot.callSnapshot()
+
+        logger.info("Streaming image files for '%s' to archive '%s'" %
+                    (domain, archive_path))
+
+        for disk, source in iter(snapshot.disks.items()):
+            # backup file with its relative path
+            img_file = os.path.join(date, os.path.basename(source))
+
+            with metrics.phase(domain, "stream", disk=disk) as phase:
+                phase.bytes = stream.addImage(source, img_file)
+
+            # pivot this disk while the next one is read
+            if parameters.get("pipelined_commit", False):
+                snapshot.startBlockCommit(disk)
+
+        # checksums computed while images were read
+        if stream.checksum:
+            stream.addChecksums(
+                os.path.join(date, domain + checksum.CHECKSUM_SUFFIX))
+
+        # block commit (and delete snapshot)
+        blockCommit(snapshot)
+
+        # wait for compression to finish
+        with metrics.phase(domain, "compression"):
+            stream.close()
+
+    except Exception:
+        stream.abort()
+        raise
+
+
+def readDisks(provider, stream, date):
+    """Add the disks of a running backup job to stream. Return their
+    description"""
+
+    domain = provider.domain_name
+    disks = {}
+
+    for disk, source in sorted(provider.disks.items()):
+        extents = provider.getExtents(disk)
+        size = provider.getSize(disk)
+        length = sum([length for offset, length in extents])
+
+        logger.info("Reading %s bytes of '%s' %s" % (
+            length, source, "changed since %s" % (provider.parent)
+            if provider.parent else "for a full backup"))
+
+        # backup file with its relative path
+        img_file = os.path.join(date, os.path.basename(source))
+
+        reader = provider.open(disk, extents)
+
+        try:
+            with metrics.phase(domain, "stream", disk=disk) as phase:
+                phase.bytes = stream.addDisk(reader, img_file, size, extents)
+
+        finally:
+            reader.close()
+
+        disks[disk] = {
+            "name": img_file,
+            "source": source,
+            "size": size,
+            "bytes": length}
+
+    return disks
+
+
+def pullDisks(snapshot, parameters, stream, date):
+    """Read disks from the NBD export of a backup job in pull mode, without
+    snapshot and blockcommit. Disks are read with many connections, and
+    their guest view is archived like the one of incremental backups"""
+
+    domain = snapshot.domain_name
+    provider = incremental.getProvider(snapshot, parameters)
+
+    logger.info("Streaming disks of '%s' from a backup job to archive "
+                "'%s'" % (domain, stream.target))
+
+    with metrics.phase(domain, "checkpoint"):
+        provider.begin()
+
+    try:
+        info = {
+            "checkpoint": None,
+            "parent": None,
+            "disks": readDisks(provider, stream, date)
+        }
+
+    finally:
+        provider.end()
+
+    # restore knows disks are raw by this file
+    stream.addData(
+        os.path.join(date, domain + incremental.INFO_SUFFIX),
+        json.dumps(info, indent=1).encode("utf-8"))
+
+    # checksums computed while disks were read
+    if stream.checksum:
+        stream.addChecksums(
+            os.path.join(date, domain + checksum.CHECKSUM_SUFFIX))
+
+
+def chunkBackup(snapshot, parameters, backupdir, manifest_path, date,
+                limits, checkpoint, compressor):
+    """Split images in chunks and store them in the chunk store of
+    backupdir. Only new chunks are written, while the backup itself is a
+    manifest listing the chunks of every image. Progress is tracked by
+    checkpoint: if it was loaded, snapshot was adopted and the backup is
+    resumed"""
+
+    domain = snapshot.domain_name
+
+    if checkpoint.state is None:
+        chunk_size = int(parameters.get("chunk_size", 4) * 1024 * 1024)
+
+        with metrics.phase(domain, "xml"):
+            xmls = dict(snapshot.getXMLs())
+
+        manifest = {
+            "domain": domain,
+            "date": date,
+            "chunk_size": chunk_size,
+            "xmls": xmls,
+            "disks": []
+        }
+
+        # call snapshot
+        with metrics.phase(domain, "snapshot"):
+            snapshot.callSnapshot()
+
+        checkpoint.start(
+            snapshot.snapshotId, os.path.basename(manifest_path), manifest)
+
+    else:
+        # XMLs and images completed before backup was interrupted
+        manifest = checkpoint.state["manifest"]
+        chunk_size = manifest["chunk_size"]
+
+    logger.info("Adding image files for '%s' to chunk store '%s'" % (
+        domain, os.path.join(backupdir, chunkstore.CHUNKS_DIR)))
+
+    # stores of every disk, to count their chunks
+    stores = []
+
+    # checkpoint is updated by every disk read
+    lock = threading.Lock()
+
+    def storeDisk(item):
+        disk, source, disk_store = item
+
+        stat = os.stat(source)
+        start, chunks = checkpoint.getCurrent(disk)
+
+        if start > 0:
+            logger.info("Resuming '%s' from offset %s" % (source, start))
+
+        # only one disk at a time could be resumed from its offset
+        if snapshot.offline:
+            progress = None
+
+        else:
+            def progress(offset, chunks):
+                checkpoint.update(disk, offset, chunks)
+
+        logger.debug("Splitting '%s' in chunks" % (source))
+
+        with metrics.phase(domain, "chunks", disk=disk) as phase:
+            chunks = disk_store.putFile(
+                source, chunk_size=chunk_size,
+                is_sparse=parameters.get("sparse", True), start=start,
+                chunks=chunks, progress=progress)
+
+            phase.bytes = disk_store.bytes_read
+
+        # chunks are named by their sha256: the checksum of the whole image
+        # is computed from them
+        with lock:
+            checkpoint.addDisk({
+                "dev": disk,
+                "source": source,
+                "name": os.path.basename(source),
+                "size": stat.st_size,
+                "mode": stat.st_mode & 0o7777,
+                "mtime": stat.st_mtime,
+                "sha256": checksum.fromChunks(
+                    chunks, stat.st_size, chunk_size)["sha256"],
+                "chunks": chunks})
+
+        # pivot this disk while the next one is read
+        if parameters.get("pipelined_commit", False):
+            snapshot.startBlockCommit(disk)
+
+    items = []
+
+    for disk, source in iter(snapshot.disks.items()):
+        if disk in checkpoint.getDisks():
+            logger.info("'%s' was stored before interruption" % (source))
+            continue
+
+        # images of a domain shut off are read at the same time: each of
+        # them has its own store, to measure its reads. Chunks are on disk
+        # before a checkpoint references them
+        disk_store = chunkstore.ChunkStore(
+            backupdir, compressor=compressor,
+            workers=parameters.get("compression_threads", 4),
+            throttle=limits, fsync=True)
+        stores.append(disk_store)
+
+        items += [(disk, source, disk_store)]
+
+    # nothing is written in images of a domain shut off: they are read all
+    # together, at full speed. Images under a snapshot are read one at a
+    # time, to limit the load on a running domain
+    workers = 1
+
+    if snapshot.offline and items:
+        workers = parameters.get("disk_workers", len(items))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(storeDisk, items))
+
+    # block commit (and delete snapshot)
+    blockCommit(snapshot)
+
+    chunkstore.writeManifest(manifest, manifest_path)
+    checkpoint.remove()
+
+    logger.info("%s new chunks written, %s chunks reused" % (
+        sum([item.written for item in stores]),
+        sum([item.reused for item in stores])))
+
+
+def incrementalBackup(snapshot, parameters, compressor, now, date, limits,
+                      backend):
+    """Read disks with a backup job which creates a checkpoint. Only the
+    blocks dirty since the checkpoint of the previous backup are read and
+    written in an incremental archive, chained to the previous backup. A
+    full backup is done without that checkpoint, or after max_incrementals
+    incremental backups"""
+
+    domain = snapshot.domain_name
+    provider = incremental.getProvider(snapshot, parameters)
+
+    parent = incremental.getParent(
+        retention.listGenerations(backend, domain),
+        provider.listCheckpoints(),
+        parameters.get("max_incrementals", incremental.MAX_INCREMENTALS))
+
+    checkpoint = incremental.getCheckpointName(now)
+
+    # incremental archives have their own extension
+    extension = ".tar" + compressor.extension
+
+    if parent is not None:
+        extension = retention.INCREMENTAL_EXT + extension
+
+    archive_name = os.path.join(
+        domain, retention.getName(domain, extension, now))
+
+    stream = archive.StreamArchive(
+        archive_name, compressor, checksum=parameters.get("checksum", True),
+        throttle=limits, storage=backend)
+
+    # which checkpoint and disks are in archive
+    info = {
+        "checkpoint": checkpoint,
+        "parent": parent,
+        "disks": {}
+    }
+
+    try:
+        logger.info("Adding XMLs files for domain '%s' to archive '%s'" %
+                    (domain, stream.target))
+
+        with metrics.phase(domain, "xml"):
+            for xml_file, xml in snapshot.getXMLs():
+                stream.addXML(os.path.join(date, xml_file), xml)
+
+        with metrics.phase(domain, "checkpoint"):
+            provider.begin(checkpoint, parent)
+
+        try:
+            info["disks"] = readDisks(provider, stream, date)
+
+        finally:
+            provider.end()
+
+        stream.addData(
+            os.path.join(date, domain + incremental.INFO_SUFFIX),
+            json.dumps(info, indent=1).encode("utf-8"))
+
+        # checksums computed while disks were read
+        if stream.checksum:
+            stream.addChecksums(
+                os.path.join(date, domain + checksum.CHECKSUM_SUFFIX))
+
+        # wait for compression to finish
+        with metrics.phase(domain, "compression"):
+            stream.close()
+
+    except Exception:
+        stream.abort()
+
+        # dirty bitmaps of a failed backup are merged in the previous ones
+        try:
+            if checkpoint in provider.listCheckpoints():
+                provider.removeCheckpoint(checkpoint)
+
+        except Exception as message:
+            logger.error("Cannot remove checkpoint %s of '%s': %s" % (
+                checkpoint, domain, message))
+
+        raise
+
+    # only the checkpoint of the last backup is needed
+    for name in provider.listCheckpoints():
+        if name != checkpoint:
+            provider.removeCheckpoint(name)
+
+
+def recoverDomain(snapshot, checkpoint=None):
+    """Deal with a snapshot left by an interrupted backup. If backup could
+    be resumed from checkpoint, the snapshot is used again, otherwise its
+    top images are committed. Snapshots not created by kvmBackup are an
+    error. Return True if backup will be resumed"""
+
+    domain = snapshot.domain_name
+    orphan = None
+
+    if snapshot.hasCurrentSnapshot() is True:
+        orphan = snapshot.getOrphanSnapshot()
+
+        if orphan is None:
+            raise Exception("Domain '%s' has already a snapshot" % (domain))
+
+    resume = False
+
+    if checkpoint is not None and checkpoint.state is not None:
+        # images not completed are still below their top images
+        if orphan is not None and \
+                checkpoint.state["snapshot"] == orphan["name"] and all([
+                    disk in orphan["active"] for disk in orphan["tops"]
+                    if disk not in checkpoint.getDisks()]):
+            logger.info("Resuming backup of '%s' from '%s'" % (
+                domain, checkpoint.path))
+
+            snapshot.adoptSnapshot(orphan)
+            resume = True
+
+        else:
+            logger.warning("Cannot resume backup of '%s' from '%s'" % (
+                domain, checkpoint.path))
+            checkpoint.remove()
+
+    if orphan is not None and not resume:
+        with metrics.phase(domain, "recovery"):
+            snapshot.recoverSnapshot(orphan)
+
+    snapshot.removeOrphanOverlays()
+
+    return resume
+
+
+def removeLeftovers(backend, domain):
+    """Remove partial files, staging directories and incomplete uploads
+    left in the directory of domain by interrupted backups"""
+
+    for name in backend.list(domain):
+        path = "/".join([domain, name])
+        local = backend.getPath(path)
+
+        if local is not None and os.path.isdir(local) and re.match(
+                "[0-9]{4}-[0-9]{2}-[0-9]{2}$", name):
+            logger.warning("Removing staging directory '%s'" % (local))
+            shutil.rmtree(local)
+
+        elif name.endswith(".part"):
+            logger.warning("Removing partial file '%s'" % (
+                backend.getURL(path)))
+            backend.remove(path)
+
+    backend.abortUploads(domain)
+
+
+def daemonBackup(domain, parameters, backupdir):
+    """Do a backup in daemon mode. The snapshot of a failed or cancelled
+    backup is committed at once, instead of at next backup, except in
+    chunks mode which resumes from its checkpoint"""
+
+    try:
+        backup(domain, parameters, backupdir)
+
+    except Exception:
+        if parameters.get("mode") != "chunks":
+            try:
+                recoverDomain(helper.Snapshot(
+                    domain,
+                    commit_bandwidth=parameters.get("commit_bandwidth", 0),
+                    overlay_dir=parameters.get(
+                        "overlay_dir", helper.OVERLAY_DIR)))
+
+            except Exception as message:
+                logger.error("Cannot recover snapshot of '%s': %s" % (
+                    domain, message))
+
+        raise
+
+
+def expireBackups(domain, backend, policy):
+    """Remove the backups of domain no more kept by retention policy"""
+
+    with metrics.phase(domain, "rotation"):
+        retention.applyPolicy(backend, domain, policy)
+
+
 def backup(domain, parameters, backupdir):
     """Do all the operation needed for backup"""
 
     # create a snapshot instance
-    snapshot = helper.Snapshot(domain)
+    snapshot = helper.Snapshot(
+        domain, commit_bandwidth=parameters.get("commit_bandwidth", 0),
+        overlay_dir=parameters.get("overlay_dir", helper.OVERLAY_DIR))
+
+    # domain could be changed since its XML was cached
+    snapshot.manager.invalidate(domain)
 
     # check if domain is active
     if not snapshot.domainIsActive():
-        logger.error(
-            "domain '%s' is not Active: is VM up and running?" % domain)
-        raise NotImplementedError("Cannot backup an inactive domain!")
+        if not parameters.get("offline", True):
+            logger.error(
+                "domain '%s' is not Active: is VM up and running?" % domain)
+            raise NotImplementedError("Cannot backup an inactive domain!")
+
+        offlineBackup(snapshot, parameters, backupdir)
+        return
 
     # check that guest agent is Up and running
-    if not snapshot.domainHasGuestAgent():
+    with metrics.phase(domain, "agent"):
+        has_agent = snapshot.domainHasGuestAgent(
+            timeout=parameters.get("agent_timeout", preflight.AGENT_TIMEOUT))
+
+    if not has_agent:
         logger.error("QEMU guest agent is a requisite for a safe snapshot")
         logger.error("Please check kvmBackup wiki pages for more info")
         raise RuntimeError(
             "Guest agent is not running. Check '%s' domain" % domain)
 
-    # check if no snapshot are defined
-    if snapshot.hasCurrentSnapshot() is True:
-        raise Exception("Domain '%s' has already a snapshot" % (domain))
+    doBackup(snapshot, parameters, backupdir)
+
+
+def offlineBackup(snapshot, parameters, backupdir):
+    """Backup a domain shut off by reading its images directly, without
+    guest agent, snapshot and blockcommit. The domain is locked while its
+    images are read: the libvirt hook in hooks/qemu refuses to start it"""
+
+    domain = snapshot.domain_name
+
+    with offline.DomainLock(domain):
+        # domain could be started before lock was taken
+        snapshot.manager.invalidate(domain)
+
+        if snapshot.domainIsActive():
+            raise RuntimeError(
+                "Domain '%s' was started before being locked" % (domain))
+
+        # top images of an interrupted backup can't be committed while
+        # domain is shut off
+        if snapshot.hasCurrentSnapshot() is True:
+            raise RuntimeError(
+                "Domain '%s' is shut off with a snapshot: start it to "
+                "recover the snapshot" % (domain))
+
+        logger.info("Domain '%s' is shut off: doing an offline backup" % (
+            domain))
+
+        snapshot.setOffline()
+        doBackup(snapshot, parameters, backupdir)
+
+
+def doBackup(snapshot, parameters, backupdir):
+    """Archive a domain once it is ready for snapshot (or shut off)"""
+
+    domain = snapshot.domain_name
+
+    # how to create archive
+    mode = parameters.get("mode", "staged")
+
+    # bandwidth and IOPS limits of this domain, of its target and of host
+    limits = throttle.getThrottle(domain, parameters, backupdir)
+
+    if mode not in MODES:
+        raise RuntimeError(
+            "Unknown mode '%s' for domain '%s'" % (mode, domain))
+
+    # a backup job in pull mode replaces snapshot
+    engine = parameters.get("engine", "snapshot")
+
+    if engine not in ENGINES:
+        raise RuntimeError(
+            "Unknown engine '%s' for domain '%s'" % (engine, domain))
 
-    # changing directory
-    olddir = os.getcwd()
+    if engine == "pull" and mode not in ["stream", "indexed"]:
+        raise RuntimeError(
+            "Engine 'pull' of domain '%s' requires 'stream' or 'indexed' "
+            "mode" % (domain))
+
+    # where archives are written: a local directory or a remote storage
+    backend = storage.getStorage(backupdir, parameters)
+
+    try:
+        writeBackup(snapshot, parameters, backupdir, backend, limits)
+
+    finally:
+        # remote storages keep a connection open
+        backend.close()
+
+
+def writeBackup(snapshot, parameters, backupdir, backend, limits):
+    """Write the backup of a domain in backend storage. Writes are limited
+    by limits throttle"""
+
+    domain = snapshot.domain_name
+
+    # how to create archive
+    mode = parameters.get("mode", "staged")
+
+    # images are copied and chunks are stored in local files
+    if not backend.isLocal() and mode in ["staged", "chunks"]:
+        raise RuntimeError(
+            "Mode '%s' of domain '%s' requires a local backupdir: use "
+            "'stream' or 'indexed' mode to write in '%s'" % (
+                mode, domain, backupdir))
+
+    # where domain archives are placed. Backups could run in parallel, so
+    # every path is absolute and current directory is never changed
     workdir = os.path.join(backupdir, domain)
 
+    # which generations are kept once this backup is completed
+    policy = retention.getPolicy(parameters)
+
     # creating directory if not exists
-    if not os.path.exists(workdir) and not os.path.isdir(workdir):
-        logger.info("Creating directory '%s'" % (workdir))
-        os.mkdir(workdir)
+    backend.makedirs(domain)
+
+    # a chunk backup could be resumed from the checkpoint of an interrupted
+    # one
+    checkpoint = None
+
+    if mode == "chunks":
+        checkpoint = chunkstore.Checkpoint(
+            os.path.join(workdir, domain + chunkstore.CHECKPOINT_EXT),
+            interval=parameters.get(
+                "checkpoint_interval", chunkstore.CHECKPOINT_INTERVAL))
+
+    # deal with snapshots and files left by interrupted backups
+    resume = recoverDomain(snapshot, checkpoint)
+    removeLeftovers(backend, domain)
+
+    # a timestamp directory in which to put files. Every backup is a new
+    # file named by its date
+    now = retention.getDate(
+        retention.listGenerations(backend, domain), datetime.datetime.now())
+    date = now.strftime('%Y-%m-%d')
+    datadir = os.path.join(workdir, date)
 
-    # cange directory
-    os.chdir(workdir)
+    # the compression engine of archives, or of chunks
+    if mode == "chunks":
+        compressor = chunkstore.getCompressor(parameters)
 
-    # a timestamp directory in which to put files
-    date = datetime.datetime.now().strftime('%Y-%m-%d')
-    datadir = os.path.join(workdir, date)
+    else:
+        compressor = compression.getCompressor(parameters)
 
-    # creating datadir
-    logger.debug("Creating directory '%s'" % (datadir))
-    os.mkdir(datadir)
+    # select compression level by sampling images
+    if compressor.auto:
+        with metrics.phase(domain, "autotune"):
+            compressor.autoTune(
+                snapshot.getDisks().values(), max_rate=limits.getRate("read"))
+
+    if mode == "chunks":
+        manifest_name = retention.getName(domain, chunkstore.MANIFEST_EXT, now)
+
+        # a resumed backup is the one of the interrupted run
+        if resume:
+            manifest_name = checkpoint.state["manifest_name"]
+            date = checkpoint.state["manifest"]["date"]
+
+        # chunks are not removed while they are reused or written
+        with chunkstore.getLock(backupdir).use():
+            chunkBackup(
+                snapshot, parameters, backupdir,
+                os.path.join(workdir, manifest_name), date, limits,
+                checkpoint, compressor)
+
+        expireBackups(domain, backend, policy)
+
+        logger.info("Backup for '%s' completed" % (domain))
+        return
 
     # define the target backup
     ext, tar_mode = '.tar', 'w'
 
-    tar_name = domain + ext
+    tar_name = retention.getName(domain, ext, now)
     tar_path = os.path.join(workdir, tar_name)
-    tar_path_gz = tar_path + ".gz"
 
-    # call rotation directive
-    if os.path.isfile(tar_path_gz):  # if file exists, run rotate
-        logger.info('rotating backup files for ' + domain)
-        helper.rotate(tar_path_gz, parameters["rotate"])
+    # the compression engine defines the archive extension
+    archive_name = os.path.join(domain, tar_name + compressor.extension)
 
-    tar = tarfile.open(tar_path, tar_mode)
+    # backup jobs need a running domain: images of a domain shut off are
+    # archived in a full backup, and the next backup starts a new chain
+    if mode == "incremental" and snapshot.offline:
+        logger.warning(
+            "Domain '%s' is shut off: doing a full backup instead of an "
+            "incremental one" % (domain))
 
-    # call dumpXML
-    xml_files = snapshot.dumpXML(path=datadir)
+    elif mode == "incremental":
+        incrementalBackup(
+            snapshot, parameters, compressor, now, date, limits, backend)
 
-    # Add xmlsto archive, and remove original file
-    logger.info("Adding XMLs files for domain '%s' to archive '%s'" %
-                (domain, tar_path))
+        expireBackups(domain, backend, policy)
 
-    for xml_file in xml_files:
-        # backup file with its relative path
-        xml_file = os.path.basename(xml_file)
-        xml_file = os.path.join(date, xml_file)
+        logger.info("Backup for '%s' completed" % (domain))
+        return
+
+    if mode in ["stream", "indexed", "incremental"]:
+        streamBackup(
+            snapshot, parameters, compressor, archive_name, date, limits,
+            backend)
+
+        expireBackups(domain, backend, policy)
+
+        logger.info("Backup for '%s' completed" % (domain))
+        return
+
+    # creating datadir
+    logger.debug("Creating directory '%s'" % (datadir))
+    os.mkdir(datadir)
+
+    tar = tarfile.open(
+        fileobj=limits.open(tar_path, "wb"), mode=tar_mode,
+        format=tarfile.PAX_FORMAT)
+
+    # read only allocated extents of thin provisioned images
+    is_sparse = parameters.get("sparse", True)
 
-        tar.add(xml_file)
-        logger.debug("'%s' added" % (xml_file))
+    # checksums of images, computed while they are added to archive
+    checksums = {}
 
-        logger.debug("removing '%s' from '%s'" % (xml_file, datadir))
-        os.remove(xml_file)
+    with metrics.phase(domain, "xml"):
+        # call dumpXML
+        xml_files = snapshot.dumpXML(path=datadir)
+
+        # Add xmlsto archive, and remove original file
+        logger.info("Adding XMLs files for domain '%s' to archive '%s'" %
+                    (domain, tar_path))
+
+        for xml_file in xml_files:
+            # backup file with its relative path
+            arcname = os.path.join(date, os.path.basename(xml_file))
+
+            tar.add(xml_file, arcname=arcname)
+            logger.debug("'%s' added" % (arcname))
+
+            logger.debug("removing '%s' from '%s'" % (xml_file, datadir))
+            os.remove(xml_file)
 
     # call snapshot
-    snapshot.callSnapshot()
+    with metrics.phase(domain, "snapshot"):
+        snapshot.callSnapshot()
 
     logger.info("Adding image files for '%s' to archive '%s'" %
                 (domain, tar_path))
 
+    # with defer_archive, images are archived once every disk is copied and
+    # block committed: snapshot lives only while images are copied
+    defer_archive = parameters.get("defer_archive", False)
+
+    def archiveCopy(disk, source, dest):
+        """Add the copy of an image to archive, then remove it"""
+
+        # backup file with its relative path
+        img_file = os.path.join(date, os.path.basename(dest))
+        logger.debug("Adding '%s' to archive '%s'" % (img_file, tar_path))
+
+        with metrics.phase(domain, "tar", disk=disk) as phase:
+            if parameters.get("checksum", True):
+                file_checksum = checksum.FileChecksum(os.path.getsize(dest))
+
+            else:
+                file_checksum = None
+
+            phase.bytes = sparse.addFile(
+                tar, dest, img_file, sparse=is_sparse, checksum=file_checksum)
+
+        if file_checksum is not None:
+            checksums[img_file] = file_checksum.finish()
+            checksums[img_file]["source"] = source
+
+        logger.debug("removing '%s' from '%s'" % (img_file, datadir))
+        os.remove(dest)
+
+    copies = []
+
     # copying file
     for disk, source in iter(snapshot.disks.items()):
         dest = os.path.join(datadir, os.path.basename(source))
 
         logger.debug("copying '%s' to '%s'" % (source, dest))
-        shutil.copy2(source, dest)
 
-        # backup file with its relative path
-        img_file = os.path.basename(dest)
-        img_file = os.path.join(date, img_file)
-        logger.debug("Adding '%s' to archive '%s'" % (img_file, tar_path))
-        tar.add(img_file)
+        # a reflink or copy_file_range, if the filesystem supports them
+        with metrics.phase(domain, "copy", disk=disk) as phase:
+            phase.bytes, phase.info["method"] = sparse.copyImage(
+                source, dest, sparse=is_sparse, throttle=limits,
+                method=parameters.get("copy_method", "auto"))
 
-        logger.debug("removing '%s' from '%s'" % (img_file, datadir))
-        os.remove(img_file)
+        logger.info("'%s' copied with %s" % (source, phase.info["method"]))
+
+        # pivot this disk while the next one is copied
+        if parameters.get("pipelined_commit", False):
+            snapshot.startBlockCommit(disk)
+
+        if defer_archive:
+            copies += [(disk, source, dest)]
+
+        else:
+            archiveCopy(disk, source, dest)
 
     # block commit (and delete snapshot)
-    snapshot.doBlockCommit()
+    blockCommit(snapshot)
 
-    # closing archive
+    for disk, source, dest in copies:
+        archiveCopy(disk, source, dest)
+
+    if checksums:
+        archive.addData(
+            tar, os.path.join(date, domain + checksum.CHECKSUM_SUFFIX),
+            checksum.dumpChecksums(checksums).encode("utf-8"))
+
+    # closing archive: tar file was opened by us
     tar.close()
+    tar.fileobj.close()
 
-    # Now launcing subprocess with pigz
-    logger.info("Compressing '%s'" % (tar_name))
-    helper.packArchive(target=tar_name)
+    # Now compressing archive
+    with metrics.phase(domain, "compression") as phase:
+        phase.bytes = os.path.getsize(tar_path)
+        compressor.compressFile(tar_path, throttle=limits)
 
     # revoving EMPTY datadir
     logger.debug("removing '%s'" % (datadir))
     os.rmdir(datadir)
 
-    # return to the original directory
-    os.chdir(olddir)
+    expireBackups(domain, backend, policy)
 
     logger.info("Backup for '%s' completed" % (domain))
 
 
-# A global connection instance
-conn = libvirt.open("qemu:///system")
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Backup of KVM-qcow2 domains')
     parser.add_argument("-c", "--config", required=True,
@@ -264,6 +1040,25 @@ if __name__ == "__main__":
         "--domains", required=False, type=str,
         help=("comma separated list of domains to backup ('virsh list "
               "--all' to get domains)"))
+    parser.add_argument(
+        "--verify", action='store_true',
+        help="verify the last backup of every domain, instead of backup")
+    parser.add_argument(
+        "--live", action='store_true',
+        help="compare verified backups with live images")
+    parser.add_argument(
+        "--workers", type=int, default=helper.getProcesses(),
+        help="processes used to verify backups")
+    parser.add_argument(
+        "--preflight", action='store_true',
+        help="check the domains to backup and exit, without backup")
+    parser.add_argument(
+        "--daemon", action='store_true',
+        help="run as a daemon, doing backups following their schedules")
+    parser.add_argument(
+        "--control", type=str, metavar="COMMAND",
+        help=("send a command to a running daemon: %s, followed by domain "
+              "names if needed" % (", ".join(daemon.COMMANDS))))
     parser.add_argument(
         "-v", "--verbose", action='store_true',
         help="verbose logging")
@@ -282,6 +1077,19 @@ if __name__ == "__main__":
     # Starting software
     logger.info("Starting '%s'" % (prog_name))
 
+    # the name of this host in configuration file
+    hostname = socket.gethostname().split(".")[0]
+
+    # commands are sent to the daemon holding the lock
+    if args.control:
+        mydomains, backupdir, config = loadConf(args.config)
+
+        reply = daemon.sendCommand(config[hostname].get(
+            "control_socket", daemon.CONTROL_SOCKET), args.control)
+
+        print(json.dumps(reply, indent=1))
+        sys.exit(0 if reply["ok"] else 1)
+
     lockfile = os.path.splitext(os.path.basename(sys.argv[0]))[0] + ".lock"
     lockfile_path = os.path.join("/var/run", lockfile)
 
@@ -294,7 +1102,8 @@ if __name__ == "__main__":
         sys.exit(-1)
 
     # get all domain names
-    domains = [domain.name() for domain in conn.listAllDomains()]
+    domains = [domain.name() for domain in
+               connection.getManager().listAllDomains()]
 
     # filter domains with user provides domains (if needed)
     if args.domains is not None:
@@ -304,14 +1113,66 @@ if __name__ == "__main__":
     # parse configuration file
     mydomains, backupdir, config = loadConf(args.config)
 
-    # test for directory existance
-    if not os.path.exists(backupdir) and os.path.isdir(backupdir) is False:
+    # limits shared by domains
+    throttle.configure(config[hostname])
+
+    # test for directory existance. Remote storages are checked by backups
+    if storage.isLocal(backupdir) and not os.path.isdir(backupdir):
         logger.info("Creating directory '%s'" % (backupdir))
         os.mkdir(backupdir)
 
     # debug
     # pprint.pprint(mydomains)
 
+    # do backups until stopped, reading configuration again when reloaded
+    if args.daemon:
+        def loadDaemonConf():
+            mydomains, backupdir, config = loadConf(args.config)
+            return mydomains, backupdir, config[hostname]
+
+        host_conf = config[hostname]
+
+        backup_daemon = daemon.Daemon(
+            daemonBackup, loadDaemonConf,
+            state_file=host_conf.get("state_file", daemon.STATE_FILE),
+            socket_path=host_conf.get(
+                "control_socket", daemon.CONTROL_SOCKET),
+            workers=host_conf.get("workers", 1),
+            target_workers=host_conf.get("target_workers"),
+            preflight_workers=host_conf.get(
+                "preflight_workers", preflight.WORKERS))
+
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: backup_daemon.stop())
+        signal.signal(signal.SIGHUP,
+                      lambda signum, frame: backup_daemon.reload())
+
+        backup_daemon.run()
+
+        logger.info("'%s' completed successfully" % (prog_name))
+        sys.exit(0)
+
+    # check backups, even of domains no more defined
+    if args.verify:
+        user_domains = None
+
+        if args.domains is not None:
+            user_domains = [
+                domain.strip() for domain in args.domains.split(",")]
+
+        problems = verifyBackups(
+            mydomains, backupdir, user_domains, args.workers, args.live)
+
+        if problems > 0:
+            logger.error("%s problems found in backups" % (problems))
+            sys.exit(1)
+
+        logger.info("'%s' completed successfully" % (prog_name))
+        sys.exit(0)
+
+    # the domains to backup
+    jobs = []
+
     for domain_name, parameters in iter(mydomains.items()):
         # check if bakcup is needed
         domain_backup = False
@@ -321,20 +1182,14 @@ if __name__ == "__main__":
             logger.info("Ignoring domain '%s'" % (domain_name))
             continue
 
-        for day in parameters["day_of_week"]:
+        for day in parameters.get("day_of_week", []):
             if checkDay(day) is True or args.force is True:
                 logger.info("Ready for backup of '%s'" % (domain_name))
                 domain_backup = True
 
-                # do backup stuff
-                try:
-                    backup(domain_name, parameters, backupdir)
-
-                except Exception as message:
-                    logger.exception(message)
-                    logger.error("Domain '%s' was not backed up" %
-                                 (domain_name))
-                    flag_errors = True
+                # a domain could be placed in a different backup target
+                target = parameters.get("backupdir", backupdir)
+                jobs += [scheduler.Job(domain_name, parameters, target)]
 
                 # breaking cicle
                 break
@@ -342,6 +1197,67 @@ if __name__ == "__main__":
         if domain_backup is False:
             logger.info("Ignoring '%s' domain" % (domain_name))
 
+    host_conf = config[hostname]
+
+    # check all domains before any backup: only ready domains are backed up
+    checks = preflight.run(
+        jobs, workers=host_conf.get("preflight_workers", preflight.WORKERS))
+
+    for check in checks:
+        if not check.ready:
+            metrics.collector.domainResult(check.domain_name, 0, False)
+            flag_errors = True
+
+    if args.preflight:
+        if flag_errors:
+            logger.error("Some domains can't be backed up")
+            sys.exit(1)
+
+        logger.info("'%s' completed successfully" % (prog_name))
+        sys.exit(0)
+
+    jobs = [check.job for check in checks if check.ready]
+
+    # do backup stuff: many domains could be processed at the same time
+
+    backup_scheduler = scheduler.Scheduler(
+        backup,
+        workers=host_conf.get("workers", 1),
+        target_workers=host_conf.get("target_workers"))
+
+    for job in backup_scheduler.run(jobs):
+        metrics.collector.domainResult(
+            job.domain_name, job.seconds, job.error is None)
+
+        if job.error is not None:
+            flag_errors = True
+
+    # remove chunks no more referenced by retained manifests, once every
+    # backup writing in chunk stores is terminated
+    targets = set([job.backupdir for job in jobs
+                   if job.parameters.get("mode") == "chunks"])
+
+    for target in targets:
+        try:
+            chunkstore.ChunkStore(target).collect()
+
+        except Exception as message:
+            logger.exception(message)
+            logger.error("Cannot clean chunk store in '%s'" % (target))
+            flag_errors = True
+
+    # export timings of this run
+    for key, write in [("metrics_textfile", metrics.collector.writePrometheus),
+                       ("summary_file", metrics.collector.writeJSON)]:
+        if host_conf.get(key):
+            try:
+                write(host_conf[key])
+
+            except Exception as message:
+                logger.exception(message)
+                logger.error("Cannot write '%s'" % (host_conf[key]))
+                flag_errors = True
+
     # end of the program
     if flag_errors is False:
         logger.info("'%s' completed successfully" % (prog_name))
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Restore a domain backed up by kvmBackup
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+
+import libvirt
+
+# my functions
+from Lib import connection, helper, restore
+from kvmBackup import loadConf
+
+# the program name
+prog_name = os.path.basename(sys.argv[0])
+
+# Logging istance
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(prog_name)
+
+
+def domainIsActive(domain_name):
+    """Return True if domain is defined and running"""
+
+    try:
+        domain = connection.getManager().lookupByName(domain_name)
+
+    except libvirt.libvirtError:
+        return False
+
+    return domain.isActive() == 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Restore a domain backed up by kvmBackup')
+    parser.add_argument("-c", "--config", required=True,
+                        type=str, help="The config file")
+    parser.add_argument("-d", "--domain", required=True,
+                        type=str, help="The domain to restore")
+    parser.add_argument(
+        "-g", "--generation", type=int, default=0,
+        help="backup generation: 0 is the last one, 1 the previous one...")
+    parser.add_argument(
+        "--dest", type=str,
+        help="restore images in this directory (def. original paths)")
+    parser.add_argument(
+        "--define", action='store_true',
+        help="define domain from the archived XML")
+    parser.add_argument(
+        "--force", action='store_true',
+        help="overwrite existing images")
+    parser.add_argument(
+        "--workers", type=int, default=helper.getProcesses(),
+        help="images and frames restored at the same time")
+    parser.add_argument(
+        "-v", "--verbose", action='store_true',
+        help="verbose logging")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    # parse configuration file
+    mydomains, backupdir, config = loadConf(args.config)
+
+    # a domain could be placed in a different backup target
+    parameters = mydomains.get(args.domain, {})
+    backupdir = parameters.get("backupdir", backupdir)
+
+    path = restore.findBackup(
+        backupdir, args.domain, args.generation, parameters)
+
+    # a running domain is using its images
+    if args.dest is None and domainIsActive(args.domain):
+        logger.error("Domain '%s' is running: shut it down or use --dest" % (
+            args.domain))
+        sys.exit(-1)
+
+    restorer = restore.Restore(
+        path, dest=args.dest, workers=args.workers, force=args.force,
+        parameters=parameters, convert=not args.define)
+
+    try:
+        images = restorer.run()
+
+        if args.define:
+            restorer.defineDomain()
+
+    except Exception as message:
+        logger.exception(message)
+        logger.error("Domain '%s' was not restored" % (args.domain))
+        sys.exit(-1)
+
+    for name, target in sorted(images.items()):
+        logger.info("'%s' restored in '%s'" % (name, target))
+
+    logger.info("'%s' completed successfully" % (prog_name))
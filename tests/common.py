@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+What tests have in common: libvirt is replaced by the fake of bench
+directory before Lib is imported, and every test has a temporary directory
+in which a fake domain could be defined with synthetic images
+
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# where kvmBackup.py, Lib and the fakes are
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(REPO_DIR, "bench")
+
+for path in [BENCH_DIR, REPO_DIR]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import fakelibvirt  # noqa: E402
+import images  # noqa: E402
+
+# the fake hypervisor, installed before kvmBackup modules are imported
+hypervisor = fakelibvirt.install()
+
+# the size of synthetic images
+IMAGE_SIZE = 8 * 1024 * 1024
+
+
+def getDigest(path):
+    """Return the sha256 of a file"""
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as handle:
+        for data in iter(lambda: handle.read(images.BLOCK_SIZE), b""):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+class TestCase(unittest.TestCase):
+    """A test with its own temporary directory"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="kvmBackup-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeImages(self):
+        """Write a dense and a sparse image. Return them by disk"""
+
+        image_dir = os.path.join(self.tmpdir, "images")
+        os.makedirs(image_dir)
+
+        disks = {}
+
+        for dev, kind in [("vda", "dense"), ("vdb", "sparse")]:
+            disks[dev] = os.path.join(image_dir, "%s.qcow2" % (kind))
+            images.makeImage(disks[dev], IMAGE_SIZE, kind)
+
+        return disks
+
+    def makeDomain(self, domain_name="vm"):
+        """Define a running fake domain with synthetic images. Return its
+        images by disk"""
+
+        disks = self.makeImages()
+        hypervisor.addDomain(domain_name, disks)
+
+        return disks
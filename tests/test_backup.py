@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Backup a fake domain in every mode, then restore and verify its backups:
+restored images must be equal to the images of domain
+
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import unittest
+from unittest import mock
+
+import common
+
+import kvmBackup
+from Lib import incremental, restore, retention, storage
+
+import fakecheckpoints
+import fakes3
+
+
+class BackupTest(common.TestCase):
+    """Backup, restore and verify a fake domain"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.disks = self.makeDomain()
+        self.backupdir = os.path.join(self.tmpdir, "backup")
+
+    def backup(self, parameters, target=None):
+        """Backup the fake domain. Return the parameters used"""
+
+        parameters = dict(parameters, overlay_dir=self.tmpdir)
+        kvmBackup.backup("vm", dict(parameters), target or self.backupdir)
+
+        return parameters
+
+    def check(self, parameters, target=None):
+        """Restore and verify the last backup"""
+
+        target = target or self.backupdir
+        dest = os.path.join(self.tmpdir, "restored")
+
+        path = restore.findBackup(target, "vm", parameters=parameters)
+        restored = restore.Restore(
+            path, dest=dest, force=True, parameters=parameters).run()
+
+        self.assertEqual(len(restored), len(self.disks))
+
+        for image in self.disks.values():
+            self.assertEqual(
+                common.getDigest(os.path.join(dest, os.path.basename(image))),
+                common.getDigest(image))
+
+        self.assertEqual(
+            kvmBackup.verifyBackups({"vm": parameters}, target), 0)
+
+        # the domain is back to its images
+        state = common.hypervisor.getDomain("vm")
+        self.assertIsNone(state["snapshot"])
+        self.assertEqual(state["disks"], self.disks)
+
+    def testStaged(self):
+        self.check(self.backup({"mode": "staged", "compression": "gzip"}))
+
+    def testStream(self):
+        self.check(self.backup({"mode": "stream", "compression": "gzip"}))
+
+    def testIndexed(self):
+        self.check(self.backup({"mode": "indexed", "compression": "gzip"}))
+
+    def testChunks(self):
+        self.check(self.backup({"mode": "chunks", "compression": "none"}))
+
+        # generations are named by seconds
+        time.sleep(1.1)
+
+        # chunks of the first backup are reused
+        self.check(self.backup({"mode": "chunks", "compression": "gzip"}))
+
+    def testPull(self):
+        self.check(self.backup(
+            {"mode": "stream", "engine": "pull", "compression": "gzip"}))
+
+    def testOffline(self):
+        common.hypervisor.getDomain("vm")["active"] = False
+
+        self.check(self.backup({"mode": "stream", "compression": "gzip"}))
+
+    def testIncremental(self):
+        provider = incremental.PROVIDERS["libvirt"]
+        self.addCleanup(
+            incremental.PROVIDERS.__setitem__, "libvirt", provider)
+
+        fakecheckpoints.install(os.path.join(self.tmpdir, "checkpoints"))
+
+        parameters = self.backup({"mode": "incremental"})
+
+        # generations are named by seconds
+        time.sleep(1.1)
+
+        with open(self.disks["vda"], "r+b") as handle:
+            handle.seek(common.IMAGE_SIZE // 2)
+            handle.write(os.urandom(65536))
+
+        self.backup(parameters)
+
+        generations = retention.listGenerations(
+            storage.LocalStorage(self.backupdir), "vm")
+
+        self.assertEqual(
+            [item["incremental"] for item in generations], [True, False])
+
+        self.check(parameters)
+
+    def checkS3(self, parameters):
+        client = fakes3.install(os.path.join(self.tmpdir, "s3"))
+
+        with mock.patch.object(storage, "boto3", fakes3):
+            target = "s3://bucket/backup"
+            self.check(self.backup(parameters, target), target)
+
+        self.assertGreater(client.calls["get_object"], 0)
+
+    def testS3(self):
+        self.checkS3({"mode": "stream", "compression": "gzip"})
+
+    def testS3Indexed(self):
+        # members are read with range requests
+        self.checkS3({"mode": "indexed", "compression": "gzip"})
+
+
+if __name__ == "__main__":
+    unittest.main()
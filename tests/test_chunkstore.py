@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Store chunks by their digest, and remove the ones no backup references
+
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+import threading
+import unittest
+
+import common
+
+from Lib import chunkstore
+
+
+class ChunkStoreTest(common.TestCase):
+    """Write, read and collect chunks"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.store = chunkstore.ChunkStore(self.tmpdir, workers=1)
+
+    def getChunks(self):
+        return sorted(os.path.basename(path) for path in glob.glob(
+            os.path.join(self.store.path, "*", "*")))
+
+    def writeManifest(self, digests):
+        os.mkdir(os.path.join(self.tmpdir, "vm"))
+
+        manifest = {"disks": [{
+            "dev": "vda",
+            "chunks": [[index, digest] for index, digest in
+                       enumerate(digests)]}]}
+
+        chunkstore.writeManifest(manifest, os.path.join(
+            self.tmpdir, "vm", "vm.20220131T230000" + chunkstore.MANIFEST_EXT))
+
+    def testRoundTrip(self):
+        data = os.urandom(1000) * 4
+
+        for name in ["gzip", "none"]:
+            self.store.compressor = chunkstore.getCompressor(
+                {"compression": name})
+
+            digest = self.store.putChunk(data + name.encode("utf-8"))
+
+            self.assertTrue(self.store.hasChunk(digest))
+            self.assertEqual(self.store.getChunk(digest),
+                             data + name.encode("utf-8"))
+
+        # a chunk is stored once
+        self.store.putChunk(data + b"none")
+
+        self.assertEqual(self.store.written, 2)
+        self.assertEqual(self.store.reused, 1)
+
+    def testCollect(self):
+        used = self.store.putChunk(b"used")
+        resumed = self.store.putChunk(b"resumed")
+        self.store.putChunk(b"unused")
+
+        # a chunk being written
+        partial = self.store.getChunkPath(used) + ".part"
+        open(partial, "w").close()
+
+        self.writeManifest([used])
+
+        # a checkpoint of an interrupted backup
+        checkpoint = chunkstore.Checkpoint(os.path.join(
+            self.tmpdir, "vm", "vm" + chunkstore.CHECKPOINT_EXT))
+        checkpoint.start("snapshot", "manifest", {"disks": []})
+        checkpoint.update("vda", 1, [[0, resumed]])
+        checkpoint.save()
+
+        self.assertEqual(self.store.collect(), 1)
+        self.assertEqual(self.getChunks(), sorted([
+            used, resumed, os.path.basename(partial)]))
+
+    def testInUse(self):
+        self.store.putChunk(b"unused")
+
+        lock = chunkstore.getLock(self.tmpdir)
+        self.addCleanup(chunkstore.store_locks.clear)
+
+        # the same lock for the same store
+        self.assertIs(chunkstore.getLock(self.tmpdir + "/"), lock)
+
+        # chunks written by a running backup are not referenced yet
+        with lock.use():
+            self.assertIsNone(self.store.collect(blocking=False))
+
+        self.assertEqual(self.store.collect(blocking=False), 1)
+
+    def testWaitCollect(self):
+        lock = chunkstore.StoreLock()
+        events = []
+
+        # a backup waits for garbage collection to finish
+        self.assertTrue(lock.acquireCollect())
+
+        def backup():
+            with lock.use():
+                events.append("backup")
+
+        thread = threading.Thread(target=backup)
+        thread.start()
+
+        thread.join(0.2)
+        events.append("collected")
+        lock.releaseCollect()
+        thread.join()
+
+        self.assertEqual(events, ["collected", "backup"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Read configuration files: host options about domains are defaults for every
+domain
+
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import unittest
+from unittest import mock
+
+import common
+
+import kvmBackup
+
+CONFIG = """
+cloud1:
+    domains:
+        DockerNode1:
+            day_of_week: [Sun]
+            mode: chunks
+        DockerNode2:
+    backupdir: /mnt/cloud/kvm_backup/cloud1
+    mode: stream
+    day_of_week: [Sat]
+    workers: 4
+    state_file: /var/lib/kvmBackup/state.json
+    metrics_textfile: /var/lib/node_exporter/kvmbackup.prom
+"""
+
+
+class ConfigTest(common.TestCase):
+    """Read a configuration file"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.path = os.path.join(self.tmpdir, "config.yml")
+
+        with open(self.path, "w") as handle:
+            handle.write(CONFIG)
+
+        patcher = mock.patch.object(
+            socket, "gethostname", return_value="cloud1.example.com")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testDefaults(self):
+        mydomains, backupdir, config = kvmBackup.loadConf(self.path)
+
+        self.assertEqual(backupdir, "/mnt/cloud/kvm_backup/cloud1")
+
+        # domain options override host ones
+        self.assertEqual(mydomains["DockerNode1"], {
+            "day_of_week": ["Sun"], "mode": "chunks"})
+
+        # a domain without options has host defaults
+        self.assertEqual(mydomains["DockerNode2"], {
+            "day_of_week": ["Sat"], "mode": "stream"})
+
+        # host only options are in host configuration
+        self.assertEqual(config["cloud1"]["workers"], 4)
+
+    def testUnknownHost(self):
+        with mock.patch.object(socket, "gethostname", return_value="cloud2"):
+            with self.assertRaises(RuntimeError):
+                kvmBackup.loadConf(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
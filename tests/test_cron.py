@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Parse cron like schedules and backup windows, and plan the jobs of the
+daemon with them
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import unittest
+
+import common
+
+from Lib import cron, daemon
+
+
+def date(*args):
+    return datetime.datetime(*args)
+
+
+class CronTest(common.TestCase):
+    """Find the occurrences of schedules"""
+
+    def testParseField(self):
+        self.assertEqual(cron.parseField("*/15", "minute", 0, 59),
+                         set([0, 15, 30, 45]))
+        self.assertEqual(cron.parseField("1-5,10", "hour", 0, 23),
+                         set([1, 2, 3, 4, 5, 10]))
+        self.assertEqual(cron.parseField("Mon-Fri", "weekday", 0, 7),
+                         set([1, 2, 3, 4, 5]))
+        self.assertEqual(cron.parseField("Jan,dec", "month", 1, 12),
+                         set([1, 12]))
+
+        # Sunday is both 0 and 7
+        self.assertEqual(cron.parseField("5-7", "weekday", 0, 7),
+                         set([0, 5, 6]))
+
+    def testInvalid(self):
+        for expression in ["* * * *", "60 * * * *", "* 24 * * *",
+                           "5-1 * * * *", "*/0 * * * *", "* * 0 * *"]:
+            with self.assertRaises(RuntimeError):
+                cron.Cron(expression)
+
+    def testGetNext(self):
+        schedule = cron.Cron("30 1 * * Mon-Fri")
+
+        # 2022-01-28 is a Friday
+        self.assertEqual(schedule.getNext(date(2022, 1, 28, 0, 0)),
+                         date(2022, 1, 28, 1, 30))
+
+        # the same minute is not the next one
+        self.assertEqual(schedule.getNext(date(2022, 1, 28, 1, 30, 10)),
+                         date(2022, 1, 31, 1, 30))
+
+    def testAnyDay(self):
+        # the 1st of month or every Sunday, like cron does
+        schedule = cron.Cron("0 2 1 * Sun")
+
+        self.assertTrue(schedule.match(date(2022, 2, 1, 2, 0)))
+        self.assertTrue(schedule.match(date(2022, 2, 6, 2, 0)))
+        self.assertFalse(schedule.match(date(2022, 2, 7, 2, 0)))
+
+        self.assertEqual(schedule.getNext(date(2022, 1, 31, 3, 0)),
+                         date(2022, 2, 1, 2, 0))
+
+    def testNever(self):
+        with self.assertRaises(RuntimeError):
+            cron.Cron("0 0 31 2 *").getNext(date(2022, 1, 1))
+
+    def testFromDays(self):
+        schedule = cron.fromDays(["Sat", "Sun"], "23:15")
+
+        # 2022-01-28 is a Friday
+        self.assertEqual(schedule.getNext(date(2022, 1, 28, 23, 30)),
+                         date(2022, 1, 29, 23, 15))
+        self.assertEqual(schedule.getNext(date(2022, 1, 29, 23, 30)),
+                         date(2022, 1, 30, 23, 15))
+
+    def testWindow(self):
+        window = cron.Window("22:00-06:00")
+
+        self.assertEqual(window.length, 8 * 60)
+
+        # the window started the day before is still open
+        self.assertEqual(window.getWindow(date(2022, 1, 28, 3, 0)),
+                         (date(2022, 1, 27, 22, 0), date(2022, 1, 28, 6, 0)))
+        self.assertTrue(window.isOpen(date(2022, 1, 28, 3, 0)))
+
+        # the next window
+        self.assertEqual(window.getWindow(date(2022, 1, 28, 12, 0)),
+                         (date(2022, 1, 28, 22, 0), date(2022, 1, 29, 6, 0)))
+        self.assertFalse(window.isOpen(date(2022, 1, 28, 12, 0)))
+        self.assertFalse(window.isOpen(date(2022, 1, 28, 6, 0)))
+
+        with self.assertRaises(RuntimeError):
+            cron.Window("22:00-24:00")
+
+    def testPlan(self):
+        job = daemon.DomainJob("vm", {
+            "schedule": "0 1 * * *", "window": "22:00-06:00"}, "/backup")
+
+        # a short job starts when scheduled, and must end with its window
+        job.plan(date(2022, 1, 28, 12, 0), datetime.timedelta(hours=1))
+
+        self.assertEqual(job.occurrence, date(2022, 1, 29, 1, 0))
+        self.assertEqual(job.start_at, date(2022, 1, 29, 1, 0))
+        self.assertEqual(job.deadline, date(2022, 1, 29, 6, 0))
+
+        # a long job starts earlier, but not before its window
+        job.plan(date(2022, 1, 28, 12, 0), datetime.timedelta(hours=6))
+        self.assertEqual(job.start_at, date(2022, 1, 29, 0, 0))
+
+        job.plan(date(2022, 1, 28, 12, 0), datetime.timedelta(hours=10))
+        self.assertEqual(job.start_at, date(2022, 1, 28, 22, 0))
+
+    def testSchedule(self):
+        schedule = daemon.getSchedule({"day_of_week": ["Sun"]})
+
+        self.assertEqual(schedule.getNext(date(2022, 1, 28)),
+                         date(2022, 1, 30, 2, 0))
+
+        with self.assertRaises(RuntimeError):
+            daemon.getSchedule({})
+
+
+if __name__ == "__main__":
+    unittest.main()
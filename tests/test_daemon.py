@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Backup a fake domain with the daemon, triggering its jobs as the control
+socket does
+
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import time
+import unittest
+
+import common
+
+import kvmBackup
+from Lib import daemon
+
+# how long a triggered backup is waited for (seconds)
+TIMEOUT = 60
+
+
+class DaemonTest(common.TestCase):
+    """Trigger backups of a fake domain and check what is exported"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.makeDomain()
+
+        # like kvmBackup.py does before starting the daemon
+        self.backupdir = os.path.join(self.tmpdir, "backup")
+        os.mkdir(self.backupdir)
+
+        self.host_conf = {
+            "metrics_textfile": os.path.join(self.tmpdir, "kvmbackup.prom"),
+            "summary_file": os.path.join(self.tmpdir, "summary.json")}
+
+        self.daemon = daemon.Daemon(
+            kvmBackup.daemonBackup, self.load,
+            state_file=os.path.join(self.tmpdir, "state.json"),
+            socket_path=os.path.join(self.tmpdir, "kvmBackup.sock"))
+
+        self.daemon.reload()
+        self.daemon.scheduler.start()
+
+        self.addCleanup(self.daemon.scheduler.join)
+        self.addCleanup(self.daemon.scheduler.close)
+
+    def load(self):
+        mydomains = {
+            "vm": {
+                "schedule": "0 2 * * *",
+                "mode": "stream",
+                "compression": "gzip",
+                "overlay_dir": self.tmpdir}}
+
+        return mydomains, self.backupdir, self.host_conf
+
+    def trigger(self):
+        """Backup the fake domain and wait for it"""
+
+        self.daemon.trigger("vm")
+
+        end = time.time() + TIMEOUT
+
+        while "vm" in self.daemon.busy:
+            self.assertLess(time.time(), end)
+            time.sleep(0.1)
+
+    def testMetrics(self):
+        for i in range(2):
+            self.trigger()
+
+            # backups are named by seconds
+            time.sleep(1.1)
+
+        self.assertEqual(
+            self.daemon.state.domains["vm"]["last_status"], "done")
+
+        with open(self.host_conf["metrics_textfile"]) as handle:
+            series = [line.rsplit(" ", 1)[0] for line in handle
+                      if not line.startswith("#")]
+
+        self.assertIn(
+            'kvmbackup_phase_duration_seconds{domain="vm",phase="xml"}',
+            series)
+
+        # the textfile collector refuses duplicate series
+        self.assertEqual(len(series), len(set(series)))
+
+        # only the phases of the last backup are kept
+        with open(self.host_conf["summary_file"]) as handle:
+            phases = [(phase["phase"], phase["disk"]) for phase in
+                      json.load(handle)["phases"]]
+
+        self.assertEqual(len(phases), len(set(phases)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Chain incremental backups to the checkpoints of previous ones
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import unittest
+
+import common
+
+from Lib import incremental, retention
+
+# the last backup, at 23:00 of 2022-01-31
+LAST = datetime.datetime(2022, 1, 31, 23, 0)
+
+
+def getGenerations(incrementals, days=6):
+    """Return a backup of 'vm' every day, newest first: the ones in
+    incrementals are incremental"""
+
+    generations = []
+
+    for day in range(days):
+        extension = ".tar.gz"
+
+        if day in incrementals:
+            extension = retention.INCREMENTAL_EXT + extension
+
+        generations += [retention.parseName("vm", retention.getName(
+            "vm", extension, LAST - datetime.timedelta(days=day)))]
+
+    return generations
+
+
+class IncrementalTest(common.TestCase):
+    """Find the parent of a backup, and the chain to restore"""
+
+    def testCheckpointName(self):
+        self.assertEqual(incremental.getCheckpointName(LAST),
+                         "kvmBackup-20220131T230000")
+
+    def testGetParent(self):
+        generations = getGenerations([0, 1])
+        checkpoints = [incremental.getCheckpointName(LAST)]
+
+        self.assertEqual(
+            incremental.getParent(generations, checkpoints, 6),
+            "kvmBackup-20220131T230000")
+
+        # too many incremental backups since the full one
+        self.assertIsNone(incremental.getParent(generations, checkpoints, 2))
+
+        # the checkpoint of last backup is lost
+        self.assertIsNone(incremental.getParent(generations, [], 6))
+
+        # the first backup, and backups rotated by number
+        self.assertIsNone(incremental.getParent([], checkpoints, 6))
+        self.assertIsNone(incremental.getParent(
+            [retention.parseName("vm", "vm.tar.gz")], checkpoints, 6))
+
+    def testGetChain(self):
+        generations = getGenerations([0, 1, 3])
+
+        chain = incremental.getChain(generations, generations[1]["name"])
+
+        self.assertEqual([item["name"] for item in chain], [
+            "vm.20220129T230000.tar.gz",
+            "vm.20220130T230000.inc.tar.gz"])
+
+        # a full backup is restored alone
+        chain = incremental.getChain(generations, generations[2]["name"])
+        self.assertEqual(chain, [generations[2]])
+
+        with self.assertRaisesRegex(Exception, "not a backup generation"):
+            incremental.getChain(generations, "vm.tar.gz")
+
+        # the full backup was removed
+        with self.assertRaisesRegex(Exception, "Cannot find the full"):
+            incremental.getChain(generations[:2], generations[0]["name"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Read images exported by the fake NBD server with the NBD client
+
+"""
+
+from __future__ import print_function
+
+import functools
+import os
+import unittest
+
+import common
+
+from Lib import nbd
+
+import fakenbd
+
+# the dirty regions of the bitmap exported with vdb
+DIRTY = [(0, 65536), (common.IMAGE_SIZE // 2, 131072)]
+
+
+class NBDTest(common.TestCase):
+    """Read data, allocation and dirty bitmaps of exports"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.disks = self.makeImages()
+        self.path = os.path.join(self.tmpdir, "nbd.sock")
+
+        self.server = fakenbd.Server(
+            self.path, self.disks, bitmaps={"vdb": {"backup-vdb": DIRTY}})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def connect(self, export, contexts=None):
+        return nbd.Client(self.path, export=export, contexts=contexts)
+
+    def readFile(self, dev, offset, length):
+        with open(self.disks[dev], "rb") as handle:
+            handle.seek(offset)
+            return handle.read(length)
+
+    def testRead(self):
+        with self.connect("vda") as client:
+            self.assertEqual(client.size, common.IMAGE_SIZE)
+
+            for offset, length in [(0, 4096), (12345, 1000000),
+                                   (common.IMAGE_SIZE - 512, 512)]:
+                self.assertEqual(client.read(offset, length),
+                                 self.readFile("vda", offset, length))
+
+    def testAllocation(self):
+        with open(self.disks["vdb"], "rb") as handle:
+            expected = fakenbd.getExtents(handle, common.IMAGE_SIZE)
+
+        with self.connect("vdb", [nbd.BASE_ALLOCATION]) as client:
+            extents = client.getExtents(
+                nbd.BASE_ALLOCATION, nbd.NBD_STATE_HOLE, 0)
+
+        # a sparse image has data and holes
+        self.assertTrue(0 < len(extents))
+        self.assertLess(sum([length for offset, length in extents]),
+                        common.IMAGE_SIZE)
+        self.assertEqual(extents, expected)
+
+    def testDirtyBitmap(self):
+        context = nbd.DIRTY_BITMAP + "backup-vdb"
+
+        with self.connect("vdb", [context]) as client:
+            self.assertEqual(
+                client.getExtents(context, nbd.NBD_STATE_DIRTY), DIRTY)
+
+    def testRangeReader(self):
+        connect = functools.partial(self.connect, "vdb")
+
+        with open(self.disks["vdb"], "rb") as handle:
+            extents = fakenbd.getExtents(handle, common.IMAGE_SIZE)
+
+        reader = nbd.RangeReader(
+            connect, common.IMAGE_SIZE, extents, readers=2,
+            range_size=256 * 1024)
+
+        try:
+            for offset, length in extents:
+                reader.seek(offset)
+
+                # reads return the data of a range at most
+                data = b""
+
+                while len(data) < length:
+                    chunk = reader.read(length - len(data))
+                    self.assertTrue(chunk)
+                    data += chunk
+
+                self.assertEqual(data, self.readFile("vdb", offset, length))
+
+        finally:
+            reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
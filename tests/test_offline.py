@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Lock domains shut off, and check locks as the libvirt hook does
+
+"""
+
+from __future__ import print_function
+
+import importlib.machinery
+import importlib.util
+import os
+import unittest
+from unittest import mock
+
+import common
+
+from Lib import offline
+
+
+def loadHook():
+    """Import hooks/qemu, which has no extension"""
+
+    path = os.path.join(common.REPO_DIR, "hooks", "qemu")
+    loader = importlib.machinery.SourceFileLoader("qemu_hook", path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+
+    hook = importlib.util.module_from_spec(spec)
+    loader.exec_module(hook)
+
+    return hook
+
+
+class OfflineTest(common.TestCase):
+    """Domain locks seen by kvmBackup and by the hook"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.hook = loadHook()
+
+        # the hook checks the lock files of backups
+        self.assertEqual(self.hook.LOCK_DIR, offline.LOCK_DIR)
+
+        lock_dir = os.path.join(self.tmpdir, "locks")
+
+        for module in [offline, self.hook]:
+            patcher = mock.patch.object(module, "LOCK_DIR", lock_dir)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def testLock(self):
+        self.assertFalse(offline.isLocked("vm"))
+        self.assertFalse(self.hook.isLocked("vm"))
+
+        with offline.DomainLock("vm"):
+            self.assertTrue(offline.isLocked("vm"))
+            self.assertTrue(self.hook.isLocked("vm"))
+            self.assertFalse(self.hook.isLocked("other"))
+
+            # a domain is locked by one backup only
+            with self.assertRaises(RuntimeError):
+                offline.DomainLock("vm").acquire()
+
+        self.assertFalse(offline.isLocked("vm"))
+        self.assertFalse(self.hook.isLocked("vm"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Restore in their original paths the raw images read by backup jobs: they
+must be converted before original images are replaced, or refused if they
+can't be converted
+
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import common
+
+import kvmBackup
+from Lib import incremental, restore
+
+import fakecheckpoints
+
+
+def findProgram(path):
+    """Return a shutil.which in which qemu-img is in path"""
+
+    which = shutil.which
+
+    def findQemuImg(name, *args, **kwargs):
+        if name == "qemu-img":
+            return path
+
+        return which(name, *args, **kwargs)
+
+    return findQemuImg
+
+
+class RawRestoreTest(common.TestCase):
+    """Restore the raw images of plain archives in their original paths"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.disks = self.makeDomain()
+        self.backupdir = os.path.join(self.tmpdir, "backup")
+
+    def backup(self, parameters):
+        """Backup the fake domain, then change its images. Return the
+        digests of images in backup, and of changed images"""
+
+        kvmBackup.backup(
+            "vm", dict(parameters, overlay_dir=self.tmpdir), self.backupdir)
+
+        saved = dict([(image, common.getDigest(image))
+                      for image in self.disks.values()])
+
+        for image in self.disks.values():
+            with open(image, "r+b") as handle:
+                handle.write(os.urandom(4096))
+
+        changed = dict([(image, common.getDigest(image))
+                        for image in self.disks.values()])
+
+        return saved, changed
+
+    def getRestore(self):
+        path = restore.findBackup(self.backupdir, "vm")
+
+        # a plain tar archive, with the information member after images
+        self.assertTrue(os.path.basename(path).endswith(".tar.gz"))
+
+        return restore.Restore(path, force=True)
+
+    def checkRefused(self, parameters):
+        saved, changed = self.backup(parameters)
+
+        with mock.patch.object(shutil, "which", findProgram(None)):
+            with self.assertRaisesRegex(Exception, "qemu-img is needed"):
+                self.getRestore().run()
+
+        # original images are untouched
+        for image, digest in changed.items():
+            self.assertEqual(common.getDigest(image), digest)
+            self.assertFalse(os.path.exists(image + ".part"))
+
+    def checkConverted(self, parameters):
+        saved, changed = self.backup(parameters)
+        converted = []
+
+        def convertImage(path, image_format):
+            # original images are replaced once converted
+            image = path[:-len(".part")]
+
+            self.assertTrue(path.endswith(".part"))
+            self.assertEqual(common.getDigest(image), changed[image])
+            converted.append((image, image_format))
+
+        with mock.patch.object(
+                shutil, "which", findProgram("/usr/bin/qemu-img")), \
+                mock.patch.object(restore, "convertImage", convertImage):
+            restored = self.getRestore().run()
+
+        self.assertEqual(sorted(converted), sorted(
+            [(image, "qcow2") for image in self.disks.values()]))
+        self.assertEqual(sorted(restored.values()),
+                         sorted(self.disks.values()))
+
+        for image, digest in saved.items():
+            self.assertEqual(common.getDigest(image), digest)
+
+    def installCheckpoints(self):
+        provider = incremental.PROVIDERS["libvirt"]
+        self.addCleanup(
+            incremental.PROVIDERS.__setitem__, "libvirt", provider)
+
+        fakecheckpoints.install(os.path.join(self.tmpdir, "checkpoints"))
+
+    def testPullRefused(self):
+        self.checkRefused(
+            {"mode": "stream", "engine": "pull", "compression": "gzip"})
+
+    def testPullConverted(self):
+        self.checkConverted(
+            {"mode": "stream", "engine": "pull", "compression": "gzip"})
+
+    def testFullRefused(self):
+        self.installCheckpoints()
+        self.checkRefused({"mode": "incremental", "compression": "gzip"})
+
+    def testFullConverted(self):
+        self.installCheckpoints()
+        self.checkConverted({"mode": "incremental", "compression": "gzip"})
+
+    def testStreamNotConverted(self):
+        saved, changed = self.backup(
+            {"mode": "stream", "compression": "gzip"})
+
+        # images of snapshots have their format, without qemu-img
+        with mock.patch.object(shutil, "which", findProgram(None)):
+            self.getRestore().run()
+
+        for image, digest in saved.items():
+            self.assertEqual(common.getDigest(image), digest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Name backup generations by date, and select the ones kept by retention
+policies
+
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import unittest
+
+import common
+
+from Lib import retention, storage
+
+
+def getGenerations(dates, incremental=()):
+    """Return generations of 'vm' at dates (newest first). Generations
+    whose index is in incremental are incremental backups"""
+
+    generations = []
+
+    for index, date in enumerate(dates):
+        extension = ".tar.gz"
+
+        if index in incremental:
+            extension = retention.INCREMENTAL_EXT + extension
+
+        generations += [retention.parseName(
+            "vm", retention.getName("vm", extension, date))]
+
+    return generations
+
+
+def getDays(start, days):
+    """Return a backup at 23:00 of every day, newest first"""
+
+    return [start - datetime.timedelta(days=day) for day in range(days)]
+
+
+class RetentionTest(common.TestCase):
+    """Parse generation names and apply policies"""
+
+    def testParseName(self):
+        date = datetime.datetime(2022, 1, 31, 23, 0)
+
+        item = retention.parseName("vm", "vm.20220131T230000.tar.gz")
+        self.assertEqual(item["date"], date)
+        self.assertFalse(item["incremental"])
+
+        item = retention.parseName("vm", "vm.20220131T230000.inc.tar.zst")
+        self.assertTrue(item["incremental"])
+
+        item = retention.parseName("vm", "vm.tar.gz.2")
+        self.assertIsNone(item["date"])
+        self.assertEqual(item["number"], 2)
+
+        # other domains and other files are not generations
+        for name in ["vm2.20220131T230000.tar.gz", "vm.20220131.tar.gz",
+                     "vm.20220131T230000.tar.gz.part", "vm.checkpoint.json"]:
+            self.assertIsNone(retention.parseName("vm", name))
+
+    def testGetDate(self):
+        date = datetime.datetime(2022, 1, 31, 23, 0, 0, 500)
+        generations = getGenerations([date.replace(microsecond=0)])
+
+        # a generation is never overwritten
+        self.assertEqual(retention.getDate(generations, date),
+                         datetime.datetime(2022, 1, 31, 23, 0, 1))
+
+    def testListGenerations(self):
+        backend = storage.LocalStorage(self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, "vm"))
+
+        for name in ["vm.tar.gz.1", "vm.20220130T230000.tar.gz",
+                     "vm.20220131T230000.inc.tar.gz", "vm.tar.gz",
+                     "vm.20220131T230000.tar.gz.part"]:
+            open(os.path.join(self.tmpdir, "vm", name), "w").close()
+
+        # dated ones, newest first, then the ones rotated by number
+        self.assertEqual(
+            [item["name"] for item in
+             retention.listGenerations(backend, "vm")],
+            ["vm.20220131T230000.inc.tar.gz", "vm.20220130T230000.tar.gz",
+             "vm.tar.gz", "vm.tar.gz.1"])
+
+        self.assertEqual(retention.listGenerations(backend, "other"), [])
+
+    def testGetPolicy(self):
+        self.assertEqual(retention.getPolicy({}), {"keep_last": 3})
+        self.assertEqual(retention.getPolicy({"rotate": 5}),
+                         {"keep_last": 5})
+
+        for policy in [{"keep_yearly": 1}, {"keep_daily": -1},
+                       {"keep_daily": "7"}]:
+            with self.assertRaises(RuntimeError):
+                retention.getPolicy({"retention": policy})
+
+    def testKeepLast(self):
+        generations = getGenerations(
+            getDays(datetime.datetime(2022, 1, 31, 23, 0), 10))
+
+        keep = retention.selectGenerations(generations, {"keep_last": 3})
+
+        self.assertEqual(keep, set(
+            [item["name"] for item in generations[:3]]))
+
+        # the last backup is never removed
+        keep = retention.selectGenerations(generations, {})
+
+        self.assertEqual(keep, set([generations[0]["name"]]))
+
+    def testGFS(self):
+        # every day from 2022-03-31 back to 2021-12-02
+        generations = getGenerations(
+            getDays(datetime.datetime(2022, 3, 31, 23, 0), 120))
+
+        keep = retention.selectGenerations(generations, {
+            "keep_daily": 3, "keep_weekly": 2, "keep_monthly": 3})
+
+        self.assertEqual(sorted(keep), sorted([
+            # daily
+            "vm.20220331T230000.tar.gz",
+            "vm.20220330T230000.tar.gz",
+            "vm.20220329T230000.tar.gz",
+            # the last of this week is the daily one, then last Sunday
+            "vm.20220327T230000.tar.gz",
+            # the last of March is the daily one, then February and January
+            "vm.20220228T230000.tar.gz",
+            "vm.20220131T230000.tar.gz"]))
+
+    def testNumbered(self):
+        generations = getGenerations(
+            getDays(datetime.datetime(2022, 1, 31, 23, 0), 2))
+        generations += [retention.parseName("vm", "vm.tar.gz.1")]
+
+        # generations rotated by number are kept only by keep_last
+        keep = retention.selectGenerations(generations, {"keep_daily": 7})
+        self.assertNotIn("vm.tar.gz.1", keep)
+
+        keep = retention.selectGenerations(generations, {"keep_last": 3})
+        self.assertIn("vm.tar.gz.1", keep)
+
+    def testChains(self):
+        # a full backup every 3 days, incremental ones in between
+        generations = getGenerations(
+            getDays(datetime.datetime(2022, 1, 31, 23, 0), 6),
+            incremental=[0, 1, 3, 4])
+
+        # incremental backups need the backups they are chained to
+        keep = retention.selectGenerations(generations, {"keep_last": 1})
+
+        self.assertEqual(keep, set(
+            [item["name"] for item in generations[:3]]))
+
+        keep = retention.selectGenerations(generations, {"keep_last": 4})
+
+        self.assertEqual(keep, set(
+            [item["name"] for item in generations]))
+
+    def testApplyPolicy(self):
+        backend = storage.LocalStorage(self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, "vm"))
+
+        generations = getGenerations(
+            getDays(datetime.datetime(2022, 1, 31, 23, 0), 5))
+
+        for item in generations:
+            open(os.path.join(self.tmpdir, "vm", item["name"]), "w").close()
+
+        removed = retention.applyPolicy(backend, "vm", {"keep_last": 2})
+
+        self.assertEqual(removed, [item["name"] for item in generations[2:]])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, "vm"))),
+                         sorted([item["name"] for item in generations[:2]]))
+
+
+if __name__ == "__main__":
+    unittest.main()
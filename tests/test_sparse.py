@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Copy synthetic images with every copy method: copies must be equal to
+their sources
+
+"""
+
+from __future__ import print_function
+
+import os
+import unittest
+
+import common
+
+from Lib import sparse
+
+
+class SparseTest(common.TestCase):
+    """Copy dense and sparse images"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.disks = self.makeImages()
+
+    def copy(self, method, is_sparse=True):
+        for dev, image in self.disks.items():
+            dest = os.path.join(self.tmpdir, "%s-%s" % (dev, method))
+
+            written, used = sparse.copyImage(
+                image, dest, sparse=is_sparse, method=method)
+
+            self.assertIn(used, sparse.COPY_METHODS)
+            self.assertLessEqual(written, common.IMAGE_SIZE)
+            self.assertEqual(common.getDigest(dest), common.getDigest(image))
+
+    def testAuto(self):
+        self.copy("auto")
+
+    def testBuffered(self):
+        self.copy("buffered")
+
+    def testDense(self):
+        self.copy("buffered", is_sparse=False)
+
+    def testUnknown(self):
+        with self.assertRaises(RuntimeError):
+            sparse.copyImage(
+                self.disks["vda"], os.path.join(self.tmpdir, "vda"),
+                method="unknown")
+
+
+if __name__ == "__main__":
+    unittest.main()
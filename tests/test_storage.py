@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Write and read files in the fake S3 storage
+
+"""
+
+from __future__ import print_function
+
+import os
+import unittest
+from unittest import mock
+
+import common
+
+import kvmBackup
+from Lib import storage
+
+import fakes3
+
+
+class S3Test(common.TestCase):
+    """Upload objects in parts, and clean uploads left by backups"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.client = fakes3.install(os.path.join(self.tmpdir, "s3"))
+        self.backend = storage.S3Storage(
+            "s3://bucket/backup", client=self.client)
+
+    def write(self, writer, data, block=7):
+        for start in range(0, len(data), block):
+            writer.write(data[start:start + block])
+
+        writer.close()
+
+    def read(self, name):
+        reader = self.backend.open(name, "rb")
+
+        try:
+            return reader.read()
+
+        finally:
+            reader.close()
+
+    def testParts(self):
+        data = os.urandom(1000)
+        writer = storage.S3Writer(
+            self.client, "bucket", "backup/vm/parts", part_size=100,
+            workers=2)
+
+        self.write(writer, data)
+
+        self.assertEqual(self.client.calls["upload_part"], 10)
+        self.assertEqual(self.read("vm/parts"), data)
+
+    def testSmall(self):
+        self.write(self.backend.open("vm/small"), b"data")
+
+        self.assertEqual(self.client.calls["put_object"], 1)
+        self.assertNotIn("create_multipart_upload", self.client.calls)
+        self.assertEqual(self.read("vm/small"), b"data")
+
+    @mock.patch.object(storage, "PART_GROWTH", 2)
+    @mock.patch.object(storage, "MAX_PARTS", 6)
+    def testGrowth(self):
+        # parts of 10, 10, 20, 20, 40 and 40 bytes
+        data = os.urandom(140)
+        writer = storage.S3Writer(
+            self.client, "bucket", "backup/vm/growth", part_size=10)
+
+        self.write(writer, data)
+
+        self.assertEqual(self.client.calls["upload_part"], 6)
+        self.assertEqual(self.read("vm/growth"), data)
+
+        # an upload can't have more parts
+        writer = storage.S3Writer(
+            self.client, "bucket", "backup/vm/big", part_size=10)
+
+        with self.assertRaisesRegex(IOError, "more than 6 parts"):
+            self.write(writer, data + b"more")
+
+        self.assertFalse(self.client.uploads)
+
+    @mock.patch.object(storage, "MAX_PARTS", 4)
+    def testSize(self):
+        data = os.urandom(1000)
+        path = os.path.join(self.tmpdir, "upload")
+
+        with open(path, "wb") as handle:
+            handle.write(data)
+
+        # parts are big enough for a known size
+        self.backend.part_size = 100
+        self.backend.upload(path, "vm/upload")
+
+        self.assertEqual(self.client.calls["upload_part"], 4)
+        self.assertEqual(self.read("vm/upload"), data)
+
+    def testAbortUploads(self):
+        # uploads left by a killed process
+        for key in ["backup/vm/archive.tar.gz", "backup/vm2/archive.tar.gz"]:
+            writer = storage.S3Writer(
+                self.client, "bucket", key, part_size=10)
+            writer.write(os.urandom(100))
+
+            while writer.pending:
+                writer.pending.popleft().result()
+
+        kvmBackup.removeLeftovers(self.backend, "vm")
+
+        # only the uploads of domain are aborted
+        self.assertEqual(
+            [key for bucket, key in self.client.uploads.values()],
+            ["backup/vm2/archive.tar.gz"])
+        self.assertEqual(self.client.calls["abort_multipart_upload"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+
+kvmBackup - a software for snapshotting KVM images and backing them up
+Copyright (C) 2015-2022  Paolo Cozzi
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+@author: Paolo Cozzi <bunop@libero.it>
+
+Token buckets, and the buckets shared by domains, with a fake clock
+
+"""
+
+from __future__ import print_function
+
+import unittest
+from unittest import mock
+
+import common
+
+from Lib import throttle
+
+MiB = 1024 * 1024
+
+
+class Clock():
+    """A clock which moves only when sleeping"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class ThrottleTest(common.TestCase):
+    """Limit rates with token buckets"""
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+
+        self.clock = Clock()
+
+        patcher = mock.patch.object(throttle, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # buckets are shared by the whole process
+        for registry in [throttle.buckets, throttle.host_limits]:
+            self.addCleanup(registry.clear)
+            registry.clear()
+
+    def testBurst(self):
+        bucket = throttle.TokenBucket(100)
+
+        # a full bucket doesn't wait
+        bucket.consume(100)
+        self.assertEqual(self.clock.slept, 0)
+
+        bucket.consume(50)
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+
+        # tokens are added while time passes
+        self.clock.now += 10
+        bucket.consume(100)
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+
+    def testFactor(self):
+        bucket = throttle.TokenBucket(100)
+        bucket.consume(100)
+
+        # half rate: tokens are consumed twice as fast
+        bucket.consume(50, factor=0.5)
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+
+    def testSetRate(self):
+        bucket = throttle.TokenBucket(100)
+        bucket.consume(100)
+
+        bucket.setRate(10)
+        self.assertEqual(bucket.burst, 10)
+
+        bucket.consume(10)
+        self.assertAlmostEqual(self.clock.slept, 1.0)
+
+    def testGetBuckets(self):
+        limits = {"read_bandwidth": 10, "write_iops": 5}
+        buckets = throttle.getBuckets(("domain", "vm"), limits)
+
+        self.assertEqual(sorted(buckets), ["read_bandwidth", "write_iops"])
+        self.assertEqual(buckets["read_bandwidth"].rate, 10 * MiB)
+        self.assertEqual(buckets["write_iops"].rate, 5)
+
+        # the same buckets, with the new rates
+        again = throttle.getBuckets(("domain", "vm"), {"read_bandwidth": 20})
+
+        self.assertEqual(list(again), ["read_bandwidth"])
+        self.assertIs(again["read_bandwidth"], buckets["read_bandwidth"])
+        self.assertEqual(buckets["read_bandwidth"].rate, 20 * MiB)
+
+        self.assertEqual(throttle.getBuckets(("domain", "vm"), None), {})
+        self.assertNotIn(("domain", "vm"), throttle.buckets)
+
+    def testHostLimits(self):
+        throttle.configure({"host_throttle": {"read_bandwidth": 100}})
+
+        # domain parameters don't change the limits of host
+        first = throttle.getThrottle(
+            "vm1", {"host_throttle": {"read_bandwidth": 1}}, self.tmpdir)
+        second = throttle.getThrottle("vm2", {}, self.tmpdir)
+
+        self.assertEqual(first.getRate("read"), 100 * MiB)
+        self.assertEqual(second.getRate("read"), 100 * MiB)
+        self.assertIsNone(second.getRate("write"))
+
+    def testReload(self):
+        throttle.configure({
+            "host_throttle": {"read_bandwidth": 100},
+            "target_throttle": {"write_bandwidth": 50}})
+
+        limits = throttle.getThrottle(
+            "vm", {"throttle": {"read_bandwidth": 200}}, self.tmpdir)
+
+        self.assertEqual(limits.getRate("read"), 100 * MiB)
+        self.assertEqual(limits.getRate("write"), 50 * MiB)
+
+        # a running backup follows the new shared limits
+        throttle.configure({
+            "host_throttle": {"read_bandwidth": 300},
+            "target_throttle": {"write_bandwidth": 25}})
+
+        self.assertEqual(limits.getRate("read"), 200 * MiB)
+        self.assertEqual(limits.getRate("write"), 25 * MiB)
+
+        # limits removed apply to next backups
+        throttle.configure({})
+
+        limits = throttle.getThrottle("vm", {}, self.tmpdir)
+
+        self.assertFalse(limits.isActive())
+
+
+if __name__ == "__main__":
+    unittest.main()